@@ -0,0 +1,105 @@
+import json
+import numpy as np
+
+
+# string columns are stored as one utf-8 blob with int64 offsets [num_rows + 1], int columns as int64
+# arrays [num_rows] and int list columns as one int64 array with offsets. A column is only kept if every
+# annotation has the key.
+STR_COLUMNS = ('clip_name', 'clip_path', 'pose_file', 'caption')
+INT_COLUMNS = ('height', 'width', 'num_frames')
+# key_indices: the keyframe positions of the clip, see tools/build_annotation_index.py
+LIST_COLUMNS = ('key_indices',)
+ALIGNMENT = 8
+
+
+def build_annotation_index(annotations, store_path):
+    """Writes the annotations (list of dicts of generate_realestate_json.py) into `store_path`.bin and `store_path`.json."""
+    arrays = {}
+    for name in STR_COLUMNS:
+        if not all(name in x for x in annotations):
+            continue
+        encoded = [x[name].encode('utf-8') for x in annotations]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        arrays[name + '.data'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        arrays[name + '.offsets'] = offsets
+    for name in INT_COLUMNS:
+        if not all(name in x for x in annotations):
+            continue
+        arrays[name] = np.asarray([x[name] for x in annotations], dtype=np.int64)
+    for name in LIST_COLUMNS:
+        if not all(name in x for x in annotations):
+            continue
+        offsets = np.zeros(len(annotations) + 1, dtype=np.int64)
+        np.cumsum([len(x[name]) for x in annotations], out=offsets[1:])
+        arrays[name + '.data'] = np.concatenate([np.asarray(x[name], dtype=np.int64) for x in annotations])
+        arrays[name + '.offsets'] = offsets
+
+    layout = {}
+    position = 0
+    with open(store_path + '.bin', 'wb') as f:
+        for name, array in arrays.items():
+            padding = -position % ALIGNMENT
+            f.write(b'\0' * padding)
+            position += padding
+            layout[name] = [position, array.dtype.str, len(array)]
+            f.write(array.tobytes())
+            position += array.nbytes
+    with open(store_path + '.json', 'w') as f:
+        json.dump({'num_rows': len(annotations), 'size': position, 'arrays': layout}, fp=f)
+    return len(annotations)
+
+
+class AnnotationIndex(object):
+    """Read-only columnar annotations, drop-in replacement of the list of dicts loaded from the annotation json.
+
+    The columns are numpy views of one memory-mapped file, so the dataloader workers share its pages
+    instead of each copying the python objects of the list on write.
+    """
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(store_path + '.json', 'r') as f:
+            index = json.load(f)
+        self.num_rows = index['num_rows']
+        self.size = index['size']
+        self.layout = index['arrays']
+        self.str_columns = [name for name in STR_COLUMNS if name + '.data' in self.layout]
+        self.int_columns = [name for name in INT_COLUMNS if name in self.layout]
+        self.list_columns = [name for name in LIST_COLUMNS if name + '.data' in self.layout]
+        self._arrays = None
+
+    @property
+    def arrays(self):
+        # opened lazily, so that every dataloader worker maps the file after fork
+        if self._arrays is None:
+            data = np.memmap(self.store_path + '.bin', dtype=np.uint8, mode='r', shape=(self.size,))
+            self._arrays = {}
+            for name, (offset, dtype, length) in self.layout.items():
+                dtype = np.dtype(dtype)
+                self._arrays[name] = data[offset: offset + length * dtype.itemsize].view(dtype)
+        return self._arrays
+
+    def __len__(self):
+        return self.num_rows
+
+    def get_str(self, name, idx):
+        offsets = self.arrays[name + '.offsets']
+        return self.arrays[name + '.data'][offsets[idx]: offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, idx):
+        idx = range(self.num_rows)[idx]
+        video_dict = {name: self.get_str(name, idx) for name in self.str_columns}
+        video_dict.update({name: int(self.arrays[name][idx]) for name in self.int_columns})
+        for name in self.list_columns:
+            offsets = self.arrays[name + '.offsets']
+            video_dict[name] = self.arrays[name + '.data'][offsets[idx]: offsets[idx + 1]]
+        return video_dict
+
+    def __iter__(self):
+        for idx in range(self.num_rows):
+            yield self[idx]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
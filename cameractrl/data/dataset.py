@@ -1,22 +1,36 @@
 import os
 import random
 import json
+import functools
 import torch
 
 import torch.nn as nn
 import torchvision.transforms as transforms
-import torchvision.transforms.functional as F
 import numpy as np
 
 from decord import VideoReader
 from torch.utils.data.dataset import Dataset
 from packaging import version as pver
 
+from cameractrl.data.pose_store import POSE_DIM, PoseStore, read_pose_file
+from cameractrl.data.latent_cache import LatentCache
+from cameractrl.data.annotation_index import AnnotationIndex
+from cameractrl.data.quarantine import QuarantineRegistry, ShortClipError, BadPoseError, get_failure_reason
+from cameractrl.data.reader_pool import VideoReaderPool
+
+
+def hflip_frames(frames, flip_flag):
+    # frames: [..., n_frame, C, H, W], flip_flag: [..., n_frame], flips the frames set in flip_flag at once
+    flip_flag = flip_flag.to(frames.device)
+    flip_flag = flip_flag.reshape(flip_flag.shape + (1, ) * (frames.dim() - flip_flag.dim()))
+    return torch.where(flip_flag, frames.flip(-1), frames)
+
 
 class RandomHorizontalFlipWithPose(nn.Module):
-    def __init__(self, p=0.5):
+    def __init__(self, p=0.5, inplace=False):
         super(RandomHorizontalFlipWithPose, self).__init__()
         self.p = p
+        self.inplace = inplace
 
     def get_flip_flag(self, n_image):
         return torch.rand(n_image) < self.p
@@ -28,27 +42,89 @@ class RandomHorizontalFlipWithPose(nn.Module):
         else:
             flip_flag = self.get_flip_flag(n_image)
 
-        ret_images = []
-        for fflag, img in zip(flip_flag, image):
-            if fflag:
-                ret_images.append(F.hflip(img))
-            else:
-                ret_images.append(img)
-        return torch.stack(ret_images, dim=0)
-
+        if not flip_flag.any():
+            return image
+        if self.inplace:
+            # only the flipped frames are copied
+            image[flip_flag] = image[flip_flag].flip(-1)
+            return image
+        return hflip_frames(image, flip_flag)
+
+
+def batch_pixel_transforms(pixel_values, flip_flag=None):
+    """Normalizes uint8 frames of a batch to [-1, 1] and flips the ones set in `flip_flag` horizontally.
+
+    Used on the training device for the datasets created with `return_uint8`, float frames are already
+    transformed in the dataloader workers and are returned unchanged.
+    """
+    if pixel_values.dtype != torch.uint8:
+        return pixel_values
+    pixel_values = pixel_values.float().div_(127.5).sub_(1.)      # same as Normalize(0.5, 0.5) on [0, 1]
+    if flip_flag is not None:
+        pixel_values = hflip_frames(pixel_values, flip_flag)
+    return pixel_values
+
+
+class CameraTrajectory(object):
+    """Intrinsics [N, 4] (normalized fx, fy, cx, cy) and w2c [N, 4, 4] of a camera trajectory."""
+    def __init__(self, intrinsics, w2c, c2w=None):
+        self.intrinsics = np.ascontiguousarray(intrinsics, dtype=np.float64)
+        self.w2c = np.ascontiguousarray(w2c, dtype=np.float64)
+        self._c2w = c2w
+
+    @classmethod
+    def from_entries(cls, entries):
+        # entries: [N, 19], rows of the RealEstate10K pose txt files
+        entries = np.asarray(entries, dtype=np.float64).reshape(-1, POSE_DIM)
+        w2c = np.tile(np.eye(4), (len(entries), 1, 1))
+        w2c[:, :3, :] = entries[:, 7:].reshape(-1, 3, 4)
+        return cls(entries[:, 1:5], w2c)
+
+    @classmethod
+    def from_pose_file(cls, pose_file):
+        return cls.from_entries(read_pose_file(pose_file, dtype=np.float64))
+
+    @property
+    def c2w(self):
+        # closed-form inverse of the rigid transforms: [R | t]^-1 = [R^T | -R^T t]
+        if self._c2w is None:
+            rot_t = self.w2c[:, :3, :3].transpose(0, 2, 1)
+            c2w = np.tile(np.eye(4), (len(self), 1, 1))
+            c2w[:, :3, :3] = rot_t
+            c2w[:, :3, 3] = -(rot_t @ self.w2c[:, :3, 3:])[..., 0]
+            self._c2w = c2w
+        return self._c2w
 
-class Camera(object):
-    def __init__(self, entry):
-        fx, fy, cx, cy = entry[1:5]
-        self.fx = fx
-        self.fy = fy
-        self.cx = cx
-        self.cy = cy
-        w2c_mat = np.array(entry[7:]).reshape(3, 4)
-        w2c_mat_4x4 = np.eye(4)
-        w2c_mat_4x4[:3, :] = w2c_mat
-        self.w2c_mat = w2c_mat_4x4
-        self.c2w_mat = np.linalg.inv(w2c_mat_4x4)
+    def __len__(self):
+        return self.w2c.shape[0]
+
+    def __getitem__(self, frame_indices):
+        return CameraTrajectory(self.intrinsics[frame_indices], self.w2c[frame_indices],
+                                self._c2w[frame_indices] if self._c2w is not None else None)
+
+    def rescale_fxy(self, ori_wh_ratio, sample_size):
+        # the frames are resized to sample_size without keeping the aspect ratio
+        sample_h, sample_w = sample_size
+        intrinsics = self.intrinsics.copy()
+        if ori_wh_ratio > sample_w / sample_h:      # rescale fx
+            intrinsics[:, 0] *= sample_h * ori_wh_ratio / sample_w
+        else:                                       # rescale fy
+            intrinsics[:, 1] *= sample_w / ori_wh_ratio / sample_h
+        return CameraTrajectory(intrinsics, self.w2c, self._c2w)
+
+    def get_intrinsics(self, sample_size):
+        sample_h, sample_w = sample_size
+        return (self.intrinsics * np.array([sample_w, sample_h, sample_w, sample_h])).astype(np.float32)
+
+    def get_relative_c2w(self, zero_t_first_frame=True):
+        c2ws = self.c2w
+        cam_to_origin = 0 if zero_t_first_frame else np.linalg.norm(c2ws[0, :3, 3])
+        target_cam_c2w = np.eye(4)
+        target_cam_c2w[1, 3] = -cam_to_origin
+        abs2rel = target_cam_c2w @ self.w2c[0]
+        ret_poses = abs2rel @ c2ws
+        ret_poses[0] = target_cam_c2w
+        return ret_poses.astype(np.float32)
 
 
 def custom_meshgrid(*args):
@@ -59,51 +135,70 @@ def custom_meshgrid(*args):
         return torch.meshgrid(*args, indexing='ij')
 
 
+@functools.lru_cache(maxsize=16)
+def get_pixel_grid(H, W, dtype, device):
+    # homogeneous pixel centers [HxW, 3], cached per resolution and device
+    j, i = custom_meshgrid(
+        torch.linspace(0, H - 1, H, device=device, dtype=dtype),
+        torch.linspace(0, W - 1, W, device=device, dtype=dtype),
+    )
+    grid = torch.stack((i + 0.5, j + 0.5, torch.ones_like(i)), dim=-1)     # H, W, 3
+    return grid.reshape(H * W, 3)
+
+
 def ray_condition(K, c2w, H, W, device, flip_flag=None):
     # c2w: B, V, 4, 4
     # K: B, V, 4
+    # flip_flag: V or B, V
 
     B, V = K.shape[:2]
 
-    j, i = custom_meshgrid(
-        torch.linspace(0, H - 1, H, device=device, dtype=c2w.dtype),
-        torch.linspace(0, W - 1, W, device=device, dtype=c2w.dtype),
-    )
-    i = i.reshape([1, 1, H * W]).expand([B, V, H * W]) + 0.5          # [B, V, HxW]
-    j = j.reshape([1, 1, H * W]).expand([B, V, H * W]) + 0.5          # [B, V, HxW]
-
-    n_flip = torch.sum(flip_flag).item() if flip_flag is not None else 0
-    if n_flip > 0:
-        j_flip, i_flip = custom_meshgrid(
-            torch.linspace(0, H - 1, H, device=device, dtype=c2w.dtype),
-            torch.linspace(W - 1, 0, W, device=device, dtype=c2w.dtype)
-        )
-        i_flip = i_flip.reshape([1, 1, H * W]).expand(B, 1, H * W) + 0.5
-        j_flip = j_flip.reshape([1, 1, H * W]).expand(B, 1, H * W) + 0.5
-        i[:, flip_flag, ...] = i_flip
-        j[:, flip_flag, ...] = j_flip
-
-    fx, fy, cx, cy = K.chunk(4, dim=-1)     # B,V, 1
-
-    zs = torch.ones_like(i)                 # [B, V, HxW]
-    xs = (i - cx) / fx * zs
-    ys = (j - cy) / fy * zs
-    zs = zs.expand_as(ys)
-
-    directions = torch.stack((xs, ys, zs), dim=-1)              # B, V, HW, 3
-    directions = directions / directions.norm(dim=-1, keepdim=True)             # B, V, HW, 3
-
-    rays_d = directions @ c2w[..., :3, :3].transpose(-1, -2)        # B, V, HW, 3
+    pixels = get_pixel_grid(H, W, c2w.dtype, torch.device(device))  # HW, 3, broadcast over B, V
+
+    fx, fy, cx, cy = K.unbind(dim=-1)   # B, V
+    zeros, ones = torch.zeros_like(fx), torch.ones_like(fx)
+    K_inv = torch.stack((1. / fx, zeros, -cx / fx,
+                         zeros, 1. / fy, -cy / fy,
+                         zeros, zeros, ones), dim=-1).reshape(B, V, 3, 3)
+
+    # rays_d = R @ normalize(K^-1 @ p), rays_dxo = rays_o x rays_d = [rays_o]_x @ rays_d, so both are
+    # obtained with a single [6, 3] projection of the pixels, and normalized afterwards
     rays_o = c2w[..., :3, 3]                                        # B, V, 3
-    rays_o = rays_o[:, :, None].expand_as(rays_d)                   # B, V, HW, 3
-    # c2w @ dirctions
-    rays_dxo = torch.cross(rays_o, rays_d)                          # B, V, HW, 3
-    plucker = torch.cat([rays_dxo, rays_d], dim=-1)
-    plucker = plucker.reshape(B, c2w.shape[1], H, W, 6)             # B, V, H, W, 6
+    ox, oy, oz = rays_o.unbind(dim=-1)
+    rays_o_cross = torch.stack((zeros, -oz, oy,
+                                oz, zeros, -ox,
+                                -oy, ox, zeros), dim=-1).reshape(B, V, 3, 3)
+    proj_d = c2w[..., :3, :3] @ K_inv                               # B, V, 3, 3
+    proj = torch.cat([rays_o_cross @ proj_d, proj_d], dim=-2)       # B, V, 6, 3
+
+    directions_xy = pixels @ K_inv[..., :2, :].transpose(-1, -2)    # B, V, HW, 2
+    inv_norm = torch.rsqrt(directions_xy.square().sum(dim=-1, keepdim=True) + 1.)   # B, V, HW, 1
+
+    plucker = pixels @ proj.transpose(-1, -2)                       # B, V, HW, 6
+    plucker.mul_(inv_norm)
+    plucker = plucker.reshape(B, V, H, W, 6)                        # B, V, H, W, 6
+    if flip_flag is not None and flip_flag.any():
+        # the rays of a flipped frame are the rays of the mirrored pixels, i.e. the rays mirrored along W
+        flip_flag = flip_flag.to(plucker.device)
+        if flip_flag.dim() == 1:        # the same flags for the whole batch
+            flip_flag = flip_flag[None].expand(B, V)
+        plucker[flip_flag] = plucker[flip_flag].flip(-2)
     # plucker = plucker.permute(0, 1, 4, 2, 3)
     return plucker
 
 
+def load_annotations(root_path, annotation_json, annotation_index=None):
+    # annotation_index: columnar index written by tools/build_annotation_index.py, used instead of annotation_json
+    if annotation_index is not None:
+        return AnnotationIndex(os.path.join(root_path, annotation_index))
+    if annotation_json is None:
+        return []
+    if not isinstance(annotation_json, str):
+        # the json shards written by tools/generate_realestate_json.py --shard_size
+        return [video_dict for shard in annotation_json for video_dict in load_annotations(root_path, shard)]
+    return json.load(open(os.path.join(root_path, annotation_json), 'r'))
+
+
 class RealEstate10K(Dataset):
     def __init__(
             self,
@@ -113,18 +208,38 @@ class RealEstate10K(Dataset):
             sample_n_frames=16,
             sample_size=[256, 384],
             is_image=False,
+            decode_at_sample_size=False,
+            return_uint8=False,
+            annotation_index=None,
+            quarantine=None,
+            quarantine_max_failures=3,
+            max_load_attempts=100,
+            video_reader_pool_size=0,
     ):
         self.root_path = root_path
         self.sample_stride = sample_stride
         self.sample_n_frames = sample_n_frames
         self.is_image = is_image
+        # let the decoder resize the frames to sample_size instead of decoding at the native resolution
+        self.decode_at_sample_size = decode_at_sample_size
+        # return the resized uint8 frames and the flip flag, see `batch_pixel_transforms`
+        self.return_uint8 = return_uint8
 
-        self.dataset = json.load(open(os.path.join(root_path, annotation_json), 'r'))
+        self.dataset = load_annotations(root_path, annotation_json, annotation_index)
         self.length = len(self.dataset)
+        # registry of the clips failing to load, see cameractrl/data/quarantine.py
+        self.quarantine = QuarantineRegistry(os.path.join(root_path, quarantine), quarantine_max_failures) \
+            if quarantine is not None else None
+        # clips tried by __getitem__ before giving up, e.g. when all the clips are quarantined
+        self.max_load_attempts = max_load_attempts
+        # keeps the last opened readers of every worker, see cameractrl/data/reader_pool.py
+        self.video_reader_pool = VideoReaderPool(video_reader_pool_size) if video_reader_pool_size > 0 else None
 
         sample_size = tuple(sample_size) if not isinstance(sample_size, int) else (sample_size, sample_size)
-        pixel_transforms = [transforms.Resize(sample_size),
-                            transforms.RandomHorizontalFlip(),
+        self.sample_size = sample_size
+        # the resize is applied on the uint8 frames in get_batch
+        self.resize = transforms.Resize(sample_size)
+        pixel_transforms = [transforms.RandomHorizontalFlip(),
                             transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)]
 
         self.pixel_transforms = transforms.Compose(pixel_transforms)
@@ -133,9 +248,17 @@ class RealEstate10K(Dataset):
         video_dict = self.dataset[idx]
 
         video_path = os.path.join(self.root_path, video_dict['clip_path'])
-        video_reader = VideoReader(video_path)
+        if self.decode_at_sample_size:
+            video_reader = self.open_video_reader(video_path, width=self.sample_size[1], height=self.sample_size[0])
+        else:
+            video_reader = self.open_video_reader(video_path)
         return video_reader, video_dict['caption']
 
+    def open_video_reader(self, video_path, width=-1, height=-1):
+        if self.video_reader_pool is not None:
+            return self.video_reader_pool.get(video_path, width=width, height=height)
+        return VideoReader(video_path, width=width, height=height)
+
     def get_batch(self, idx):
         video_reader, video_caption = self.load_video_reader(idx)
         total_frames = len(video_reader)
@@ -158,7 +281,10 @@ class RealEstate10K(Dataset):
             frame_indice = np.linspace(start_frame_ind, end_frame_ind - 1, self.sample_n_frames, dtype=int)
 
         pixel_values = torch.from_numpy(video_reader.get_batch(frame_indice).asnumpy()).permute(0, 3, 1, 2).contiguous()
-        pixel_values = pixel_values / 255.
+        if tuple(pixel_values.shape[-2:]) != self.sample_size:
+            pixel_values = self.resize(pixel_values)
+        if not self.return_uint8:
+            pixel_values = pixel_values / 255.
 
         if self.is_image:
             pixel_values = pixel_values[0]
@@ -168,17 +294,36 @@ class RealEstate10K(Dataset):
     def __len__(self):
         return self.length
 
+    def get_load_error_message(self):
+        message = f'No clip could be loaded in {self.max_load_attempts} attempts'
+        if self.quarantine is not None:
+            message += f', {len(self.quarantine)} of the {self.length} clips are quarantined in {self.quarantine.path}'
+        return message
+
     def __getitem__(self, idx):
-        while True:
+        for _ in range(self.max_load_attempts):
+            clip_name = self.dataset[idx]['clip_name']
+            if self.quarantine is not None and self.quarantine.is_quarantined(clip_name):
+                idx = random.randint(0, self.length - 1)
+                continue
             try:
                 video, video_caption = self.get_batch(idx)
                 break
 
             except Exception as e:
+                if self.quarantine is not None:
+                    video_path = os.path.join(self.root_path, self.dataset[idx]['clip_path'])
+                    self.quarantine.record_failure(clip_name, get_failure_reason(e, [video_path]))
                 idx = random.randint(0, self.length - 1)
+        else:
+            raise RuntimeError(self.get_load_error_message())
 
-        video = self.pixel_transforms(video)
-        sample = dict(pixel_values=video, caption=video_caption)
+        if self.return_uint8:
+            flip_flag = torch.rand(()) < 0.5
+            sample = dict(pixel_values=video, caption=video_caption, flip_flag=flip_flag)
+        else:
+            video = self.pixel_transforms(video)
+            sample = dict(pixel_values=video, caption=video_caption)
 
         return sample
 
@@ -198,6 +343,19 @@ class RealEstate10KPose(Dataset):
             shuffle_frames=False,
             use_flip=False,
             return_clip_name=False,
+            pose_store=None,
+            return_poses=False,
+            decode_at_sample_size=False,
+            return_uint8=False,
+            latent_cache=None,
+            latent_cache_dtype='float32',
+            annotation_index=None,
+            quarantine=None,
+            quarantine_max_failures=3,
+            max_load_attempts=100,
+            video_reader_pool_size=0,
+            keyframe_sampling=False,
+            keyframe_min_starts=4,
     ):
         self.root_path = root_path
         self.relative_pose = relative_pose
@@ -206,19 +364,42 @@ class RealEstate10KPose(Dataset):
         self.minimum_sample_stride = minimum_sample_stride
         self.sample_n_frames = sample_n_frames
         self.return_clip_name = return_clip_name
-
-        self.dataset = json.load(open(os.path.join(root_path, annotation_json), 'r'))
+        # return the intrinsics, c2w and flip flags instead of the plucker embedding, which is then computed
+        # for the whole batch on the training device, see `get_plucker_embedding` in train_camera_control.py
+        self.return_poses = return_poses
+        # let the decoder resize the frames to sample_size, rescale_fxy then needs the native size of
+        # the clip from the annotation (`height` and `width`, see tools/generate_realestate_json.py)
+        self.decode_at_sample_size = decode_at_sample_size
+        # return the resized uint8 frames and the flip flags, see `batch_pixel_transforms`
+        self.return_uint8 = return_uint8
+        # start the sampled windows on keyframes with the probability keyframe_sampling (True is 1), for the clips
+        # with at least keyframe_min_starts possible keyframe starts, see `sample_frame_indices`
+        self.keyframe_sampling = float(keyframe_sampling)
+        self.keyframe_min_starts = keyframe_min_starts
+
+        # annotation_json can be None when the instance only processes samples read from elsewhere,
+        # like the shards of RealEstate10KPoseShards
+        self.dataset = load_annotations(root_path, annotation_json, annotation_index)
         self.length = len(self.dataset)
+        # registry of the clips failing to load, see cameractrl/data/quarantine.py
+        self.quarantine = QuarantineRegistry(os.path.join(root_path, quarantine), quarantine_max_failures) \
+            if quarantine is not None else None
+        # clips tried by __getitem__ before giving up, e.g. when all the clips are quarantined
+        self.max_load_attempts = max_load_attempts
+        # keeps the last opened readers of every worker, see cameractrl/data/reader_pool.py
+        self.video_reader_pool = VideoReaderPool(video_reader_pool_size) if video_reader_pool_size > 0 else None
+        # packed poses written by tools/pack_realestate_poses.py, replaces parsing the txt files
+        self.pose_store = PoseStore(os.path.join(root_path, pose_store)) if pose_store is not None else None
 
         sample_size = tuple(sample_size) if not isinstance(sample_size, int) else (sample_size, sample_size)
         self.sample_size = sample_size
+        # the resize is applied on the uint8 frames in get_batch
+        self.resize = transforms.Resize(sample_size)
         if use_flip:
-            pixel_transforms = [transforms.Resize(sample_size),
-                                RandomHorizontalFlipWithPose(),
+            pixel_transforms = [RandomHorizontalFlipWithPose(inplace=True),
                                 transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)]
         else:
-            pixel_transforms = [transforms.Resize(sample_size),
-                                transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)]
+            pixel_transforms = [transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True)]
         self.rescale_fxy = rescale_fxy
         self.sample_wh_ratio = sample_size[1] / sample_size[0]
 
@@ -226,47 +407,117 @@ class RealEstate10KPose(Dataset):
         self.shuffle_frames = shuffle_frames
         self.use_flip = use_flip
 
+        # VAE latents written by tools/encode_realestate_latents.py, the samples then hold the latent
+        # mean and std of the frames instead of the pixel values
+        self.latent_cache = LatentCache(os.path.join(root_path, latent_cache)) if latent_cache is not None else None
+        if self.latent_cache is not None:
+            assert self.latent_cache.sample_size == sample_size, 'sample_size does not match the latent cache'
+            assert self.latent_cache.sample_n_frames in (None, sample_n_frames), \
+                'sample_n_frames does not match the windows of the latent cache'
+            assert not use_flip or self.latent_cache.with_flip, 'use_flip needs a latent cache with the flipped frames'
+            # a float16 cache changes the training targets, it has to be asked for with latent_cache_dtype
+            assert self.latent_cache.dtype == latent_cache_dtype, \
+                f'the latent cache is {self.latent_cache.dtype}, latent_cache_dtype is {latent_cache_dtype}'
+
     def get_relative_pose(self, cam_params):
-        abs_w2cs = [cam_param.w2c_mat for cam_param in cam_params]
-        abs_c2ws = [cam_param.c2w_mat for cam_param in cam_params]
-        source_cam_c2w = abs_c2ws[0]
-        if self.zero_t_first_frame:
-            cam_to_origin = 0
-        else:
-            cam_to_origin = np.linalg.norm(source_cam_c2w[:3, 3])
-        target_cam_c2w = np.array([
-            [1, 0, 0, 0],
-            [0, 1, 0, -cam_to_origin],
-            [0, 0, 1, 0],
-            [0, 0, 0, 1]
-        ])
-        abs2rel = target_cam_c2w @ abs_w2cs[0]
-        ret_poses = [target_cam_c2w, ] + [abs2rel @ abs_c2w for abs_c2w in abs_c2ws[1:]]
-        ret_poses = np.array(ret_poses, dtype=np.float32)
-        return ret_poses
+        return cam_params.get_relative_c2w(self.zero_t_first_frame)
+
+    def set_bucket(self, sample_size, sample_n_frames):
+        # shape of the current batch of the BucketBatchSampler (cameractrl/data/samplers.py), the frames, intrinsics
+        # and plucker embeddings of the next samples follow it
+        assert self.latent_cache is None, 'the latent cache has a fixed sample_size'
+        sample_size = tuple(sample_size)
+        if sample_size != self.sample_size:
+            self.sample_size = sample_size
+            self.sample_wh_ratio = sample_size[1] / sample_size[0]
+            self.resize = transforms.Resize(sample_size)
+        self.sample_n_frames = sample_n_frames
 
     def load_video_reader(self, idx):
         video_dict = self.dataset[idx]
 
         video_path = os.path.join(self.root_path, video_dict['clip_path'])
-        video_reader = VideoReader(video_path)
+        if self.decode_at_sample_size and (not self.rescale_fxy or 'height' in video_dict):
+            video_reader = self.open_video_reader(video_path, width=self.sample_size[1], height=self.sample_size[0])
+        else:
+            video_reader = self.open_video_reader(video_path)
         return video_dict['clip_name'], video_reader, video_dict['caption']
 
-    def load_cameras(self, idx):
+    def open_video_reader(self, video_path, width=-1, height=-1):
+        if self.video_reader_pool is not None:
+            return self.video_reader_pool.get(video_path, width=width, height=height)
+        return VideoReader(video_path, width=width, height=height)
+
+    def load_cameras(self, idx, frame_indices=None):
         video_dict = self.dataset[idx]
-        pose_file = os.path.join(self.root_path, video_dict['pose_file'])
-        with open(pose_file, 'r') as f:
-            poses = f.readlines()
-        poses = [pose.strip().split(' ') for pose in poses[1:]]
-        cam_params = [[float(x) for x in pose] for pose in poses]
-        cam_params = [Camera(cam_param) for cam_param in cam_params]
-        return cam_params
+        try:
+            if self.pose_store is not None:
+                return CameraTrajectory.from_entries(self.pose_store.get(video_dict['pose_file'], frame_indices))
+            cam_params = CameraTrajectory.from_pose_file(os.path.join(self.root_path, video_dict['pose_file']))
+        except (ValueError, IndexError) as e:
+            raise BadPoseError(f"{video_dict['pose_file']}: {e}") from e
+        return cam_params[frame_indices] if frame_indices is not None else cam_params
 
     def get_batch(self, idx):
+        if self.latent_cache is not None:
+            return self.get_latent_batch(idx)
         clip_name, video_reader, video_caption = self.load_video_reader(idx)
-        cam_params = self.load_cameras(idx)
-        assert len(cam_params) >= self.sample_n_frames
-        total_frames = len(cam_params)
+        if self.pose_store is not None:
+            # only the sampled rows are read from the store below
+            cam_params = None
+            total_frames = self.pose_store.num_frames(self.dataset[idx]['pose_file'])
+        else:
+            cam_params = self.load_cameras(idx)
+            total_frames = len(cam_params)
+        key_indices = self.get_key_indices(idx, video_reader) if self.keyframe_sampling else None
+        frame_indices = self.sample_frame_indices(total_frames, key_indices)
+        if self.shuffle_frames:
+            perm = np.random.permutation(self.sample_n_frames)
+            frame_indices = frame_indices[perm]
+
+        pixel_values = torch.from_numpy(video_reader.get_batch(frame_indices).asnumpy()).permute(0, 3, 1, 2).contiguous()
+        video_dict = self.dataset[idx]
+        ori_h, ori_w = video_dict.get('height', pixel_values.shape[-2]), video_dict.get('width', pixel_values.shape[-1])
+        if tuple(pixel_values.shape[-2:]) != self.sample_size:
+            pixel_values = self.resize(pixel_values)
+        if not self.return_uint8:
+            pixel_values = pixel_values / 255.
+
+        if cam_params is None:
+            cam_params = self.load_cameras(idx, frame_indices)
+        else:
+            cam_params = cam_params[frame_indices]
+        pose_cond, flip_flag = self.get_pose_cond(cam_params, (ori_h, ori_w))
+
+        return pixel_values, video_caption, pose_cond, flip_flag, clip_name
+
+    def get_latent_batch(self, idx):
+        video_dict = self.dataset[idx]
+        clip_name = video_dict['clip_name']
+        row_indices, frame_indices = self.latent_cache.sample_rows(clip_name, self.sample_frame_indices)
+        if self.shuffle_frames:
+            perm = np.random.permutation(self.sample_n_frames)
+            row_indices, frame_indices = row_indices[perm], frame_indices[perm]
+
+        cam_params = self.load_cameras(idx, frame_indices)
+        pose_cond, flip_flag = self.get_pose_cond(cam_params, self.latent_cache.get_native_size(clip_name))
+        # the latents of the flipped frames are cached, so flip_flag is applied here
+        latent_mean, latent_std = self.latent_cache.get(clip_name, row_indices, flip_flag.numpy())
+        latents = dict(latent_mean=torch.from_numpy(latent_mean), latent_std=torch.from_numpy(latent_std))
+
+        return latents, video_dict['caption'], pose_cond, flip_flag, clip_name
+
+    def get_key_indices(self, idx, video_reader):
+        # keyframes cached in the annotation index (tools/build_annotation_index.py), read from the reader otherwise
+        video_dict = self.dataset[idx]
+        if 'key_indices' in video_dict:
+            return np.asarray(video_dict['key_indices'])
+        return np.asarray(video_reader.get_key_indices())
+
+    def sample_frame_indices(self, total_frames, key_indices=None):
+        if total_frames < self.sample_n_frames * self.minimum_sample_stride:
+            raise ShortClipError(f'{total_frames} frames, {self.sample_n_frames} frames at a stride of at least '
+                                 f'{self.minimum_sample_stride} requested')
 
         current_sample_stride = self.sample_stride
 
@@ -275,74 +526,96 @@ class RealEstate10KPose(Dataset):
             current_sample_stride = random.randint(self.minimum_sample_stride, maximum_sample_stride)
 
         cropped_length = self.sample_n_frames * current_sample_stride
-        start_frame_ind = random.randint(0, max(0, total_frames - cropped_length - 1))
+        maximum_start_frame_ind = max(0, total_frames - cropped_length - 1)
+        # starting the window on a keyframe, the GOP of its first frame is decoded from its first frame,
+        # and the window spans the fewest GOPs for its length. With long GOPs (e.g. the keyint 250 of x264),
+        # the few keyframes would be the only starts of the clip, the start is uniform for these clips
+        key_starts = key_indices[key_indices <= maximum_start_frame_ind] if key_indices is not None else []
+        if len(key_starts) >= max(1, self.keyframe_min_starts) and random.random() < self.keyframe_sampling:
+            start_frame_ind = int(random.choice(key_starts))
+        else:
+            start_frame_ind = random.randint(0, maximum_start_frame_ind)
         end_frame_ind = min(start_frame_ind + cropped_length, total_frames)
 
         assert end_frame_ind - start_frame_ind >= self.sample_n_frames
         frame_indices = np.linspace(start_frame_ind, end_frame_ind - 1, self.sample_n_frames, dtype=int)
+        return frame_indices
 
-        if self.shuffle_frames:
-            perm = np.random.permutation(self.sample_n_frames)
-            frame_indices = frame_indices[perm]
-
-        pixel_values = torch.from_numpy(video_reader.get_batch(frame_indices).asnumpy()).permute(0, 3, 1, 2).contiguous()
-        pixel_values = pixel_values / 255.
-
-        cam_params = [cam_params[indice] for indice in frame_indices]
+    def get_pose_cond(self, cam_params, ori_size):
+        # ori_size: the native (height, width) of the clip, before resizing to sample_size
         if self.rescale_fxy:
-            ori_h, ori_w = pixel_values.shape[-2:]
-            ori_wh_ratio = ori_w / ori_h
-            if ori_wh_ratio > self.sample_wh_ratio:       # rescale fx
-                resized_ori_w = self.sample_size[0] * ori_wh_ratio
-                for cam_param in cam_params:
-                    cam_param.fx = resized_ori_w * cam_param.fx / self.sample_size[1]
-            else:                                          # rescale fy
-                resized_ori_h = self.sample_size[1] / ori_wh_ratio
-                for cam_param in cam_params:
-                    cam_param.fy = resized_ori_h * cam_param.fy / self.sample_size[0]
-        intrinsics = np.asarray([[cam_param.fx * self.sample_size[1],
-                                  cam_param.fy * self.sample_size[0],
-                                  cam_param.cx * self.sample_size[1],
-                                  cam_param.cy * self.sample_size[0]]
-                                 for cam_param in cam_params], dtype=np.float32)
-        intrinsics = torch.as_tensor(intrinsics)[None]                  # [1, n_frame, 4]
+            ori_h, ori_w = ori_size
+            cam_params = cam_params.rescale_fxy(ori_w / ori_h, self.sample_size)
+        intrinsics = torch.as_tensor(cam_params.get_intrinsics(self.sample_size))[None]     # [1, n_frame, 4]
         if self.relative_pose:
             c2w_poses = self.get_relative_pose(cam_params)
         else:
-            c2w_poses = np.array([cam_param.c2w_mat for cam_param in cam_params], dtype=np.float32)
+            c2w_poses = cam_params.c2w.astype(np.float32)
         c2w = torch.as_tensor(c2w_poses)[None]                          # [1, n_frame, 4, 4]
         if self.use_flip:
-            flip_flag = self.pixel_transforms[1].get_flip_flag(self.sample_n_frames)
+            flip_flag = self.pixel_transforms[0].get_flip_flag(self.sample_n_frames)
         else:
             flip_flag = torch.zeros(self.sample_n_frames, dtype=torch.bool, device=c2w.device)
-        plucker_embedding = ray_condition(intrinsics, c2w, self.sample_size[0], self.sample_size[1], device='cpu',
-                                          flip_flag=flip_flag)[0].permute(0, 3, 1, 2).contiguous()
-
-        return pixel_values, video_caption, plucker_embedding, flip_flag, clip_name
+        if self.return_poses:
+            pose_cond = dict(intrinsics=intrinsics[0], c2w=c2w[0], flip_flag=flip_flag)
+        else:
+            plucker_embedding = ray_condition(intrinsics, c2w, self.sample_size[0], self.sample_size[1], device='cpu',
+                                              flip_flag=flip_flag)[0].permute(0, 3, 1, 2).contiguous()
+            pose_cond = dict(plucker_embedding=plucker_embedding)
+        return pose_cond, flip_flag
 
     def __len__(self):
         return self.length
 
+    def get_load_error_message(self):
+        message = f'No clip could be loaded in {self.max_load_attempts} attempts'
+        if self.quarantine is not None:
+            message += f', {len(self.quarantine)} of the {self.length} clips are quarantined in {self.quarantine.path}'
+        return message
+
     def __getitem__(self, idx):
-        while True:
+        if isinstance(idx, tuple):
+            # (index, height, width, frames) of the BucketBatchSampler
+            idx, height, width, sample_n_frames = idx
+            self.set_bucket((height, width), sample_n_frames)
+        for _ in range(self.max_load_attempts):
+            clip_name = self.dataset[idx]['clip_name']
+            if self.quarantine is not None and self.quarantine.is_quarantined(clip_name):
+                idx = random.randint(0, self.length - 1)
+                continue
             try:
-                video, video_caption, plucker_embedding, flip_flag, clip_name = self.get_batch(idx)
+                video, video_caption, pose_cond, flip_flag, clip_name = self.get_batch(idx)
                 break
 
             except Exception as e:
+                if self.quarantine is not None:
+                    video_path = os.path.join(self.root_path, self.dataset[idx]['clip_path'])
+                    self.quarantine.record_failure(clip_name, get_failure_reason(e, [video_path]))
                 idx = random.randint(0, self.length - 1)
-
-        if self.use_flip:
-            video = self.pixel_transforms[0](video)
-            video = self.pixel_transforms[1](video, flip_flag)
-            video = self.pixel_transforms[2](video)
+        else:
+            raise RuntimeError(self.get_load_error_message())
+
+        return self.transform_sample(video, video_caption, pose_cond, flip_flag, clip_name)
+
+    def transform_sample(self, video, video_caption, pose_cond, flip_flag, clip_name):
+        if self.latent_cache is not None:
+            # video holds the latent_mean and latent_std of get_latent_batch
+            sample = dict(video, text=video_caption, **pose_cond)
+            if self.return_clip_name:
+                sample['clip_name'] = clip_name
+            return sample
+        if self.return_uint8:
+            pose_cond['flip_flag'] = flip_flag
+        elif self.use_flip:
+            video = self.pixel_transforms[0](video, flip_flag)
+            video = self.pixel_transforms[1](video)
         else:
             for transform in self.pixel_transforms:
                 video = transform(video)
         if self.return_clip_name:
-            sample = dict(pixel_values=video, text=video_caption, plucker_embedding=plucker_embedding, clip_name=clip_name)
+            sample = dict(pixel_values=video, text=video_caption, clip_name=clip_name, **pose_cond)
         else:
-            sample = dict(pixel_values=video, text=video_caption, plucker_embedding=plucker_embedding)
+            sample = dict(pixel_values=video, text=video_caption, **pose_cond)
 
         return sample
 
@@ -0,0 +1,27 @@
+import numpy as np
+
+from decord import VideoReader
+
+
+def read_key_indices(video_path):
+    # the keyframe positions come from the frame index decord builds when opening the container
+    return np.asarray(VideoReader(video_path).get_key_indices(), dtype=np.int64)
+
+
+def estimate_decoded_frames(frame_indices, key_indices):
+    """Estimates the number of frames decoded to read `frame_indices`.
+
+    The frames are read in increasing order, decoding forward from the last decoded frame while the next one is
+    in the same GOP, and from its keyframe otherwise.
+    """
+    key_indices = np.asarray(key_indices)
+    position = -1
+    num_decoded = 0
+    for frame_idx in np.unique(frame_indices):
+        key_idx = key_indices[max(np.searchsorted(key_indices, frame_idx, side='right') - 1, 0)]
+        if key_idx <= position:
+            num_decoded += frame_idx - position
+        else:
+            num_decoded += frame_idx - key_idx + 1
+        position = frame_idx
+    return int(num_decoded)
@@ -0,0 +1,106 @@
+import json
+import random
+import numpy as np
+
+
+class LatentCacheWriter(object):
+    """Writes the VAE latent distributions of the clips into `store_path`.bin and `store_path`.json (index).
+
+    Every cached frame is one `dtype` row [n_dist, C, h, w], holding the mean and std of the latent distribution,
+    followed by the mean and std of the horizontally flipped frame if `with_flip`. The dtype is float32 by default,
+    as the latents the training encodes with the float32 VAE, float16 halves the cache.
+    """
+    def __init__(self, store_path, latent_shape, sample_size, with_flip=False, sample_n_frames=None,
+                 dtype='float32'):
+        assert dtype in ('float16', 'float32')
+        self.store_path = store_path
+        self.latent_shape = tuple(latent_shape)
+        self.sample_size = tuple(sample_size)
+        self.with_flip = with_flip
+        # the frame number of the cached windows, None if all frames of the clips are cached
+        self.sample_n_frames = sample_n_frames
+        self.n_dist = 4 if with_flip else 2
+        self.dtype = dtype
+        self.clips = {}
+        self.num_rows = 0
+        self._file = open(store_path + '.bin', 'wb')
+
+    def write(self, clip_name, latents, frame_indices, height, width):
+        # latents: [n_frame, n_dist, C, h, w], frame_indices: the frame of the clip of every row
+        assert latents.shape[1:] == (self.n_dist, *self.latent_shape)
+        assert len(latents) == len(frame_indices)
+        if self.sample_n_frames is not None:
+            assert len(latents) % self.sample_n_frames == 0
+        self._file.write(np.ascontiguousarray(latents, dtype=self.dtype).tobytes())
+        self.clips[clip_name] = {'offset': self.num_rows, 'frame_indices': [int(x) for x in frame_indices],
+                                 'height': int(height), 'width': int(width)}
+        self.num_rows += len(latents)
+
+    def close(self):
+        self._file.close()
+        with open(self.store_path + '.json', 'w') as f:
+            json.dump({'latent_shape': list(self.latent_shape), 'sample_size': list(self.sample_size),
+                       'with_flip': self.with_flip, 'sample_n_frames': self.sample_n_frames, 'dtype': self.dtype,
+                       'num_rows': self.num_rows, 'clips': self.clips}, fp=f)
+        return self.num_rows
+
+
+class LatentCache(object):
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(store_path + '.json', 'r') as f:
+            index = json.load(f)
+        self.latent_shape = tuple(index['latent_shape'])
+        self.sample_size = tuple(index['sample_size'])
+        self.with_flip = index['with_flip']
+        self.sample_n_frames = index['sample_n_frames']
+        self.num_rows = index['num_rows']
+        self.clips = index['clips']
+        self.n_dist = 4 if self.with_flip else 2
+        # the caches written before the dtype was recorded are float16
+        self.dtype = index.get('dtype', 'float16')
+        self._latents = None
+
+    @property
+    def latents(self):
+        # opened lazily, so that every dataloader worker maps the file after fork
+        if self._latents is None:
+            self._latents = np.memmap(self.store_path + '.bin', dtype=self.dtype, mode='r',
+                                      shape=(self.num_rows, self.n_dist, *self.latent_shape))
+        return self._latents
+
+    def __contains__(self, clip_name):
+        return clip_name in self.clips
+
+    def get_native_size(self, clip_name):
+        clip = self.clips[clip_name]
+        return clip['height'], clip['width']
+
+    def sample_rows(self, clip_name, sample_frame_indices):
+        """Returns the rows of a frame window of the clip and the frame of the clip of every row.
+
+        A cached window is picked at random if the cache holds windows, otherwise the frames are
+        sampled from all frames of the clip by `sample_frame_indices(total_frames)`.
+        """
+        frame_indices = self.clips[clip_name]['frame_indices']
+        if self.sample_n_frames is not None:
+            window = random.randint(0, len(frame_indices) // self.sample_n_frames - 1)
+            row_indices = np.arange(window * self.sample_n_frames, (window + 1) * self.sample_n_frames)
+        else:
+            row_indices = sample_frame_indices(len(frame_indices))
+        return row_indices, np.asarray(frame_indices)[row_indices]
+
+    def get(self, clip_name, row_indices, flip_flag=None):
+        """Returns the latent mean and std [n_frame, C, h, w] of the rows, of the flipped frames where flip_flag."""
+        latents = np.array(self.latents[self.clips[clip_name]['offset'] + np.asarray(row_indices)])
+        mean, std = latents[:, 0], latents[:, 1]
+        if flip_flag is not None and flip_flag.any():
+            assert self.with_flip, 'the latents of the flipped frames are not cached'
+            flip_flag = np.asarray(flip_flag)
+            mean[flip_flag], std[flip_flag] = latents[flip_flag, 2], latents[flip_flag, 3]
+        return mean, std
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_latents'] = None
+        return state
@@ -0,0 +1,69 @@
+import os
+import json
+import numpy as np
+
+
+# one row per frame, same column layout as the RealEstate10K txt files:
+# timestamp, fx, fy, cx, cy, 0, 0, w2c (3x4, row major).
+# The timestamps are not exact in float32, they are only kept to preserve the layout.
+POSE_DIM = 19
+
+
+def read_pose_file(pose_file, dtype=np.float32):
+    with open(pose_file, 'r') as f:
+        poses = f.readlines()
+    poses = [pose.strip().split(' ') for pose in poses[1:] if pose.strip()]
+    return np.asarray([[float(x) for x in pose] for pose in poses], dtype=dtype).reshape(-1, POSE_DIM)
+
+
+def pack_pose_files(root_path, pose_files, store_path):
+    """Packs the pose txt files into `store_path`.bin (float32 [num_rows, POSE_DIM]) and `store_path`.json (index)."""
+    clips = {}
+    offset = 0
+    with open(store_path + '.bin', 'wb') as f:
+        for pose_file in pose_files:
+            poses = read_pose_file(os.path.join(root_path, pose_file))
+            f.write(poses.tobytes())
+            clips[pose_file] = [offset, len(poses)]
+            offset += len(poses)
+    with open(store_path + '.json', 'w') as f:
+        json.dump({'pose_dim': POSE_DIM, 'num_rows': offset, 'clips': clips}, fp=f)
+    return offset
+
+
+class PoseStore(object):
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(store_path + '.json', 'r') as f:
+            index = json.load(f)
+        assert index['pose_dim'] == POSE_DIM
+        self.num_rows = index['num_rows']
+        self.clips = index['clips']
+        self._poses = None
+
+    @property
+    def poses(self):
+        # opened lazily, so that every dataloader worker maps the file after fork
+        if self._poses is None:
+            self._poses = np.memmap(self.store_path + '.bin', dtype=np.float32, mode='r',
+                                    shape=(self.num_rows, POSE_DIM))
+        return self._poses
+
+    def __contains__(self, pose_file):
+        return pose_file in self.clips
+
+    def num_frames(self, pose_file):
+        return self.clips[pose_file][1]
+
+    def get(self, pose_file, frame_indices=None):
+        offset, length = self.clips[pose_file]
+        if frame_indices is None:
+            return np.array(self.poses[offset: offset + length])
+        frame_indices = np.asarray(frame_indices)
+        assert frame_indices.max() < length
+        return np.array(self.poses[offset + frame_indices])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_poses'] = None
+        return state
@@ -0,0 +1,120 @@
+import queue
+import threading
+import time
+import torch
+
+
+def transfer_to_device(data, device, non_blocking=True):
+    if isinstance(data, torch.Tensor):
+        if data.device.type == 'cpu' and torch.device(device).type == 'cuda' and not data.is_pinned():
+            data = data.pin_memory()
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, dict):
+        return {k: transfer_to_device(v, device, non_blocking) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(transfer_to_device(v, device, non_blocking) for v in data)
+    return data
+
+
+def record_stream(data, stream):
+    # the tensors copied on the prefetch stream are used on `stream`, keeps the allocator from reusing them early
+    if isinstance(data, torch.Tensor):
+        if data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, dict):
+        for v in data.values():
+            record_stream(v, stream)
+    elif isinstance(data, (list, tuple)):
+        for v in data:
+            record_stream(v, stream)
+
+
+class BatchPrefetcher(object):
+    """Iterates the dataloader in a background thread, `num_batches` batches ahead of the training loop.
+
+    Each batch goes through `process_fn` (e.g. the null-text dropout and the tokenization of the captions),
+    then its tensors are pinned and copied to `device` on a separate CUDA stream, so that the training loop
+    gets batches already on the device. The time the loop waits for a batch is accumulated as the stall time.
+    """
+    _END = object()
+
+    def __init__(self, dataloader, device, num_batches=2, process_fn=None):
+        assert num_batches >= 1
+        self.device = torch.device(device)
+        self.num_batches = num_batches
+        self.process_fn = process_fn
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.stop_event = threading.Event()
+        self.stall_time = 0.
+        self.num_fetched = 0
+        self.thread = threading.Thread(target=self._worker, args=(iter(dataloader),), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _prepare(self, batch):
+        if self.process_fn is not None:
+            batch = self.process_fn(batch)
+        if self.stream is None:
+            return transfer_to_device(batch, self.device), None
+        with torch.cuda.stream(self.stream):
+            batch = transfer_to_device(batch, self.device)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def _worker(self, data_iter):
+        if self.device.type == 'cuda':
+            torch.cuda.set_device(self.device)
+        try:
+            for batch in data_iter:
+                if not self._put(self._prepare(batch)):
+                    return
+        except Exception as e:
+            # raised again in the training loop
+            self._put(e)
+            return
+        self._put(self._END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        item = self.queue.get()
+        self.stall_time += time.time() - start
+        if item is self._END:
+            self._put(self._END)
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        batch, event = item
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            record_stream(batch, current_stream)
+        self.num_fetched += 1
+        return batch
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def get_log_message(self):
+        # the stall time is averaged over the batches fetched since the previous message
+        msg = f"Prefetch queue: {self.qsize()}/{self.num_batches}, " \
+              f"stall time: {self.stall_time / max(self.num_fetched, 1) * 1000: .1f} ms/batch"
+        self.stall_time = 0.
+        self.num_fetched = 0
+        return msg
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
@@ -0,0 +1,116 @@
+import os
+import time
+import fcntl
+
+from collections import Counter
+
+
+# reason codes of the clip failures
+MISSING_FILE = 'missing_file'
+BAD_POSE = 'bad_pose'
+SHORT_CLIP = 'short_clip'
+DECODE_ERROR = 'decode_error'
+OTHER = 'other'
+# failures that happen again on every load, the clip is quarantined on the first one
+PERMANENT_REASONS = (BAD_POSE, SHORT_CLIP)
+
+
+class ShortClipError(ValueError):
+    # the clip has too few frames for sample_n_frames at the minimum sample stride
+    pass
+
+
+class BadPoseError(ValueError):
+    # the pose file of the clip cannot be parsed
+    pass
+
+
+def get_failure_reason(exception, paths=()):
+    # decord raises the same RuntimeError for missing and corrupt videos, so the paths of the clip are checked
+    if isinstance(exception, FileNotFoundError) or not all(os.path.exists(path) for path in paths):
+        return MISSING_FILE
+    # only the errors raised on purpose are permanent, the other exceptions (e.g. an IndexError of a transform)
+    # count toward max_failures
+    if isinstance(exception, ShortClipError):
+        return SHORT_CLIP
+    if isinstance(exception, BadPoseError):
+        return BAD_POSE
+    if type(exception).__name__ == 'DECORDError' or isinstance(exception, RuntimeError):
+        return DECODE_ERROR
+    return OTHER
+
+
+class QuarantineRegistry(object):
+    """File-backed registry of the clips that failed to load, shared by all dataloader workers and ranks.
+
+    Every failure is appended as a `clip_name<TAB>reason` line to the registry file under an exclusive
+    lock, and a clip is quarantined once it failed `max_failures` times, so that a transient I/O or decoding
+    error does not drop it. The permanent failures (`PERMANENT_REASONS`, or recorded with `permanent=True`,
+    written with a third `permanent` column) quarantine the clip at once. Each process reads the lines
+    appended by the others every `refresh_interval` seconds.
+    """
+    def __init__(self, path, max_failures=3, refresh_interval=30.):
+        self.path = path
+        self.max_failures = max_failures
+        self.refresh_interval = refresh_interval
+        self.failures = Counter()
+        self.failure_reasons = Counter()
+        self.quarantined = {}
+        self._offset = 0
+        self._last_refresh = 0.
+        self.refresh()
+
+    def _add(self, clip_name, reason, permanent=False):
+        self.failures[clip_name] += 1
+        self.failure_reasons[reason] += 1
+        if (permanent or self.failures[clip_name] >= self.max_failures) and clip_name not in self.quarantined:
+            self.quarantined[clip_name] = reason
+
+    def refresh(self):
+        self._last_refresh = time.time()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        # a line may still be incomplete if another process is writing it
+        data = data[:data.rfind(b'\n') + 1]
+        self._offset += len(data)
+        for line in data.decode('utf-8').splitlines():
+            clip_name, reason, *flags = line.split('\t')
+            self._add(clip_name, reason, 'permanent' in flags)
+
+    def is_quarantined(self, clip_name):
+        if time.time() - self._last_refresh > self.refresh_interval:
+            self.refresh()
+        return clip_name in self.quarantined
+
+    def record_failure(self, clip_name, reason, permanent=False):
+        permanent = permanent or reason in PERMANENT_REASONS
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(f'{clip_name}\t{reason}\tpermanent\n' if permanent else f'{clip_name}\t{reason}\n')
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+        # the own failures are counted when the registry file is read again
+        self.refresh()
+
+    def summary(self):
+        self.refresh()
+        quarantined_reasons = Counter(self.quarantined.values())
+        return {
+            'num_failures': sum(self.failure_reasons.values()),
+            'num_quarantined': len(self.quarantined),
+            'quarantined_reasons': dict(quarantined_reasons),
+        }
+
+    def __len__(self):
+        return len(self.quarantined)
+
+    def get_log_message(self, num_samples, num_failures_offset=0):
+        # num_samples: samples drawn by all ranks since the training started, num_failures_offset: the
+        # number of failures in the registry when it started, like those of tools/validate_realestate_clips.py
+        summary = self.summary()
+        num_failures = summary['num_failures'] - num_failures_offset
+        return f"Bad clips: {num_failures} failures ({num_failures / max(num_samples, 1): .2%} of the samples), " \
+               f"{summary['num_quarantined']} quarantined {summary['quarantined_reasons']}"
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+from decord import VideoReader
+
+
+class VideoReaderPool(object):
+    """LRU pool of open VideoReaders, one pool per dataloader worker.
+
+    Reopening a clip parses its container and rebuilds its frame index, the pool keeps the last
+    `max_readers` readers open instead. Each reader holds a file descriptor and its decoder state,
+    so `max_readers` bounds both.
+    """
+    def __init__(self, max_readers=8):
+        self.max_readers = max_readers
+        self.readers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, video_path, width=-1, height=-1):
+        key = (video_path, width, height)
+        if key in self.readers:
+            self.readers.move_to_end(key)
+            self.hits += 1
+            return self.readers[key]
+        self.misses += 1
+        video_reader = VideoReader(video_path, width=width, height=height)
+        self.readers[key] = video_reader
+        if len(self.readers) > self.max_readers:
+            self.readers.popitem(last=False)
+        return video_reader
+
+    def clear(self):
+        self.readers.clear()
+
+    def __len__(self):
+        return len(self.readers)
+
+    def __getstate__(self):
+        # the readers can not be pickled, e.g. when the workers are spawned
+        state = self.__dict__.copy()
+        state['readers'] = OrderedDict()
+        return state
@@ -0,0 +1,129 @@
+import os
+import random
+import warnings
+import numpy as np
+import torch.distributed as dist
+
+from torch.utils.data import Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+
+def get_source_video_ids(annotations):
+    # clips are stored as video_clips/<video_id>/<clip_name>.mp4, returns the int id of the source video of every clip
+    video_dirs = [os.path.dirname(video_dict['clip_path']) for video_dict in annotations]
+    return np.unique(video_dirs, return_inverse=True)[1]
+
+
+class LocalityAwareSampler(DistributedSampler):
+    """DistributedSampler that draws the clips of the same source video consecutively.
+
+    The shuffled indices of the rank are split into windows of `window_size` indices, and the indices
+    of every window are grouped by source video, in a random order of the videos. The clips of a video are
+    separate files stored in the same folder (video_clips/<video_id>), reading them close in time only helps
+    the page cache and the directory caches of the storage. It does not help the VideoReaderPool, which
+    is keyed by clip file, and only the indices of the same batch go to the same dataloader worker.
+    """
+    def __init__(self, dataset, window_size=256, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.window_size = window_size
+        self.video_ids = get_source_video_ids(dataset.dataset)
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        rng = random.Random(self.seed + self.epoch)
+        grouped_indices = []
+        for start in range(0, len(indices), self.window_size):
+            window = indices[start: start + self.window_size]
+            video_order = {video_id: rng.random() for video_id in set(self.video_ids[window].tolist())}
+            grouped_indices += sorted(window, key=lambda idx: video_order[self.video_ids[idx]])
+        return iter(grouped_indices)
+
+
+def assign_buckets(annotations, buckets, default_wh_ratio):
+    """Returns the index of the (height, width, frames) bucket of every clip.
+
+    A clip goes to the bucket closest to its aspect ratio (`height` and `width` of the annotation, see
+    tools/generate_realestate_json.py), with the most frames among those its `num_frames` can provide.
+    """
+    bucket_ratios = np.log([width / height for height, width, _ in buckets])
+    bucket_frames = np.asarray([num_frames for _, _, num_frames in buckets])
+    bucket_ids = np.zeros(len(annotations), dtype=np.int64)
+    for idx, video_dict in enumerate(annotations):
+        wh_ratio = video_dict['width'] / video_dict['height'] if 'height' in video_dict else default_wh_ratio
+        fits = bucket_frames <= video_dict.get('num_frames', bucket_frames.max())
+        if not fits.any():
+            fits = bucket_frames == bucket_frames.min()
+        ratio_distance = np.where(fits, np.abs(bucket_ratios - np.log(wh_ratio)).round(6), np.inf)
+        candidates = np.flatnonzero(ratio_distance == ratio_distance.min())
+        bucket_ids[idx] = candidates[np.argmax(bucket_frames[candidates])]
+    return bucket_ids
+
+
+class BucketBatchSampler(Sampler):
+    """Distributed batch sampler of RealEstate10KPose with one (height, width, frames) shape per batch.
+
+    The clips are grouped by bucket (see `assign_buckets`), split into batches within their bucket, and
+    the shuffled batches are dealt to the ranks. The batches hold (index, height, width, frames) tuples,
+    and the dataset resizes and samples every clip to the shape of its batch.
+    """
+    def __init__(self, dataset, buckets, batch_size, num_replicas=None, rank=None, shuffle=True, seed=0,
+                 drop_last=True):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.buckets = [tuple(int(x) for x in bucket) for bucket in buckets]
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.bucket_ids = assign_buckets(dataset.dataset, self.buckets, dataset.sample_wh_ratio)
+        self.check_bucket_sizes()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_bucket_sizes(self):
+        return np.bincount(self.bucket_ids, minlength=len(self.buckets))
+
+    def check_bucket_sizes(self):
+        # a bucket no clip fits, e.g. a mistake in the config, would silently change the mix of shapes
+        bucket_sizes = self.get_bucket_sizes()
+        if len(self) == 0:
+            raise ValueError(f'No batch of {self.batch_size} clips per rank in the buckets {self.buckets}, '
+                             f'of {bucket_sizes.tolist()} clips')
+        min_size = self.batch_size * self.num_replicas if self.drop_last else 1
+        for bucket, bucket_size in zip(self.buckets, bucket_sizes):
+            if bucket_size < min_size:
+                warnings.warn(f'The bucket (height, width, frames) {bucket} has {bucket_size} clips, fewer than a '
+                              f'batch of {self.batch_size} clips per rank, the buckets have {bucket_sizes.tolist()} '
+                              f'clips')
+
+    def __len__(self):
+        bucket_sizes = self.get_bucket_sizes()
+        if self.drop_last:
+            num_batches = (bucket_sizes // self.batch_size).sum()
+        else:
+            num_batches = (-(-bucket_sizes // self.batch_size)).sum()
+        return int(num_batches) // self.num_replicas
+
+    def __iter__(self):
+        # the same batches are drawn on every rank, each takes every `num_replicas`-th of them
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for bucket_idx, bucket in enumerate(self.buckets):
+            indices = np.flatnonzero(self.bucket_ids == bucket_idx)
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start: start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append([(int(idx), *bucket) for idx in batch])
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        num_batches = len(batches) // self.num_replicas
+        return iter(batches[self.rank: num_batches * self.num_replicas: self.num_replicas])
@@ -0,0 +1,186 @@
+import os
+import json
+import random
+import torch
+import torch.distributed as dist
+import numpy as np
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+from cameractrl.data.pose_store import POSE_DIM
+from cameractrl.data.dataset import CameraTrajectory, RealEstate10KPose
+
+
+# Each shard is a pair of files:
+#   `<shard>.bin`: fixed-size records, uint8 frames [F, H, W, 3] followed by float32 pose rows [F, POSE_DIM]
+#   `<shard>.json`: clip_name, caption and native height / width of every record
+# and the shard index `<name>.json` lists the shards with the frame number and size of the records.
+
+def get_record_size(sample_n_frames, sample_size):
+    frame_bytes = sample_n_frames * sample_size[0] * sample_size[1] * 3
+    return frame_bytes, frame_bytes + sample_n_frames * POSE_DIM * 4
+
+
+class ShardWriter(object):
+    def __init__(self, root_path, name, sample_n_frames, sample_size, records_per_shard=256):
+        self.root_path = root_path
+        self.name = name
+        self.sample_n_frames = sample_n_frames
+        self.sample_size = tuple(sample_size)
+        self.records_per_shard = records_per_shard
+        self.shards = []
+        self._file = None
+        self._metas = []
+        os.makedirs(os.path.dirname(os.path.join(root_path, name)), exist_ok=True)
+
+    def _flush(self):
+        if self._file is None:
+            return
+        self._file.close()
+        with open(os.path.join(self.root_path, self.shards[-1]['path'] + '.json'), 'w') as f:
+            json.dump(self._metas, fp=f)
+        self.shards[-1]['num_records'] = len(self._metas)
+        self._file = None
+        self._metas = []
+
+    def write(self, frames, poses, clip_name, caption, height, width):
+        assert frames.shape == (self.sample_n_frames, *self.sample_size, 3) and frames.dtype == np.uint8
+        assert poses.shape == (self.sample_n_frames, POSE_DIM)
+        if self._file is None:
+            shard_path = f'{self.name}-{len(self.shards):05d}'
+            self.shards.append({'path': shard_path, 'num_records': 0})
+            self._file = open(os.path.join(self.root_path, shard_path + '.bin'), 'wb')
+        self._file.write(np.ascontiguousarray(frames).tobytes())
+        self._file.write(np.ascontiguousarray(poses, dtype=np.float32).tobytes())
+        self._metas.append({'clip_name': clip_name, 'caption': caption, 'height': int(height), 'width': int(width)})
+        if len(self._metas) == self.records_per_shard:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        with open(os.path.join(self.root_path, self.name + '.json'), 'w') as f:
+            json.dump({'sample_n_frames': self.sample_n_frames, 'sample_size': list(self.sample_size),
+                       'pose_dim': POSE_DIM, 'shards': self.shards}, fp=f)
+        return sum(shard['num_records'] for shard in self.shards)
+
+
+class RealEstate10KPoseShards(IterableDataset):
+    """Streams the shards written by tools/pack_realestate_shards.py, returns the same samples as RealEstate10KPose.
+
+    The shards are split between all the (rank, dataloader worker) pairs, each of them reads its shards
+    sequentially and shuffles the records with a buffer of `shuffle_buffer` samples. The stream wraps around
+    its shards, the length of an epoch is given by `__len__`.
+    """
+    def __init__(
+            self,
+            root_path,
+            shard_index,
+            shuffle=True,
+            shuffle_buffer=16,
+            seed=0,
+            rank=None,
+            world_size=None,
+            sample_n_frames=None,
+            sample_size=None,
+            **kwargs,
+    ):
+        self.root_path = root_path
+        with open(os.path.join(root_path, shard_index), 'r') as f:
+            index = json.load(f)
+        assert index['pose_dim'] == POSE_DIM
+        self.sample_n_frames = index['sample_n_frames']
+        self.sample_size = tuple(index['sample_size'])
+        if sample_n_frames is not None:
+            assert sample_n_frames == self.sample_n_frames, 'sample_n_frames does not match the shards'
+        if sample_size is not None:
+            sample_size = tuple(sample_size) if not isinstance(sample_size, int) else (sample_size, sample_size)
+            assert sample_size == self.sample_size, 'sample_size does not match the shards'
+        self.shards = index['shards']
+        self.num_records = sum(shard['num_records'] for shard in self.shards)
+        self.frame_bytes, self.record_size = get_record_size(self.sample_n_frames, self.sample_size)
+
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if world_size is None:
+            world_size = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+        # only used for the pose conditions and the pixel transforms of the samples
+        kwargs.pop('annotation_json', None)
+        kwargs.pop('annotation_index', None)
+        self.processor = RealEstate10KPose(root_path, None, sample_n_frames=self.sample_n_frames,
+                                           sample_size=self.sample_size, **kwargs)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_records // self.world_size
+
+    def get_assigned_shards(self, slot, num_slots, n_pass):
+        # returns (shard index, first record, record step) of the shards read by a (rank, worker) slot
+        shard_order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch * 1000 + n_pass).shuffle(shard_order)
+        num_shards = len(shard_order)
+        if num_shards >= num_slots:
+            return [(shard_order[i], 0, 1) for i in range(slot, num_shards, num_slots)]
+        # fewer shards than slots, the slots sharing a shard read every `step`-th record of it
+        shard_slot = slot % num_shards
+        step = len(range(shard_slot, num_slots, num_shards))
+        return [(shard_order[shard_slot], slot // num_shards, step)]
+
+    def read_shard(self, shard_idx, start, step):
+        shard_path = os.path.join(self.root_path, self.shards[shard_idx]['path'])
+        with open(shard_path + '.json', 'r') as f:
+            metas = json.load(f)
+        with open(shard_path + '.bin', 'rb') as f:
+            for record_idx in range(start, len(metas), step):
+                if step > 1:
+                    f.seek(record_idx * self.record_size)
+                data = f.read(self.record_size)
+                frames = np.frombuffer(data, dtype=np.uint8, count=self.frame_bytes)
+                frames = frames.reshape(self.sample_n_frames, *self.sample_size, 3)
+                poses = np.frombuffer(data, dtype=np.float32, offset=self.frame_bytes)
+                poses = poses.reshape(self.sample_n_frames, POSE_DIM)
+                yield frames, poses, metas[record_idx]
+
+    def get_sample(self, frames, poses, meta):
+        processor = self.processor
+        if processor.shuffle_frames:
+            frame_indices = np.random.permutation(self.sample_n_frames)
+        else:
+            frame_indices = np.arange(self.sample_n_frames)
+        pixel_values = torch.from_numpy(frames[frame_indices]).permute(0, 3, 1, 2).contiguous()
+        if not processor.return_uint8:
+            pixel_values = pixel_values / 255.
+        cam_params = CameraTrajectory.from_entries(poses[frame_indices])
+        pose_cond, flip_flag = processor.get_pose_cond(cam_params, (meta['height'], meta['width']))
+        return processor.transform_sample(pixel_values, meta['caption'], pose_cond, flip_flag, meta['clip_name'])
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        slot = self.rank * num_workers + worker_id
+        num_slots = self.world_size * num_workers
+        rng = random.Random(self.seed + self.epoch * num_slots + slot)
+
+        buffer = []
+        n_pass = 0
+        while True:
+            for shard_idx, start, step in self.get_assigned_shards(slot, num_slots, n_pass):
+                for record in self.read_shard(shard_idx, start, step):
+                    if not self.shuffle:
+                        yield self.get_sample(*record)
+                        continue
+                    buffer.append(record)
+                    if len(buffer) >= self.shuffle_buffer:
+                        buffer_idx = rng.randrange(len(buffer))
+                        buffer[buffer_idx], buffer[-1] = buffer[-1], buffer[buffer_idx]
+                        yield self.get_sample(*buffer.pop())
+            n_pass += 1
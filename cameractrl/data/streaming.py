@@ -0,0 +1,144 @@
+import os
+import random
+import torch
+import torch.distributed as dist
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+from cameractrl.data.dataset import RealEstate10KPose
+from cameractrl.data.quarantine import get_failure_reason
+
+
+class RealEstate10KPoseStream(IterableDataset):
+    """Streams the samples of RealEstate10KPose over contiguous shards of its annotations.
+
+    The annotations are split into shards of about `shard_size` consecutive clips, and the shards are split
+    evenly between all the (rank, dataloader worker) pairs, so that every pair only reads its part of the
+    annotations and of the storage (with an `annotation_index`, the other rows are never paged in). Each pair
+    reads the clips of its shards in order and shuffles them with a buffer of `shuffle_buffer` clips. The
+    stream wraps around its shards, the length of an epoch is given by `__len__`.
+
+    Every sample holds the `stream_cursor` [slot, pass, shard, offset] of its pair: the stream has read the
+    first `offset` clips of `shard`. Passing the last cursors of all the pairs to `set_cursors` resumes the
+    epoch from there, the clips left in the shuffle buffers are skipped.
+    """
+    def __init__(
+            self,
+            root_path,
+            shard_size=1024,
+            shuffle=True,
+            shuffle_buffer=64,
+            seed=0,
+            rank=None,
+            world_size=None,
+            **kwargs,
+    ):
+        self.dataset = RealEstate10KPose(root_path, **kwargs)
+        self.shard_size = shard_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if world_size is None:
+            world_size = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.quarantine = self.dataset.quarantine
+        self.cursors = {}
+        self.cursor_epoch = None
+        self.cursor_num_slots = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_cursors(self, cursors, epoch, num_slots):
+        # cursors: {slot: [pass, shard, offset]}, only used if the epoch and the number of (rank, worker) pairs match
+        self.cursors = {int(slot): cursor for slot, cursor in cursors.items()}
+        self.cursor_epoch = epoch
+        self.cursor_num_slots = num_slots
+
+    def __len__(self):
+        return len(self.dataset) // self.world_size
+
+    def get_shards(self, num_slots):
+        # contiguous [start, end) rows of the annotations, of about shard_size rows. The number of shards is a
+        # multiple of num_slots and their sizes differ by at most one row, so that every slot reads the same
+        # number of shards and its pass wraps around after the same number of clips as the others, within
+        # the number of shards per slot
+        num_rows = len(self.dataset)
+        assert num_rows >= num_slots, 'fewer clips than (rank, worker) pairs'
+        num_shards = -(-num_rows // self.shard_size)
+        num_shards = min(-(-num_shards // num_slots) * num_slots, num_rows // num_slots * num_slots)
+        bounds = [num_rows * shard_idx // num_shards for shard_idx in range(num_shards + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def get_assigned_shards(self, slot, num_slots, num_shards, n_pass):
+        shard_order = list(range(num_shards))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch * 1000 + n_pass).shuffle(shard_order)
+        return shard_order[slot::num_slots]
+
+    def get_sample(self, idx):
+        # same as RealEstate10KPose.__getitem__, except that a failing clip is skipped instead of replaced
+        dataset = self.dataset
+        clip_name = dataset.dataset[idx]['clip_name']
+        if dataset.quarantine is not None and dataset.quarantine.is_quarantined(clip_name):
+            return None
+        try:
+            video, video_caption, pose_cond, flip_flag, clip_name = dataset.get_batch(idx)
+        except Exception as e:
+            if dataset.quarantine is not None:
+                video_path = os.path.join(dataset.root_path, dataset.dataset[idx]['clip_path'])
+                dataset.quarantine.record_failure(clip_name, get_failure_reason(e, [video_path]))
+            return None
+        return dataset.transform_sample(video, video_caption, pose_cond, flip_flag, clip_name)
+
+    def iter_indices(self, slot, num_slots):
+        # yields (clip index, cursor after reading it) of the slot, from its cursor if it resumes
+        shards = self.get_shards(num_slots)
+        cursor = None
+        if self.cursor_epoch == self.epoch and self.cursor_num_slots == num_slots:
+            cursor = self.cursors.get(slot, None)
+        n_pass = cursor[0] if cursor is not None else 0
+        while True:
+            assigned_shards = self.get_assigned_shards(slot, num_slots, len(shards), n_pass)
+            first_shard, first_offset = 0, 0
+            if cursor is not None:
+                first_shard, first_offset = assigned_shards.index(cursor[1]), cursor[2]
+                cursor = None
+            for shard_idx in assigned_shards[first_shard:]:
+                start, end = shards[shard_idx]
+                for idx in range(start + first_offset, end):
+                    yield idx, [slot, n_pass, shard_idx, idx - start + 1]
+                first_offset = 0
+            n_pass += 1
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        slot = self.rank * num_workers + worker_id
+        num_slots = self.world_size * num_workers
+        rng = random.Random(self.seed + self.epoch * num_slots + slot)
+
+        buffer = []
+        num_failed = 0
+        for idx, cursor in self.iter_indices(slot, num_slots):
+            if self.shuffle:
+                buffer.append(idx)
+                if len(buffer) < self.shuffle_buffer:
+                    continue
+                buffer_idx = rng.randrange(len(buffer))
+                buffer[buffer_idx], buffer[-1] = buffer[-1], buffer[buffer_idx]
+                idx = buffer.pop()
+            sample = self.get_sample(idx)
+            if sample is None:
+                # the stream never ends, it stops when its clips keep failing, e.g. all of them are quarantined
+                num_failed += 1
+                if num_failed >= self.dataset.max_load_attempts:
+                    raise RuntimeError(self.dataset.get_load_error_message())
+                continue
+            num_failed = 0
+            sample['stream_cursor'] = torch.tensor(cursor)
+            yield sample
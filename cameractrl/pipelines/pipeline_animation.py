@@ -113,6 +113,8 @@ class AnimationPipeline(DiffusionPipeline, LoraLoaderMixin):
             scheduler=scheduler,
         )
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        # optional TextEmbeddingCache (cameractrl/utils/text_embedding_cache.py) used by _encode_prompt
+        self.text_embedding_cache = None
 
     def enable_vae_slicing(self):
         self.vae.enable_slicing()
@@ -147,6 +149,9 @@ class AnimationPipeline(DiffusionPipeline, LoraLoaderMixin):
         return self.device
 
     def _encode_prompt(self, prompt, device, num_videos_per_prompt, do_classifier_free_guidance, negative_prompt):
+        if self.text_embedding_cache is not None:
+            return self._encode_prompt_with_cache(prompt, device, num_videos_per_prompt, do_classifier_free_guidance,
+                                                  negative_prompt)
         batch_size = len(prompt) if isinstance(prompt, list) else 1
 
         text_inputs = self.tokenizer(
@@ -235,6 +240,36 @@ class AnimationPipeline(DiffusionPipeline, LoraLoaderMixin):
 
         return text_embeddings
 
+    def _encode_prompt_with_cache(self, prompt, device, num_videos_per_prompt, do_classifier_free_guidance,
+                                  negative_prompt):
+        batch_size = len(prompt) if isinstance(prompt, list) else 1
+        text_embeddings = self.text_embedding_cache.encode(prompt, device)
+        text_embeddings = text_embeddings.repeat_interleave(num_videos_per_prompt, dim=0)
+
+        if do_classifier_free_guidance:
+            if negative_prompt is None:
+                uncond_tokens = [""] * batch_size
+            elif type(prompt) is not type(negative_prompt):
+                raise TypeError(
+                    f"`negative_prompt` should be the same type to `prompt`, but got {type(negative_prompt)} !="
+                    f" {type(prompt)}."
+                )
+            elif isinstance(negative_prompt, str):
+                uncond_tokens = [negative_prompt]
+            elif batch_size != len(negative_prompt):
+                raise ValueError(
+                    f"`negative_prompt`: {negative_prompt} has batch size {len(negative_prompt)}, but `prompt`:"
+                    f" {prompt} has batch size {batch_size}. Please make sure that passed `negative_prompt` matches"
+                    " the batch size of `prompt`."
+                )
+            else:
+                uncond_tokens = negative_prompt
+            uncond_embeddings = self.text_embedding_cache.encode(uncond_tokens, device)
+            uncond_embeddings = uncond_embeddings.repeat_interleave(num_videos_per_prompt, dim=0)
+            text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+
+        return text_embeddings
+
     def decode_latents(self, latents):
         video_length = latents.shape[2]
         latents = 1 / 0.18215 * latents
@@ -478,6 +513,9 @@ class CameraCtrlPipeline(AnimationPipeline):
         return video
 
     def _encode_prompt(self, prompt, device, num_videos_per_prompt, do_classifier_free_guidance, negative_prompt):
+        if self.text_embedding_cache is not None:
+            return self._encode_prompt_with_cache(prompt, device, num_videos_per_prompt, do_classifier_free_guidance,
+                                                  negative_prompt)
         batch_size = len(prompt) if isinstance(prompt, list) else 1
 
         text_inputs = self.tokenizer(
@@ -0,0 +1,169 @@
+import os
+import socket
+import sqlite3
+import time
+
+from contextlib import contextmanager
+
+
+# status of the videos and clips of the manifest
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def finish_clip(manifest, clip_name, status, **kwargs):
+    # the tools run with or without a manifest
+    if manifest is not None:
+        manifest.finish_clip(clip_name, status, **kwargs)
+
+
+class ClipJobManifest(object):
+    """SQLite manifest of the clip extraction jobs, shared by all the tool instances through the storage.
+
+    The instances claim the pending videos one at a time, so that the work is balanced whatever the number of
+    clips per video, and record the status, attempts, duration and output size of every clip. Every finished
+    clip renews the lease of its video, and a video is claimed again if its worker does not renew it within
+    `lease_timeout` seconds (e.g. the worker died), or if some of its clips failed, up to `max_attempts` times.
+    The videos whose last lease expired are marked failed. The database relies on the file locks of the
+    storage, like the QuarantineRegistry.
+    """
+    def __init__(self, path, max_attempts=3, lease_timeout=6 * 3600.):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_timeout = lease_timeout
+        self._connection = None
+        with self.transaction() as cursor:
+            cursor.execute('CREATE TABLE IF NOT EXISTS videos (video_name TEXT PRIMARY KEY, status TEXT, '
+                           'worker TEXT, claimed_at REAL, attempts INTEGER, duration REAL)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS clips (clip_name TEXT PRIMARY KEY, video_name TEXT, '
+                           'status TEXT, attempts INTEGER, duration REAL, output_size INTEGER, error TEXT, '
+                           'num_frames INTEGER)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS clips_video ON clips (video_name)')
+            # the manifests created before the encoded frame numbers were recorded
+            if 'num_frames' not in [row[1] for row in cursor.execute('PRAGMA table_info(clips)').fetchall()]:
+                cursor.execute('ALTER TABLE clips ADD COLUMN num_frames INTEGER')
+
+    @property
+    def connection(self):
+        # opened lazily, so that every worker process has its own connection
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=600., isolation_level=None)
+        return self._connection
+
+    @contextmanager
+    def transaction(self):
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+
+    def add_videos(self, video2clips):
+        # the videos and clips already in the manifest keep their status
+        with self.transaction() as cursor:
+            cursor.executemany('INSERT OR IGNORE INTO videos VALUES (?, ?, NULL, NULL, 0, NULL)',
+                               [(video_name, PENDING) for video_name in video2clips])
+            cursor.executemany('INSERT OR IGNORE INTO clips (clip_name, video_name, status, attempts) VALUES (?, ?, ?, 0)',
+                               [(clip_name, video_name, PENDING)
+                                for video_name, clip_list in video2clips.items() for clip_name in clip_list])
+
+    def _expire(self, cursor, now):
+        # the running videos whose lease expired at their last attempt are not claimed again
+        cursor.execute('UPDATE videos SET status = ? WHERE status = ? AND claimed_at < ? AND attempts >= ?',
+                       (FAILED, RUNNING, now - self.lease_timeout, self.max_attempts))
+
+    def claim(self, worker=None):
+        """Returns the name of the next video to process, or None when no video is left."""
+        worker = worker if worker is not None else get_worker_name()
+        now = time.time()
+        with self.transaction() as cursor:
+            self._expire(cursor, now)
+            row = cursor.execute(
+                'SELECT video_name FROM videos WHERE attempts < ? AND '
+                '(status = ? OR (status = ? AND claimed_at < ?)) ORDER BY attempts, rowid LIMIT 1',
+                (self.max_attempts, PENDING, RUNNING, now - self.lease_timeout)).fetchone()
+            if row is None:
+                return None
+            cursor.execute('UPDATE videos SET status = ?, worker = ?, claimed_at = ?, attempts = attempts + 1 '
+                           'WHERE video_name = ?', (RUNNING, worker, now, row[0]))
+        return row[0]
+
+    def iter_claims(self, worker=None):
+        while True:
+            video_name = self.claim(worker)
+            if video_name is None:
+                return
+            yield video_name
+
+    def renew(self, video_name, worker=None):
+        """Extends the lease of a claimed video, returns False if the worker does not hold it anymore."""
+        worker = worker if worker is not None else get_worker_name()
+        with self.transaction() as cursor:
+            return self._renew(cursor, video_name, worker)
+
+    def _renew(self, cursor, video_name, worker):
+        cursor.execute('UPDATE videos SET claimed_at = ? WHERE video_name = ? AND status = ? AND worker = ?',
+                       (time.time(), video_name, RUNNING, worker))
+        return cursor.rowcount > 0
+
+    def get_pending_clips(self, video_name):
+        rows = self.connection.execute('SELECT clip_name FROM clips WHERE video_name = ? AND status NOT IN (?, ?) '
+                                       'ORDER BY rowid', (video_name, DONE, SKIPPED)).fetchall()
+        return [row[0] for row in rows]
+
+    def finish_clip(self, clip_name, status, duration=None, output_file=None, error=None, num_frames=None):
+        # num_frames: frames the encoder received, checked by tools/verify_realestate_clips.py. Also the
+        # heartbeat of the video of the clip, see renew
+        output_size = os.path.getsize(output_file) if output_file is not None and os.path.exists(output_file) else None
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE clips SET status = ?, attempts = attempts + 1, duration = ?, output_size = ?, '
+                           'error = ?, num_frames = COALESCE(?, num_frames) WHERE clip_name = ?',
+                           (status, duration, output_size, error, num_frames, clip_name))
+            video_name = cursor.execute('SELECT video_name FROM clips WHERE clip_name = ?', (clip_name,)).fetchone()
+            if video_name is not None:
+                self._renew(cursor, video_name[0], get_worker_name())
+
+    def finish_video(self, video_name, duration=None):
+        # the video is done once none of its clips failed, it is claimed again otherwise
+        with self.transaction() as cursor:
+            num_failed = cursor.execute('SELECT COUNT(*) FROM clips WHERE video_name = ? AND status = ?',
+                                        (video_name, FAILED)).fetchone()[0]
+            attempts = cursor.execute('SELECT attempts FROM videos WHERE video_name = ?',
+                                      (video_name,)).fetchone()[0]
+            if num_failed == 0:
+                status = DONE
+            else:
+                status = PENDING if attempts < self.max_attempts else FAILED
+            cursor.execute('UPDATE videos SET status = ?, duration = ? WHERE video_name = ?',
+                           (status, duration, video_name))
+        return status
+
+    def get_clips(self):
+        # clip name -> video name, status, error and encoded frame number of every clip
+        rows = self.connection.execute('SELECT clip_name, video_name, status, error, num_frames FROM clips').fetchall()
+        return {row[0]: {'video_name': row[1], 'status': row[2], 'error': row[3], 'num_frames': row[4]}
+                for row in rows}
+
+    def summary(self):
+        with self.transaction() as cursor:
+            self._expire(cursor, time.time())
+        videos = dict(self.connection.execute('SELECT status, COUNT(*) FROM videos GROUP BY status').fetchall())
+        clips = dict(self.connection.execute('SELECT status, COUNT(*) FROM clips GROUP BY status').fetchall())
+        output_size = self.connection.execute('SELECT SUM(output_size) FROM clips WHERE status = ?',
+                                              (DONE,)).fetchone()[0]
+        return {'videos': videos, 'clips': clips, 'output_size': output_size or 0}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
@@ -0,0 +1,138 @@
+import json
+import hashlib
+import torch
+import numpy as np
+
+from collections import OrderedDict
+
+
+def get_prompt_key(prompt):
+    return hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+
+
+def tokenize_prompts(tokenizer, prompts):
+    return dict(tokenizer(
+        prompts,
+        padding="max_length",
+        max_length=tokenizer.model_max_length,
+        truncation=True,
+        return_tensors="pt",
+    ))
+
+
+@torch.no_grad()
+def encode_prompts(tokenizer, text_encoder, prompts, text_inputs=None):
+    # text_inputs: the output of tokenize_prompts for the prompts, e.g. tokenized ahead by the BatchPrefetcher
+    if text_inputs is None:
+        text_inputs = tokenize_prompts(tokenizer, prompts)
+    if hasattr(text_encoder.config, "use_attention_mask") and text_encoder.config.use_attention_mask:
+        attention_mask = text_inputs['attention_mask'].to(text_encoder.device)
+    else:
+        attention_mask = None
+    return text_encoder(text_inputs['input_ids'].to(text_encoder.device), attention_mask=attention_mask)[0]
+
+
+def write_text_embedding_store(store_path, prompts, tokenizer, text_encoder, batch_size=64, dtype=None):
+    """Encodes the prompts into `store_path`.bin ([num_prompts, seq_len, hidden_size]) and `store_path`.json (index).
+
+    dtype: 'float32' or 'float16', the dtype of the text encoder by default (float32 unless it runs in float16),
+    so that the stored embeddings are the ones the text encoder returns.
+    """
+    if dtype is None:
+        dtype = 'float16' if text_encoder.dtype == torch.float16 else 'float32'
+    prompts = list(dict.fromkeys(prompts))
+    keys = {}
+    with open(store_path + '.bin', 'wb') as f:
+        for start in range(0, len(prompts), batch_size):
+            batch_prompts = prompts[start: start + batch_size]
+            embeddings = encode_prompts(tokenizer, text_encoder, batch_prompts)
+            f.write(embeddings.float().cpu().numpy().astype(dtype).tobytes())
+            for prompt in batch_prompts:
+                keys[get_prompt_key(prompt)] = len(keys)
+    with open(store_path + '.json', 'w') as f:
+        json.dump({'seq_len': tokenizer.model_max_length, 'hidden_size': text_encoder.config.hidden_size,
+                   'dtype': dtype, 'keys': keys}, fp=f)
+    return len(keys)
+
+
+class TextEmbeddingCache(object):
+    """Text embeddings of the frozen text encoder, keyed by the sha1 of the prompt.
+
+    The embeddings are looked up in an in-memory LRU of `max_items` entries, then in the store written by
+    `write_text_embedding_store` (tools/precompute_text_embeddings.py), and only encoded on a miss of both.
+    The store is read-only, the prompts encoded at runtime are only kept in the LRU.
+    """
+    def __init__(self, tokenizer, text_encoder, store_path=None, max_items=256):
+        self.tokenizer = tokenizer
+        self.text_encoder = text_encoder
+        self.max_items = max_items
+        self.lru = OrderedDict()
+        self.store_path = store_path
+        self.store_keys = {}
+        self._store = None
+        if store_path is not None:
+            with open(store_path + '.json', 'r') as f:
+                index = json.load(f)
+            assert index['seq_len'] == tokenizer.model_max_length
+            assert index['hidden_size'] == text_encoder.config.hidden_size
+            self.store_keys = index['keys']
+            self.store_dtype = index['dtype']
+            self.store_shape = (len(self.store_keys), index['seq_len'], index['hidden_size'])
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = np.memmap(self.store_path + '.bin', dtype=self.store_dtype, mode='r', shape=self.store_shape)
+        return self._store
+
+    def _put(self, key, embedding):
+        self.lru[key] = embedding
+        if len(self.lru) > self.max_items:
+            self.lru.popitem(last=False)
+
+    def _get(self, key):
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            return self.lru[key]
+        if key in self.store_keys:
+            embedding = torch.from_numpy(np.array(self.store[self.store_keys[key]]))
+            embedding = embedding.to(self.text_encoder.device, self.text_encoder.dtype)
+            self._put(key, embedding)
+            return embedding
+        return None
+
+    @torch.no_grad()
+    def encode(self, prompts, device=None, text_inputs=None):
+        """Returns the text embeddings [len(prompts), seq_len, hidden_size] of the prompts.
+
+        text_inputs: optional output of `tokenize_prompts` for the prompts, used to encode the missing ones.
+        """
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        keys = [get_prompt_key(prompt) for prompt in prompts]
+        embeddings = {}
+        missing = {}
+        for idx, (prompt, key) in enumerate(zip(prompts, keys)):
+            if key in embeddings or key in missing:
+                continue
+            embedding = self._get(key)
+            if embedding is None:
+                missing[key] = (idx, prompt)
+            else:
+                embeddings[key] = embedding
+        if len(missing) > 0:
+            missing_indices = [idx for idx, _ in missing.values()]
+            missing_inputs = {k: v[missing_indices] for k, v in text_inputs.items()} if text_inputs is not None else None
+            missing_embeddings = encode_prompts(self.tokenizer, self.text_encoder,
+                                                [prompt for _, prompt in missing.values()], missing_inputs)
+            for key, embedding in zip(missing, missing_embeddings):
+                # a copy, a view would keep the embeddings of the whole batch alive in the LRU
+                embedding = embedding.clone()
+                embeddings[key] = embedding
+                self._put(key, embedding)
+        text_embeddings = torch.stack([embeddings[key] for key in keys])
+        return text_embeddings.to(device) if device is not None else text_embeddings
+
+    def __contains__(self, prompt):
+        key = get_prompt_key(prompt)
+        return key in self.lru or key in self.store_keys
@@ -0,0 +1,192 @@
+import os
+import subprocess
+import threading
+import time
+import imageio
+import imageio_ffmpeg
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+class StreamingVideoWriter(object):
+    """Encodes frames into `save_file` as they are appended, through the stdin pipe of an ffmpeg process.
+
+    The video is written under a temporary name and only renamed to `save_file` by `close`, so that an
+    interrupted or aborted video is never taken for a finished one. `num_frames` counts the frames encoded.
+    """
+    def __init__(self, save_file, fps, **writer_kwargs):
+        self.save_file = save_file
+        root, ext = os.path.splitext(save_file)
+        self.tmp_file = root + '.tmp' + ext
+        self.writer = imageio.get_writer(self.tmp_file, fps=fps, **writer_kwargs)
+        self.num_frames = 0
+
+    def append(self, frame):
+        self.writer.append_data(frame)
+        self.num_frames += 1
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.tmp_file, self.save_file)
+        return self.num_frames
+
+    def abort(self):
+        try:
+            self.writer.close()
+        finally:
+            if os.path.exists(self.tmp_file):
+                os.remove(self.tmp_file)
+
+
+class FFmpegPipeWriter(object):
+    """Encodes frames into `save_file` by writing them as raw video to the stdin of an ffmpeg process.
+
+    Same interface as StreamingVideoWriter. ffmpeg runs with `threads` encoding threads (0 lets it pick one
+    per core), only the last `log_lines` lines of its stderr are kept for the error messages, and it is killed
+    if it blocks a frame write or the end of the video for more than `timeout` seconds. The time spent
+    producing the frames, e.g. decoding the images, does not count. The process is started with the first
+    frame, which gives the size of the video.
+    """
+    def __init__(self, save_file, fps, codec='libx264', output_params=(), threads=0, timeout=600., log_lines=50):
+        self.save_file = save_file
+        root, ext = os.path.splitext(save_file)
+        self.tmp_file = root + '.tmp' + ext
+        self.fps = fps
+        self.codec = codec
+        self.output_params = list(output_params)
+        self.threads = threads
+        self.timeout = timeout
+        self.log = deque(maxlen=log_lines)
+        self.process = None
+        self.log_thread = None
+        self.watchdog = None
+        self.finished = threading.Event()
+        # start time of the current write to ffmpeg, or of the wait for its end, None in between
+        self.busy_since = None
+        self.timed_out = False
+        self.num_frames = 0
+
+    def _start(self, height, width):
+        cmd = [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'warning',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', f'{self.fps:.6f}', '-i', '-',
+               '-an', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', self.codec, '-pix_fmt', 'yuv420p',
+               '-threads', str(self.threads)] + self.output_params + [self.tmp_file]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE)
+        self.log_thread = threading.Thread(target=self._read_log, args=(self.process.stderr,), daemon=True)
+        self.log_thread.start()
+        self.watchdog = threading.Thread(target=self._watch, daemon=True)
+        self.watchdog.start()
+
+    def _read_log(self, stderr):
+        for line in stderr:
+            self.log.append(line.decode(errors='replace').rstrip())
+
+    def _watch(self):
+        while not self.finished.wait(min(self.timeout, 1.)):
+            busy_since = self.busy_since
+            if busy_since is not None and time.monotonic() - busy_since > self.timeout:
+                self.timed_out = True
+                self.process.kill()
+                return
+
+    def _error(self, message):
+        if self.timed_out:
+            message = f'ffmpeg timed out after {self.timeout}s'
+        self.log_thread.join(1.)
+        return RuntimeError(f'{message} while encoding {self.save_file}:\n' + '\n'.join(self.log))
+
+    def append(self, frame):
+        if frame.ndim == 2:
+            frame = np.stack([frame] * 3, axis=-1)
+        frame = np.ascontiguousarray(frame[..., :3], dtype=np.uint8)
+        if self.process is None:
+            self._start(*frame.shape[:2])
+        self.busy_since = time.monotonic()
+        try:
+            self.process.stdin.write(frame.tobytes())
+        except (BrokenPipeError, OSError):
+            raise self._error('ffmpeg exited')
+        finally:
+            self.busy_since = None
+        self.num_frames += 1
+
+    def _wait(self):
+        # the watchdog kills ffmpeg if flushing the last frames or finishing the file takes too long
+        self.busy_since = time.monotonic()
+        try:
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+            returncode = self.process.wait()
+        finally:
+            self.busy_since = None
+            self.finished.set()
+        return returncode
+
+    def close(self):
+        if self.process is None:
+            raise RuntimeError(f'no frame was written to {self.save_file}')
+        try:
+            if self._wait() != 0:
+                raise self._error('ffmpeg failed')
+        except BaseException:
+            self.abort()
+            raise
+        os.replace(self.tmp_file, self.save_file)
+        return self.num_frames
+
+    def abort(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+        self.finished.set()
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+
+
+def get_thread_budget(num_workers, threads=0):
+    # encoding threads per worker, so that the workers together do not use more threads than the cores
+    if threads > 0:
+        return threads
+    return max(1, (os.cpu_count() or 1) // max(1, num_workers))
+
+
+def iter_frame_files(frame_files, num_threads=4, read_ahead=16):
+    # decodes the images on `num_threads` threads, at most `read_ahead` of them ahead of the consumer
+    frame_files = iter(frame_files)
+    with ThreadPoolExecutor(num_threads) as executor:
+        pending = deque(executor.submit(imageio.imread, frame_file) for frame_file in islice(frame_files, read_ahead))
+        while len(pending) > 0:
+            frame = pending.popleft().result()
+            frame_file = next(frame_files, None)
+            if frame_file is not None:
+                pending.append(executor.submit(imageio.imread, frame_file))
+            yield frame
+
+
+def encode_frame_files(frame_files, save_file, fps, num_threads=4, read_ahead=16, writer_cls=StreamingVideoWriter,
+                       **writer_kwargs):
+    """Encodes the image files into the video `save_file`, returns the number of frames encoded.
+
+    The images are decoded on a small thread pool while the previous ones are encoded, so that only
+    `read_ahead` decoded frames are held in memory, whatever the length of the clip. `writer_cls` is
+    StreamingVideoWriter or FFmpegPipeWriter, it is given `writer_kwargs`.
+    """
+    writer = writer_cls(save_file, fps, **writer_kwargs)
+    try:
+        for frame in iter_frame_files(frame_files, num_threads, read_ahead):
+            writer.append(frame)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
@@ -2,10 +2,8 @@ import argparse
 import json
 import os
 
-import numpy as np
 import torch
 from tqdm import tqdm
-from packaging import version as pver
 from einops import rearrange
 from safetensors import safe_open
 
@@ -23,7 +21,8 @@ from cameractrl.models.unet import UNet3DConditionModelPoseCond
 from cameractrl.models.pose_adaptor import CameraPoseEncoder
 from cameractrl.pipelines.pipeline_animation import CameraCtrlPipeline
 from cameractrl.utils.convert_from_ckpt import convert_ldm_unet_checkpoint
-from cameractrl.data.dataset import Camera
+from cameractrl.data.dataset import CameraTrajectory, ray_condition
+from cameractrl.utils.text_embedding_cache import TextEmbeddingCache
 
 
 def setup_for_distributed(is_master):
@@ -41,64 +40,6 @@ def setup_for_distributed(is_master):
     __builtin__.print = print
 
 
-def custom_meshgrid(*args):
-    # ref: https://pytorch.org/docs/stable/generated/torch.meshgrid.html?highlight=meshgrid#torch.meshgrid
-    if pver.parse(torch.__version__) < pver.parse('1.10'):
-        return torch.meshgrid(*args)
-    else:
-        return torch.meshgrid(*args, indexing='ij')
-
-
-def get_relative_pose(cam_params):
-    abs_w2cs = [cam_param.w2c_mat for cam_param in cam_params]
-    abs_c2ws = [cam_param.c2w_mat for cam_param in cam_params]
-    cam_to_origin = 0
-    target_cam_c2w = np.array([
-        [1, 0, 0, 0],
-        [0, 1, 0, -cam_to_origin],
-        [0, 0, 1, 0],
-        [0, 0, 0, 1]
-    ])
-    abs2rel = target_cam_c2w @ abs_w2cs[0]
-    ret_poses = [target_cam_c2w, ] + [abs2rel @ abs_c2w for abs_c2w in abs_c2ws[1:]]
-    ret_poses = np.array(ret_poses, dtype=np.float32)
-    return ret_poses
-
-
-def ray_condition(K, c2w, H, W, device):
-    # c2w: B, V, 4, 4
-    # K: B, V, 4
-
-    B = K.shape[0]
-
-    j, i = custom_meshgrid(
-        torch.linspace(0, H - 1, H, device=device, dtype=c2w.dtype),
-        torch.linspace(0, W - 1, W, device=device, dtype=c2w.dtype),
-    )
-    i = i.reshape([1, 1, H * W]).expand([B, 1, H * W]) + 0.5  # [B, HxW]
-    j = j.reshape([1, 1, H * W]).expand([B, 1, H * W]) + 0.5  # [B, HxW]
-
-    fx, fy, cx, cy = K.chunk(4, dim=-1)  # B,V, 1
-
-    zs = torch.ones_like(i)  # [B, HxW]
-    xs = (i - cx) / fx * zs
-    ys = (j - cy) / fy * zs
-    zs = zs.expand_as(ys)
-
-    directions = torch.stack((xs, ys, zs), dim=-1)  # B, V, HW, 3
-    directions = directions / directions.norm(dim=-1, keepdim=True)  # B, V, HW, 3
-
-    rays_d = directions @ c2w[..., :3, :3].transpose(-1, -2)  # B, V, 3, HW
-    rays_o = c2w[..., :3, 3]  # B, V, 3
-    rays_o = rays_o[:, :, None].expand_as(rays_d)  # B, V, 3, HW
-    # c2w @ dirctions
-    rays_dxo = torch.cross(rays_o, rays_d)
-    plucker = torch.cat([rays_dxo, rays_d], dim=-1)
-    plucker = plucker.reshape(B, c2w.shape[1], H, W, 6)  # B, V, H, W, 6
-    # plucker = plucker.permute(0, 1, 4, 2, 3)
-    return plucker
-
-
 def load_personalized_base_model(pipeline, personalized_base_model):
     print(f'Load civitai base model from {personalized_base_model}')
     if personalized_base_model.endswith(".safetensors"):
@@ -201,33 +142,19 @@ def main(args):
                             unet_additional_kwargs, args.motion_module_ckpt, pose_encoder_kwargs, attention_processor_kwargs,
                             noise_scheduler_kwargs, args.pose_adaptor_ckpt,
                             args.personalized_base_model, f"cuda:{gpu_id}")
+    # the prompts and negative prompts repeat across the captions, their embeddings are cached
+    pipeline.text_embedding_cache = TextEmbeddingCache(pipeline.tokenizer, pipeline.text_encoder,
+                                                       store_path=args.text_embedding_store)
     device = torch.device(f"cuda:{gpu_id}")
     print('Done')
     print('Loading K, R, t matrix')
-    with open(args.trajectory_file, 'r') as f:
-        poses = f.readlines()
-    poses = [pose.strip().split(' ') for pose in poses[1:]]
-
-    cam_params = [[float(x) for x in pose] for pose in poses]
-    cam_params = [Camera(cam_param) for cam_param in cam_params]
-    sample_wh_ratio = args.image_width / args.image_height
-    pose_wh_ratio = args.original_pose_width / args.original_pose_height
-    if pose_wh_ratio > sample_wh_ratio:
-        resized_ori_w = args.image_height * pose_wh_ratio
-        for cam_param in cam_params:
-            cam_param.fx = resized_ori_w * cam_param.fx / args.image_width
-    else:
-        resized_ori_h = args.image_width / pose_wh_ratio
-        for cam_param in cam_params:
-            cam_param.fy = resized_ori_h * cam_param.fy / args.image_height
-    intrinsic = np.asarray([[cam_param.fx * args.image_width,
-                             cam_param.fy * args.image_height,
-                             cam_param.cx * args.image_width,
-                             cam_param.cy * args.image_height]
-                            for cam_param in cam_params], dtype=np.float32)
+    sample_size = (args.image_height, args.image_width)
+    cam_params = CameraTrajectory.from_pose_file(args.trajectory_file)
+    cam_params = cam_params.rescale_fxy(args.original_pose_width / args.original_pose_height, sample_size)
+    intrinsic = cam_params.get_intrinsics(sample_size)
 
     K = torch.as_tensor(intrinsic)[None]  # [1, 1, 4]
-    c2ws = get_relative_pose(cam_params)
+    c2ws = cam_params.get_relative_c2w(zero_t_first_frame=True)
     c2ws = torch.as_tensor(c2ws)[None]  # [1, n_frame, 4, 4]
     plucker_embedding = ray_condition(K, c2ws, args.image_height, args.image_width, device='cpu')[0].permute(0, 3, 1, 2).contiguous()  # V, 6, H, W
     plucker_embedding = plucker_embedding[None].to(device)  # B V 6 H W
@@ -304,6 +231,9 @@ if __name__ == '__main__':
     parser.add_argument("--original_pose_width", type=int, default=1280, help='the width of the video used to extract camera trajectory')
     parser.add_argument("--original_pose_height", type=int, default=720, help='the height of the video used to extract camera trajectory')
     parser.add_argument("--n_procs", type=int, default=8)
+    parser.add_argument("--text_embedding_store", default=None,
+                        help='text embeddings written by tools/precompute_text_embeddings.py, '
+                             'must be computed with the text encoder of the personalized base model if it is used')
 
     # DDP args
     parser.add_argument("--world_size", default=1, type=int,
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from cameractrl.data.streaming import RealEstate10KPoseStream
+
+
+class IndexStream(RealEstate10KPoseStream):
+    # returns the clip index instead of loading the clip
+    def get_sample(self, idx):
+        return {'idx': idx}
+
+
+def make_stream(tmp_path, num_clips, **kwargs):
+    with open(tmp_path / 'train.json', 'w') as f:
+        json.dump([{'clip_name': f'clip{idx}'} for idx in range(num_clips)], f)
+    return IndexStream(str(tmp_path), annotation_json='train.json', **kwargs)
+
+
+@pytest.mark.parametrize('num_clips, shard_size, num_slots', [(103, 8, 4), (100, 1024, 3), (10, 1, 4)])
+def test_shards_are_balanced(tmp_path, num_clips, shard_size, num_slots):
+    stream = make_stream(tmp_path, num_clips, shard_size=shard_size)
+    shards = stream.get_shards(num_slots)
+    assert shards[0][0] == 0 and shards[-1][1] == num_clips
+    assert all(end == start for (_, end), (start, _) in zip(shards[:-1], shards[1:]))
+    assert len(shards) % num_slots == 0
+    sizes = [end - start for start, end in shards]
+    assert max(sizes) - min(sizes) <= 1
+
+    rows = []
+    for slot in range(num_slots):
+        assigned = stream.get_assigned_shards(slot, num_slots, len(shards), 0)
+        assert len(assigned) == len(shards) // num_slots
+        rows.append(sum(sizes[shard_idx] for shard_idx in assigned))
+    assert max(rows) - min(rows) <= len(shards) // num_slots
+    assert sum(rows) == num_clips
+
+
+def test_slots_are_disjoint(tmp_path):
+    num_slots = 4
+    stream = make_stream(tmp_path, 103, shard_size=8)
+    seen = []
+    for slot in range(num_slots):
+        indices = stream.iter_indices(slot, num_slots)
+        seen += [next(indices)[0] for _ in range(len(stream.dataset) // num_slots)]
+    assert len(set(seen)) == len(seen)
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_cursor_resume(tmp_path, shuffle):
+    # with a shuffle buffer of one clip, the resumed stream continues exactly where the cursor was taken
+    num_slots, num_read, num_resumed = 3, 50, 40
+    stream = make_stream(tmp_path, 64, shard_size=5, shuffle=shuffle, shuffle_buffer=1, seed=3)
+    stream.set_epoch(2)
+    expected, cursors = {}, {}
+    for slot in range(num_slots):
+        indices = stream.iter_indices(slot, num_slots)
+        read = [next(indices) for _ in range(num_read + num_resumed)]
+        cursors[slot] = read[num_read - 1][1][1:]
+        expected[slot] = [idx for idx, _ in read[num_read:]]
+
+    # the cursors go through a checkpoint, e.g. torch.save of train_camera_control.py
+    checkpoint = json.loads(json.dumps({'cursors': cursors, 'epoch': 2, 'num_slots': num_slots}))
+    resumed = make_stream(tmp_path, 64, shard_size=5, shuffle=shuffle, shuffle_buffer=1, seed=3)
+    resumed.set_epoch(2)
+    resumed.set_cursors(checkpoint['cursors'], checkpoint['epoch'], checkpoint['num_slots'])
+    for slot in range(num_slots):
+        indices = resumed.iter_indices(slot, num_slots)
+        assert [next(indices)[0] for _ in range(num_resumed)] == expected[slot]
+
+    # the samples of __iter__ (a single worker, slot 0) carry the same cursors
+    stream = make_stream(tmp_path, 64, shard_size=5, shuffle=shuffle, shuffle_buffer=1, seed=3,
+                         rank=0, world_size=num_slots)
+    stream.set_epoch(2)
+    samples = iter(stream)
+    read = [next(samples) for _ in range(num_read + num_resumed)]
+    resumed.rank, resumed.world_size = 0, num_slots
+    resumed.set_cursors({0: read[num_read - 1]['stream_cursor'][1:].tolist()}, 2, num_slots)
+    samples = iter(resumed)
+    assert [next(samples)['idx'] for _ in range(num_resumed)] == [sample['idx'] for sample in read[num_read:]]
+
+
+def test_cursors_of_another_layout_are_ignored(tmp_path):
+    stream = make_stream(tmp_path, 64, shard_size=5, shuffle=False)
+    stream.set_cursors({0: [0, 3, 2]}, epoch=0, num_slots=2)
+    assert next(stream.iter_indices(0, 4))[0] == next(make_stream(tmp_path, 64, shard_size=5,
+                                                                   shuffle=False).iter_indices(0, 4))[0]
@@ -0,0 +1,133 @@
+import argparse
+import os.path as osp
+import sys
+import time
+import torch
+
+from collections import defaultdict
+from torch.utils.data import DataLoader
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.data.dataset import RealEstate10KPose
+
+
+# per-sample stages timed in the dataloader workers: pose_cond is the pose processing and the plucker embedding,
+# normalize the flip and normalization of the frames, `other` the rest of __getitem__ (sampling, retries, ...)
+STAGES = ('pose_parse', 'video_open', 'decode', 'resize', 'pose_cond', 'normalize')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Measures the throughput of RealEstate10KPose through a DataLoader, '
+                                                 'e.g. on a dataset made by tools/make_synthetic_realestate.py')
+    parser.add_argument('--root_path', required=True)
+    parser.add_argument('--annotation_json', default='annotations/train.json')
+    parser.add_argument('--annotation_index', default=None)
+    parser.add_argument('--pose_store', default=None)
+    parser.add_argument('--sample_stride', type=int, default=8)
+    parser.add_argument('--sample_n_frames', type=int, default=16)
+    parser.add_argument('--sample_size', type=int, nargs=2, default=[256, 384])
+    parser.add_argument('--rescale_fxy', action='store_true')
+    parser.add_argument('--relative_pose', action='store_true')
+    parser.add_argument('--use_flip', action='store_true')
+    parser.add_argument('--return_poses', action='store_true')
+    parser.add_argument('--decode_at_sample_size', action='store_true')
+    parser.add_argument('--return_uint8', action='store_true')
+    parser.add_argument('--keyframe_sampling', type=float, default=0.,
+                        help='probability of starting the windows on keyframes')
+    parser.add_argument('--video_reader_pool_size', type=int, default=0)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 4],
+                        help='one run per number of workers')
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--warmup_batches', type=int, default=5)
+    return parser.parse_args()
+
+
+def timed(fn, timings, stage):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[stage] += time.perf_counter() - start
+    return wrapper
+
+
+class TimedVideoReader(object):
+    def __init__(self, video_reader, timings):
+        self.video_reader = video_reader
+        self.get_batch = timed(video_reader.get_batch, timings, 'decode')
+
+    def __len__(self):
+        return len(self.video_reader)
+
+    def __getattr__(self, name):
+        return getattr(self.video_reader, name)
+
+
+class TimedRealEstate10KPose(RealEstate10KPose):
+    """RealEstate10KPose returning the seconds spent in every stage of the sample under `stage_times`."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = defaultdict(float)
+        self.load_cameras = timed(self.load_cameras, self.timings, 'pose_parse')
+        self.resize = timed(self.resize, self.timings, 'resize')
+        self.get_pose_cond = timed(self.get_pose_cond, self.timings, 'pose_cond')
+        self.transform_sample = timed(self.transform_sample, self.timings, 'normalize')
+
+    def open_video_reader(self, video_path, width=-1, height=-1):
+        start = time.perf_counter()
+        video_reader = super().open_video_reader(video_path, width=width, height=height)
+        self.timings['video_open'] += time.perf_counter() - start
+        return TimedVideoReader(video_reader, self.timings)
+
+    def __getitem__(self, idx):
+        self.timings.clear()
+        start = time.perf_counter()
+        sample = super().__getitem__(idx)
+        total = time.perf_counter() - start
+        sample['stage_times'] = torch.tensor([self.timings[stage] for stage in STAGES] + [total], dtype=torch.float64)
+        return sample
+
+
+def run(dataset, batch_size, num_workers, num_batches, warmup_batches):
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, drop_last=True)
+    stage_times = torch.zeros(len(STAGES) + 1, dtype=torch.float64)
+    num_samples = 0
+    data_iter = iter(dataloader)
+    for step in range(warmup_batches + num_batches):
+        if step == warmup_batches:
+            start = time.perf_counter()
+        try:
+            batch = next(data_iter)
+        except StopIteration:
+            data_iter = iter(dataloader)
+            batch = next(data_iter)
+        if step >= warmup_batches:
+            stage_times += batch['stage_times'].sum(0)
+            num_samples += batch['stage_times'].shape[0]
+    elapsed = time.perf_counter() - start
+    return num_samples / elapsed, stage_times / num_samples
+
+
+if __name__ == '__main__':
+    args = get_args()
+    start = time.perf_counter()
+    dataset = TimedRealEstate10KPose(
+        args.root_path, args.annotation_json if args.annotation_index is None else None,
+        sample_stride=args.sample_stride, sample_n_frames=args.sample_n_frames, sample_size=args.sample_size,
+        relative_pose=args.relative_pose, rescale_fxy=args.rescale_fxy, use_flip=args.use_flip,
+        pose_store=args.pose_store, return_poses=args.return_poses, decode_at_sample_size=args.decode_at_sample_size,
+        return_uint8=args.return_uint8, annotation_index=args.annotation_index,
+        video_reader_pool_size=args.video_reader_pool_size, keyframe_sampling=args.keyframe_sampling)
+    print(f'Loaded {len(dataset)} annotations in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    header = f'{"workers":>8} {"samples/s":>10} ' + ' '.join(f'{stage:>10}' for stage in STAGES + ('other', 'total'))
+    print('Per-sample time of the stages in ms, measured in the workers')
+    print(header)
+    for num_workers in args.num_workers:
+        samples_per_second, stage_times = run(dataset, args.batch_size, num_workers, args.num_batches,
+                                              args.warmup_batches)
+        stage_ms = (stage_times * 1000).tolist()
+        stage_ms = stage_ms[:-1] + [stage_ms[-1] - sum(stage_ms[:-1]), stage_ms[-1]]
+        print(f'{num_workers:>8} {samples_per_second:>10.1f} ' + ' '.join(f'{x:>10.2f}' for x in stage_ms))
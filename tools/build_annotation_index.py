@@ -0,0 +1,87 @@
+import argparse
+import os.path as osp
+import sys
+import numpy as np
+
+from multiprocessing import Pool
+from tqdm import tqdm
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.data.annotation_index import build_annotation_index
+from cameractrl.data.dataset import RealEstate10KPose, load_annotations
+from cameractrl.data.keyframes import read_key_indices, estimate_decoded_frames
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_path', required=True, help='root path of the RealEstate10K dataset')
+    parser.add_argument('--annotation_json', required=True, nargs='+',
+                        help='json file generated by generate_realestate_json.py, or all its shards')
+    parser.add_argument('--save_name', default=None,
+                        help='the index is saved to root_path/save_name.bin and root_path/save_name.json, '
+                             'defaults to the annotation json name with an _index suffix')
+    parser.add_argument('--count_frames', action='store_true',
+                        help='store the frame number of every clip, counted from its pose file')
+    parser.add_argument('--record_key_indices', action='store_true',
+                        help='store the keyframe positions of every clip, used by the keyframe_sampling of '
+                             'RealEstate10KPose, and report the decoding saved by it')
+    parser.add_argument('--sample_stride', type=int, default=8, help='only used for the decoding report')
+    parser.add_argument('--sample_n_frames', type=int, default=16, help='only used for the decoding report')
+    parser.add_argument('--num_workers', type=int, default=8)
+    return parser.parse_args()
+
+
+def count_pose_frames(pose_file):
+    with open(pose_file, 'r') as f:
+        return sum(1 for line in f.readlines()[1:] if line.strip())
+
+
+def read_key_indices_worker(video_path):
+    try:
+        return read_key_indices(video_path).tolist()
+    except Exception:
+        return None
+
+
+def report_keyframe_sampling(annotations, sample_stride, sample_n_frames, num_draws=8):
+    # estimated number of decoded frames per sample of the uniform and the keyframe-aligned window starts
+    sampler = RealEstate10KPose('', None, sample_stride=sample_stride, sample_n_frames=sample_n_frames,
+                                keyframe_sampling=True)
+    num_uniform, num_aligned, num_requested = 0, 0, 0
+    for video_dict in annotations:
+        total_frames = video_dict.get('num_frames', None)
+        if total_frames is None or total_frames < sample_n_frames or len(video_dict.get('key_indices', [])) == 0:
+            continue
+        key_indices = np.asarray(video_dict['key_indices'])
+        for _ in range(num_draws):
+            num_uniform += estimate_decoded_frames(sampler.sample_frame_indices(total_frames), key_indices)
+            num_aligned += estimate_decoded_frames(sampler.sample_frame_indices(total_frames, key_indices), key_indices)
+            num_requested += sample_n_frames
+    if num_requested == 0:
+        print('No clip with a frame number and keyframes to report, add --count_frames')
+        return
+    num_samples = num_requested // sample_n_frames
+    print(f'Decoded frames per sample of {sample_n_frames} frames: uniform {num_uniform / num_samples:.1f}, '
+          f'keyframe-aligned {num_aligned / num_samples:.1f} '
+          f'({1 - num_aligned / max(num_uniform, 1):.1%} fewer)')
+
+
+if __name__ == '__main__':
+    args = get_args()
+    annotations = load_annotations(args.root_path, args.annotation_json)
+    if args.count_frames:
+        for video_dict in tqdm(annotations):
+            if 'num_frames' not in video_dict:
+                video_dict['num_frames'] = count_pose_frames(osp.join(args.root_path, video_dict['pose_file']))
+    if args.record_key_indices:
+        video_paths = [osp.join(args.root_path, video_dict['clip_path']) for video_dict in annotations]
+        with Pool(args.num_workers) as pool:
+            key_indices = list(tqdm(pool.imap(read_key_indices_worker, video_paths, chunksize=16), total=len(video_paths)))
+        for video_dict, clip_key_indices in zip(annotations, key_indices):
+            # the clips which can not be opened get no keyframes and are sampled uniformly
+            video_dict['key_indices'] = clip_key_indices if clip_key_indices is not None else []
+        report_keyframe_sampling(annotations, args.sample_stride, args.sample_n_frames)
+    save_name = args.save_name if args.save_name is not None else osp.splitext(args.annotation_json[0])[0] + '_index'
+    store_path = osp.join(args.root_path, save_name)
+    num_rows = build_annotation_index(annotations, store_path)
+    print(f'Saved {num_rows} annotations to {store_path}.bin, index saved to {store_path}.json')
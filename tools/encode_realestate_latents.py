@@ -0,0 +1,101 @@
+import argparse
+import os.path as osp
+import random
+import sys
+import torch
+import numpy as np
+
+from decord import VideoReader
+from diffusers import AutoencoderKL
+from tqdm import tqdm
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.data.dataset import RealEstate10KPose
+from cameractrl.data.latent_cache import LatentCacheWriter
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_path', required=True, help='root path of the RealEstate10K dataset')
+    parser.add_argument('--annotation_json', required=True, help='json file generated by generate_realestate_json.py')
+    parser.add_argument('--pretrained_model_path', required=True, help='the vae is loaded from its vae subfolder')
+    parser.add_argument('--pose_store', default=None, help='pose store written by pack_realestate_poses.py')
+    parser.add_argument('--save_name', default='latent_cache',
+                        help='the cache is saved to root_path/save_name.bin and root_path/save_name.json')
+    parser.add_argument('--sample_size', type=int, nargs=2, default=[256, 384])
+    parser.add_argument('--windows_per_clip', type=int, default=0,
+                        help='number of frame windows cached per clip, all frames of the clips are cached if 0')
+    parser.add_argument('--sample_stride', type=int, default=8)
+    parser.add_argument('--minimum_sample_stride', type=int, default=1)
+    parser.add_argument('--sample_n_frames', type=int, default=16)
+    parser.add_argument('--with_flip', action='store_true', help='also cache the latents of the flipped frames')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of frames per vae forward')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'],
+                        help='dtype of the vae and of the cached latents, float32 as the vae of the training')
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def encode_frames(vae, frames, with_flip):
+    # frames: uint8 [n_frame, 3, h, w] at sample_size, returns [n_frame, n_dist, C, h // 8, w // 8]
+    pixel_values = frames.to(vae.device, vae.dtype).div_(127.5).sub_(1.)
+    latent_dist = vae.encode(pixel_values).latent_dist
+    latents = [latent_dist.mean, latent_dist.std]
+    if with_flip:
+        latent_dist = vae.encode(pixel_values.flip(-1)).latent_dist
+        latents += [latent_dist.mean, latent_dist.std]
+    return torch.stack(latents, dim=1).cpu().numpy()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    # only used for its annotations and frame sampling
+    dataset = RealEstate10KPose(args.root_path, args.annotation_json, sample_stride=args.sample_stride,
+                                minimum_sample_stride=args.minimum_sample_stride,
+                                sample_n_frames=args.sample_n_frames, sample_size=args.sample_size,
+                                pose_store=args.pose_store)
+    vae = AutoencoderKL.from_pretrained(args.pretrained_model_path, subfolder="vae",
+                                        torch_dtype=getattr(torch, args.dtype))
+    vae.requires_grad_(False)
+    vae.to('cuda').eval()
+    downsample_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+    latent_shape = (vae.config.latent_channels, dataset.sample_size[0] // downsample_factor,
+                    dataset.sample_size[1] // downsample_factor)
+    writer = LatentCacheWriter(osp.join(args.root_path, args.save_name), latent_shape, dataset.sample_size,
+                               with_flip=args.with_flip,
+                               sample_n_frames=args.sample_n_frames if args.windows_per_clip > 0 else None,
+                               dtype=args.dtype)
+
+    num_skipped = 0
+    for idx in tqdm(range(len(dataset))):
+        video_dict = dataset.dataset[idx]
+        try:
+            total_frames = len(dataset.load_cameras(idx))
+            if args.windows_per_clip > 0:
+                frame_indices = np.concatenate([dataset.sample_frame_indices(total_frames)
+                                                for _ in range(args.windows_per_clip)])
+            else:
+                frame_indices = np.arange(total_frames)
+            # decode and encode every cached frame of the clip once
+            decode_indices = np.unique(frame_indices)
+            video_reader = VideoReader(osp.join(args.root_path, video_dict['clip_path']))
+            latents = []
+            for start in range(0, len(decode_indices), args.batch_size):
+                frames = video_reader.get_batch(decode_indices[start: start + args.batch_size]).asnumpy()
+                frames = torch.from_numpy(frames).permute(0, 3, 1, 2).contiguous()
+                ori_h, ori_w = frames.shape[-2:]
+                if tuple(frames.shape[-2:]) != dataset.sample_size:
+                    frames = dataset.resize(frames)
+                latents.append(encode_frames(vae, frames, args.with_flip))
+            latents = np.concatenate(latents)[np.searchsorted(decode_indices, frame_indices)]
+        except Exception as e:
+            print(f'Skipping {video_dict["clip_name"]}: {e}')
+            num_skipped += 1
+            continue
+        writer.write(video_dict['clip_name'], latents, frame_indices, ori_h, ori_w)
+    num_rows = writer.close()
+    print(f'Saved the latents of {num_rows} frames, skipped {num_skipped} clips, '
+          f'index saved to {osp.join(args.root_path, args.save_name)}.json')
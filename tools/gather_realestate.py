@@ -3,6 +3,7 @@ import json
 import os
 import os.path as osp
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 
@@ -11,20 +12,67 @@ def get_args():
     parser.add_argument('--video_folder', required=True, help='Path to the down loaded realestate10k txt files')
     parser.add_argument('--save_path', required=True)
     parser.add_argument('--save_name', required=True)
+    parser.add_argument('--num_workers', type=int, default=16, help='threads reading the txt files')
+    parser.add_argument('--chunk_size', type=int, default=256, help='txt files per task of the threads')
+    parser.add_argument('--incremental', action='store_true',
+                        help='reuse the existing save_name json, only read the txt files not in it or modified '
+                             'after it was written')
     return parser.parse_args()
 
 
+def list_txts(video_folder):
+    with os.scandir(video_folder) as it:
+        return sorted(entry.name for entry in it if entry.is_file())
+
+
+def read_video_name(txt_path):
+    # the first line of the txt files is the youtube url of the video
+    with open(txt_path, 'r') as f:
+        return f.readline().strip().split('=')[-1]
+
+
+def scan_chunk(video_folder, txts, known_videos, since):
+    # known_videos: clip name -> video name of the previous scan, reused if the txt is older than `since`
+    results = []
+    for txt in txts:
+        txt_path = osp.join(video_folder, txt)
+        clip_name = txt.split('.')[0]
+        if clip_name in known_videos and os.stat(txt_path).st_mtime < since:
+            results.append((clip_name, known_videos[clip_name], False))
+        else:
+            results.append((clip_name, read_video_name(txt_path), True))
+    return results
+
+
 if __name__ == "__main__":
     args = get_args()
     os.makedirs(args.save_path, exist_ok=True)
-    all_txts = os.listdir(args.video_folder)
+    save_file = osp.join(args.save_path, args.save_name)
+    all_txts = list_txts(args.video_folder)
     print(f'There are {len(all_txts)} video clips in the folder {args.video_folder}')
+
+    known_videos, since = {}, 0.
+    if args.incremental and osp.exists(save_file):
+        with open(save_file, 'r') as f:
+            known_videos = {clip_name: video_name for video_name, clip_list in json.load(f).items()
+                            for clip_name in clip_list}
+        since = os.stat(save_file).st_mtime
+
+    chunks = [all_txts[start: start + args.chunk_size] for start in range(0, len(all_txts), args.chunk_size)]
     video_paths = defaultdict(list)
-    for txt in tqdm(all_txts):
-        with open(osp.join(args.video_folder, txt), 'r') as f:
-            lines = f.readlines()
-        video_name = lines[0].strip().split('=')[-1]
-        video_paths[video_name].append(txt.split('.')[0])
+    num_read = 0
+    with ThreadPoolExecutor(args.num_workers) as executor:
+        futures = [executor.submit(scan_chunk, args.video_folder, chunk, known_videos, since) for chunk in chunks]
+        with tqdm(total=len(all_txts)) as pbar:
+            # collected in the order of the chunks, so that the json does not depend on the scheduling
+            for future in futures:
+                results = future.result()
+                for clip_name, video_name, is_read in results:
+                    video_paths[video_name].append(clip_name)
+                    num_read += is_read
+                pbar.update(len(results))
+    if args.incremental:
+        print(f'Read {num_read} new or modified txt files, reused {len(all_txts) - num_read} from {save_file}')
     print(f'There are {len(video_paths)} videos in the folder {args.video_folder}')
-    with open(osp.join(args.save_path, args.save_name), 'w') as f:
+    with open(save_file, 'w') as f:
         json.dump(video_paths, fp=f)
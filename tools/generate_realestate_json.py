@@ -2,7 +2,10 @@ import argparse
 import json
 import os
 import os.path as osp
+import struct
+from multiprocessing import Pool
 from tqdm import tqdm
+from decord import VideoReader
 
 
 def get_args():
@@ -17,9 +20,133 @@ def get_args():
     parser.add_argument('--pose_folder', default='pose_files')
     parser.add_argument('--video2clip_json', required=True,
                         help='Mapping from original video to clip names, generated by gather_realestate.py')
+    parser.add_argument('--record_video_size', action='store_true',
+                        help='record the height and width of each clip, used by `decode_at_sample_size` of the datasets, '
+                             'with its fps and number of video frames')
+    parser.add_argument('--count_frames', action='store_true',
+                        help='record the frame number of each clip (`num_frames`), counted from its pose file')
+    parser.add_argument('--num_workers', type=int, default=8, help='processes opening the clips and pose files')
+    parser.add_argument('--shard_size', type=int, default=0,
+                        help='split the output into json files of shard_size clips, save_name-00000.json, ...')
     return parser.parse_args()
 
 
+def list_files(folder, suffix):
+    # one scandir of the folder instead of a stat call per file
+    if not osp.isdir(folder):
+        return set()
+    with os.scandir(folder) as it:
+        return {entry.name for entry in it if entry.name.endswith(suffix) and entry.is_file()}
+
+
+def list_video_clips(root_path, video_folder, suffix):
+    # relative paths of video_folder/<video_name>/<clip_name><suffix>
+    clip_paths = set()
+    with os.scandir(osp.join(root_path, video_folder)) as it:
+        video_dirs = [entry.name for entry in it if entry.is_dir()]
+    for video_name in tqdm(video_dirs, desc='listing the clips'):
+        for clip_file in list_files(osp.join(root_path, video_folder, video_name), suffix):
+            clip_paths.add(osp.join(video_folder, video_name, clip_file))
+    return clip_paths
+
+
+def find_mp4_boxes(f, path, start, end):
+    # (payload start, payload end) of the boxes at `path` (a list of box types) between start and end
+    while start + 8 <= end:
+        f.seek(start)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size, header = struct.unpack('>Q', f.read(8))[0], 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        if box_type == path[0]:
+            if len(path) == 1:
+                yield start + header, start + size
+            else:
+                yield from find_mp4_boxes(f, path[1:], start + header, start + size)
+        start += size
+
+
+def read_mp4_size(video_path):
+    """Returns the (height, width) of the first video track of an mp4 from its sample description, None if
+    it is not found. Reads a few boxes of the container instead of decoding a frame."""
+    with open(video_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        for minf_start, minf_end in list(find_mp4_boxes(f, [b'moov', b'trak', b'mdia', b'minf'], 0, file_size)):
+            if len(list(find_mp4_boxes(f, [b'vmhd'], minf_start, minf_end))) == 0:
+                continue  # not a video track
+            for stsd_start, _ in find_mp4_boxes(f, [b'stbl', b'stsd'], minf_start, minf_end):
+                # version, flags and entry count, then the first visual sample entry:
+                # size, format, 6 reserved, data reference, 16 predefined / reserved, width, height
+                f.seek(stsd_start + 8 + 32)
+                width, height = struct.unpack('>HH', f.read(4))
+                return height, width
+    return None
+
+
+def get_clip_metadata(task):
+    clip_info, root_path, record_video_size, count_frames = task
+    if record_video_size:
+        video_path = osp.join(root_path, clip_info['clip_path'])
+        video_reader = VideoReader(video_path)
+        # the size from the container, the first frame is only decoded if it is not an mp4
+        size = read_mp4_size(video_path) if video_path.endswith('.mp4') else None
+        height, width = size if size is not None else video_reader[0].shape[:2]
+        clip_info.update({"height": height, "width": width, "fps": video_reader.get_avg_fps(),
+                          "video_frames": len(video_reader)})
+    if count_frames:
+        with open(osp.join(root_path, clip_info['pose_file']), 'r') as f:
+            clip_info['num_frames'] = sum(1 for line in f.readlines()[1:] if line.strip())
+    return clip_info
+
+
+class AnnotationWriter(object):
+    """Writes the annotation list to one json file, or to json files of `shard_size` clips, one clip at a time."""
+    def __init__(self, save_path, save_name, shard_size=0):
+        self.save_path = save_path
+        self.save_name = save_name
+        self.shard_size = shard_size
+        self.saved_files = []
+        self.num_written = 0
+        self._file = None
+        self._num_in_file = 0
+
+    def _open(self):
+        if self.shard_size > 0:
+            save_name = f'{osp.splitext(self.save_name)[0]}-{len(self.saved_files):05d}.json'
+        else:
+            save_name = self.save_name
+        self.saved_files.append(osp.join(self.save_path, save_name))
+        self._file = open(self.saved_files[-1], 'w')
+        self._file.write('[')
+        self._num_in_file = 0
+
+    def _close_file(self):
+        self._file.write(']')
+        self._file.close()
+        self._file = None
+
+    def write(self, clip_info):
+        if self._file is None:
+            self._open()
+        # same separators as json.dump of the whole list
+        self._file.write((', ' if self._num_in_file > 0 else '') + json.dumps(clip_info))
+        self._num_in_file += 1
+        self.num_written += 1
+        if self.shard_size > 0 and self._num_in_file == self.shard_size:
+            self._close_file()
+
+    def close(self):
+        if self._file is None and len(self.saved_files) == 0:
+            self._open()
+        if self._file is not None:
+            self._close_file()
+        return self.saved_files
+
+
 if __name__ == '__main__':
     args = get_args()
     os.makedirs(args.save_path, exist_ok=True)
@@ -28,21 +155,30 @@ if __name__ == '__main__':
     captions = {k: v[0] for k, v in captions.items()}
     video2clips = json.load(open(args.video2clip_json, 'r'))
 
-    all_results = []
-    for video_name, clip_list in tqdm(video2clips.items()):
-        for clip_name in clip_list:
-            if clip_name not in captions:
-                continue
-            caption = captions[clip_name]
-            clip_relative_path = osp.join(args.video_folder, video_name, clip_name + args.video_suffix)
-            if not osp.exists(osp.join(save_root, clip_relative_path)):
-                continue
-            pose_file = osp.join(args.pose_folder, clip_name + args.pose_suffix)
-            if not osp.exists(osp.join(save_root, pose_file)):
-                continue
-            all_results.append({"clip_name": clip_name, "clip_path": clip_relative_path,
-                                "pose_file": pose_file, "caption": caption})
-    print(f'There are {len(all_results)} clips after the processing')
-    with open(osp.join(args.save_path, args.save_name), 'w') as f:
-        json.dump(all_results, fp=f)
-    print(f'Saved the generated json file to {osp.join(args.save_path, args.save_name)}')
+    clip_paths = list_video_clips(save_root, args.video_folder, args.video_suffix)
+    pose_files = list_files(osp.join(save_root, args.pose_folder), args.pose_suffix)
+
+    def iter_clip_infos():
+        for video_name, clip_list in video2clips.items():
+            for clip_name in clip_list:
+                if clip_name not in captions:
+                    continue
+                clip_relative_path = osp.join(args.video_folder, video_name, clip_name + args.video_suffix)
+                if clip_relative_path not in clip_paths or clip_name + args.pose_suffix not in pose_files:
+                    continue
+                pose_file = osp.join(args.pose_folder, clip_name + args.pose_suffix)
+                yield {"clip_name": clip_name, "clip_path": clip_relative_path,
+                       "pose_file": pose_file, "caption": captions[clip_name]}
+
+    writer = AnnotationWriter(args.save_path, args.save_name, args.shard_size)
+    if args.record_video_size or args.count_frames:
+        tasks = ((clip_info, save_root, args.record_video_size, args.count_frames) for clip_info in iter_clip_infos())
+        with Pool(args.num_workers) as pool:
+            for clip_info in tqdm(pool.imap(get_clip_metadata, tasks, chunksize=16)):
+                writer.write(clip_info)
+    else:
+        for clip_info in tqdm(iter_clip_infos()):
+            writer.write(clip_info)
+    saved_files = writer.close()
+    print(f'There are {writer.num_written} clips after the processing')
+    print(f'Saved the generated json file to {", ".join(saved_files)}')
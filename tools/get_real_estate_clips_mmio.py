@@ -2,11 +2,15 @@ import argparse
 import json
 import os
 import os.path as osp
-import imageio
-from decord import VideoReader
+import sys
+import time
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.utils.video_encoding import FFmpegPipeWriter, encode_frame_files, get_thread_budget
+from cameractrl.utils.job_manifest import ClipJobManifest, finish_clip, DONE, FAILED, SKIPPED
+
 def get_args():
     p = argparse.ArgumentParser()
     p.add_argument('--frame_root',       required=True)
@@ -21,6 +25,17 @@ def get_args():
                    help='Total parallel machines/instances')
     p.add_argument('--machine_rank',     type=int, default=0,
                    help='This machine’s rank (0 to num_machines-1)')
+    p.add_argument('--decode_threads',   type=int, default=4,
+                   help='Threads decoding the frame images of each worker')
+    p.add_argument('--read_ahead',       type=int, default=16,
+                   help='Decoded frames held ahead of the encoder by each worker')
+    p.add_argument('--ffmpeg_threads',   type=int, default=0,
+                   help='Encoding threads of the ffmpeg process of each worker, 0 splits the cores among the workers')
+    p.add_argument('--ffmpeg_timeout',   type=float, default=600.,
+                   help='Seconds after which the ffmpeg process encoding a clip is killed')
+    p.add_argument('--manifest',         default=None,
+                   help='SQLite job manifest on the shared storage, the workers of all the machines using the same '
+                        'manifest claim the videos from it instead of the low_idx:high_idx and machine_rank split')
     return p.parse_args()
 
 def load_map(path):
@@ -33,30 +48,40 @@ def load_map(path):
             m[clip] = line
     return m
 
-def process_video(vid, clip_list, clip_map, args, gpu_id):
+def process_video(vid, clip_list, clip_map, args, gpu_id, manifest=None):
+    # with a manifest, the progress is kept in the manifest instead of the .done markers
     os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
     out_dir = osp.join(args.save_path, vid)
     done_marker = osp.join(out_dir, '.done')
-    if osp.exists(done_marker):
+    if manifest is None and osp.exists(done_marker):
         return  # already done
 
     os.makedirs(out_dir, exist_ok=True)
     for clip in clip_list:
         txt = osp.join(args.clip_txt_path, clip + '.txt')
         if not osp.exists(txt):
+            finish_clip(manifest, clip, SKIPPED, error='no txt file')
             continue
         lines = [l.strip() for l in open(txt).read().splitlines() if l.strip()]
         if len(lines) < 2:
+            finish_clip(manifest, clip, SKIPPED, error='bad timestamps')
+            continue
+        try:
+            ts = [int(l.split()[0]) for l in lines[1:]]
+        except ValueError:
+            finish_clip(manifest, clip, SKIPPED, error='bad timestamps')
             continue
-        ts = [int(l.split()[0]) for l in lines[1:]]
         if ts[-1] <= ts[0]:
+            finish_clip(manifest, clip, SKIPPED, error='bad timestamps')
             continue
 
         fps = 1e6 / (ts[1] - ts[0])
         if clip not in clip_map:
+            finish_clip(manifest, clip, SKIPPED, error='no frames')
             continue
         frames_dir = osp.join(args.frame_root, clip_map[clip])
         if not osp.isdir(frames_dir):
+            finish_clip(manifest, clip, SKIPPED, error='no frames')
             continue
 
         frame_files = sorted(
@@ -65,28 +90,63 @@ def process_video(vid, clip_list, clip_map, args, gpu_id):
             if x.lower().endswith(('.png', '.jpg'))
         )
         if not frame_files:
+            finish_clip(manifest, clip, SKIPPED, error='no frames')
             continue
 
         out_mp4 = osp.join(out_dir, clip + '.mp4')
         if osp.exists(out_mp4):
+            finish_clip(manifest, clip, DONE, output_file=out_mp4)
             continue
 
-        frames = [imageio.imread(fp) for fp in frame_files]
-        imageio.mimsave(out_mp4, frames, fps=fps)
-
-        vr = VideoReader(out_mp4)
-        assert len(vr) == len(frame_files)
-
-    # mark done
-    open(done_marker, 'w').close()
+        start_time = time.time()
+        try:
+            # the clips are verified afterwards by verify_realestate_clips.py, from the container metadata
+            num_frames = encode_frame_files(frame_files, out_mp4, fps,
+                                            num_threads=args.decode_threads, read_ahead=args.read_ahead,
+                                            writer_cls=FFmpegPipeWriter, threads=args.ffmpeg_threads,
+                                            timeout=args.ffmpeg_timeout)
+        except Exception as e:
+            if manifest is None:
+                raise
+            finish_clip(manifest, clip, FAILED, duration=time.time() - start_time, error=repr(e))
+            continue
+        finish_clip(manifest, clip, DONE, duration=time.time() - start_time, output_file=out_mp4,
+                    num_frames=num_frames)
+
+    if manifest is None:
+        # mark done
+        open(done_marker, 'w').close()
+
+def run_manifest_worker(clip_map, args, gpu_id):
+    # claims videos until none is left, the workers finishing early take over the remaining ones
+    manifest = ClipJobManifest(args.manifest)
+    num_videos = 0
+    for vid in manifest.iter_claims():
+        start_time = time.time()
+        process_video(vid, manifest.get_pending_clips(vid), clip_map, args, gpu_id, manifest)
+        manifest.finish_video(vid, duration=time.time() - start_time)
+        num_videos += 1
+    return num_videos
 
 def main():
     args = get_args()
     os.makedirs(args.save_path, exist_ok=True)
+    # one worker per gpu, reused for all the videos, each one running a single ffmpeg process at a time
+    args.ffmpeg_threads = get_thread_budget(args.gpus, args.ffmpeg_threads)
 
     video2clips = json.load(open(args.video2clip_json))
     clip_map    = load_map(args.clip_folder_map)
 
+    if args.manifest is not None:
+        manifest = ClipJobManifest(args.manifest)
+        manifest.add_videos(video2clips)
+        with ProcessPoolExecutor(max_workers=args.gpus) as exe:
+            futures = [exe.submit(run_manifest_worker, clip_map, args, gpu) for gpu in range(args.gpus)]
+            for _ in tqdm(as_completed(futures), total=len(futures), desc='workers'):
+                pass
+        print(manifest.summary())
+        return
+
     vids = list(video2clips.keys())
     # apply index slicing
     if args.high_idx != -1:
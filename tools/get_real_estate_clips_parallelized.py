@@ -2,11 +2,15 @@ import argparse
 import json
 import os
 import os.path as osp
-import subprocess
-import tempfile
+import sys
+import time
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.utils.video_encoding import FFmpegPipeWriter, encode_frame_files, get_thread_budget
+from cameractrl.utils.job_manifest import ClipJobManifest, finish_clip, DONE, FAILED, SKIPPED
+
 def get_args():
     p = argparse.ArgumentParser()
     p.add_argument('--frame_root', required=True,
@@ -22,30 +26,30 @@ def get_args():
                    help='Number of parallel worker processes')
     p.add_argument('--use_nvenc', action='store_true',
                    help='Use GPU h264_nvenc encoder instead of libx264')
+    p.add_argument('--decode_threads', type=int, default=2,
+                   help='Threads decoding the frame images of each worker')
+    p.add_argument('--read_ahead', type=int, default=16,
+                   help='Decoded frames held ahead of the encoder by each worker')
+    p.add_argument('--ffmpeg_threads', type=int, default=0,
+                   help='Encoding threads of the ffmpeg process of each worker, 0 splits the cores among the workers')
+    p.add_argument('--ffmpeg_timeout', type=float, default=600.,
+                   help='Seconds after which the ffmpeg process encoding a clip is killed')
+    p.add_argument('--manifest', default=None,
+                   help='SQLite job manifest on the shared storage, the workers of all the instances using '
+                        'the same manifest claim the videos from it instead of processing low_idx:high_idx')
     return p.parse_args()
 
-def run_cmd(cmd):
-    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-def ffmpeg_frames_to_video(frames_dir, fps, output_path, file_list, use_nvenc):
-    # write a temp concat list (absolute paths)
-    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
-        list_path = f.name
-        for fname in file_list:
-            f.write(f"file '{osp.join(frames_dir, fname)}'\n")
-    cmd = [
-        'ffmpeg', '-y',
-        '-f', 'concat', '-safe', '0',
-        '-r', str(fps),
-        '-i', list_path,
-    ]
+def ffmpeg_frames_to_video(frames_dir, fps, output_path, file_list, use_nvenc, decode_threads=2, read_ahead=16,
+                           ffmpeg_threads=0, ffmpeg_timeout=600.):
+    # the decoded frames are streamed as raw video to the stdin of ffmpeg, no frame list is written
     if use_nvenc:
-        cmd += ['-c:v', 'h264_nvenc']
+        codec, output_params = 'h264_nvenc', []
     else:
-        cmd += ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '30']
-    cmd.append(output_path)
-    run_cmd(cmd)
-    os.remove(list_path)
+        codec, output_params = 'libx264', ['-preset', 'ultrafast', '-crf', '30']
+    return encode_frame_files([osp.join(frames_dir, fname) for fname in file_list], output_path, fps,
+                              num_threads=decode_threads, read_ahead=read_ahead, writer_cls=FFmpegPipeWriter,
+                              codec=codec, output_params=output_params, threads=ffmpeg_threads,
+                              timeout=ffmpeg_timeout)
 
 def load_map(path):
     m = {}
@@ -58,49 +62,90 @@ def load_map(path):
             m[clip] = line
     return m
 
-def process_video(vid, args, video2clips, clip_map):
+def process_video(vid, args, video2clips, clip_map, manifest=None):
     out_dir = osp.join(args.save_path, vid)
     os.makedirs(out_dir, exist_ok=True)
-    for clip in video2clips[vid]:
+    clip_list = manifest.get_pending_clips(vid) if manifest is not None else video2clips[vid]
+    for clip in clip_list:
         txt = osp.join(args.clip_txt_path, clip + '.txt')
         if not osp.exists(txt):
+            finish_clip(manifest, clip, SKIPPED, error='no txt file')
             continue
         lines = [l for l in open(txt).read().splitlines() if l.strip()]
         if len(lines) < 2:
+            finish_clip(manifest, clip, SKIPPED, error='bad timestamps')
+            continue
+        try:
+            ts = [int(l.split()[0]) for l in lines[1:]]
+        except ValueError:
+            finish_clip(manifest, clip, SKIPPED, error='bad timestamps')
             continue
-        ts = [int(l.split()[0]) for l in lines[1:]]
         if ts[-1] <= ts[0]:
+            finish_clip(manifest, clip, SKIPPED, error='bad timestamps')
             continue
 
         fps = 1e6 / (ts[1] - ts[0])
         if clip not in clip_map:
+            finish_clip(manifest, clip, SKIPPED, error='no frames')
             continue
         frames_dir = osp.join(args.frame_root, clip_map[clip])
         if not osp.isdir(frames_dir):
+            finish_clip(manifest, clip, SKIPPED, error='no frames')
             continue
 
         files = sorted(f for f in os.listdir(frames_dir)
                        if f.lower().endswith(('.png', '.jpg')))
         if not files:
+            finish_clip(manifest, clip, SKIPPED, error='no frames')
             continue
 
         out_mp4 = osp.join(out_dir, clip + '.mp4')
         if osp.exists(out_mp4):
+            finish_clip(manifest, clip, DONE, output_file=out_mp4)
             continue
 
+        start_time = time.time()
         try:
-            ffmpeg_frames_to_video(frames_dir, fps, out_mp4, files,
-                                   use_nvenc=args.use_nvenc)
-        except subprocess.CalledProcessError:
+            num_frames = ffmpeg_frames_to_video(frames_dir, fps, out_mp4, files,
+                                                use_nvenc=args.use_nvenc, decode_threads=args.decode_threads,
+                                                read_ahead=args.read_ahead, ffmpeg_threads=args.ffmpeg_threads,
+                                                ffmpeg_timeout=args.ffmpeg_timeout)
+        except Exception as e:
+            finish_clip(manifest, clip, FAILED, duration=time.time() - start_time, error=repr(e))
             continue
+        finish_clip(manifest, clip, DONE, duration=time.time() - start_time, output_file=out_mp4,
+                    num_frames=num_frames)
+
+def run_manifest_worker(args, video2clips, clip_map):
+    # claims videos until none is left, the workers finishing early take over the remaining ones
+    manifest = ClipJobManifest(args.manifest)
+    num_videos = 0
+    for vid in manifest.iter_claims():
+        start_time = time.time()
+        process_video(vid, args, video2clips, clip_map, manifest)
+        manifest.finish_video(vid, duration=time.time() - start_time)
+        num_videos += 1
+    return num_videos
 
 if __name__ == '__main__':
     args = get_args()
     os.makedirs(args.save_path, exist_ok=True)
+    # the workers are reused for all the videos, each one running a single ffmpeg process at a time
+    args.ffmpeg_threads = get_thread_budget(args.workers, args.ffmpeg_threads)
 
     video2clips = json.load(open(args.video2clip_json))
     clip_map = load_map(args.clip_folder_map)
 
+    if args.manifest is not None:
+        manifest = ClipJobManifest(args.manifest)
+        manifest.add_videos(video2clips)
+        with ProcessPoolExecutor(max_workers=args.workers) as exe:
+            futures = [exe.submit(run_manifest_worker, args, video2clips, clip_map) for _ in range(args.workers)]
+            for _ in tqdm(as_completed(futures), total=len(futures), desc='workers'):
+                pass
+        print(manifest.summary())
+        sys.exit(0)
+
     keys = list(video2clips.keys())
     if args.high_idx != -1:
         keys = keys[args.low_idx:args.high_idx]
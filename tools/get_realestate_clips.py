@@ -2,10 +2,15 @@ import argparse
 import json
 import os
 import os.path as osp
+import sys
+import time
+from collections import defaultdict
 from tqdm import tqdm
-from moviepy.editor import VideoFileClip
 import imageio
-from decord import VideoReader
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.utils.video_encoding import StreamingVideoWriter, encode_frame_files
+from cameractrl.utils.job_manifest import ClipJobManifest, finish_clip, DONE, FAILED, SKIPPED
 
 
 def get_args():
@@ -17,59 +22,177 @@ def get_args():
     parser.add_argument('--clip_txt_path', required=True, help='path to the downloaded realestate txt files')
     parser.add_argument('--low_idx', type=int, default=0, help='used for parallel processing')
     parser.add_argument('--high_idx', type=int, default=-1, help='used for parallel processing')
+    parser.add_argument('--decode_threads', type=int, default=4, help='threads decoding the frames of --frame_root')
+    parser.add_argument('--read_ahead', type=int, default=16, help='decoded frames held ahead of the encoder')
+    parser.add_argument('--manifest', default=None,
+                        help='SQLite job manifest on the shared storage, the instances using the same manifest claim '
+                             'the videos from it instead of processing low_idx:high_idx')
     return parser.parse_args()
 
 
+def read_timesteps(clip_txt_path, clip):
+    with open(osp.join(clip_txt_path, clip + '.txt'), 'r') as f:
+        lines = f.readlines()
+    return [int(x.split(' ')[0]) for x in lines[1:] if x.strip()]
+
+
+def read_clip_timesteps(clip_txt_path, clip, manifest=None):
+    # the timesteps of the clip, None if its txt file is missing or bad, the clip is then skipped
+    try:
+        timesteps = read_timesteps(clip_txt_path, clip)
+    except FileNotFoundError:
+        finish_clip(manifest, clip, SKIPPED, error='no txt file')
+        return None
+    except (ValueError, IndexError):
+        finish_clip(manifest, clip, SKIPPED, error='bad timestamps')
+        return None
+    if len(timesteps) < 2 or timesteps[-1] <= timesteps[0]:
+        finish_clip(manifest, clip, SKIPPED, error='bad timestamps')
+        return None
+    return timesteps
+
+
+def extract_clips(video_path, clip_timesteps, clip_save_path, on_clip_done=None):
+    """Decodes the source video once, in order, and streams the frames of all its clips to their encoders.
+
+    clip_timesteps: clip name -> timestamps (us) of its frames. The frame of a timestamp is the one
+    `VideoFileClip.get_frame` of moviepy returns. Returns the clips written, with their encoding time and the
+    number of frames the encoder received, and the clips left incomplete because the video ended before
+    their last frame. The clips are verified afterwards by verify_realestate_clips.py. `on_clip_done` is
+    called with the name of every clip written, e.g. to renew the lease of the video in the job manifest.
+    """
+    reader = imageio.get_reader(video_path, 'ffmpeg')
+    fps = reader.get_meta_data()['fps']
+    frame_clips = defaultdict(list)
+    last_frame = {}
+    for clip, timesteps in clip_timesteps.items():
+        frame_indices = [int(t / 1000000.0 * fps + 0.00001) for t in timesteps]
+        for frame_idx in frame_indices:
+            frame_clips[frame_idx].append(clip)
+        last_frame[clip] = max(frame_indices)
+    last_needed = max(last_frame.values())
+
+    writers, written, start_times = {}, {}, {}
+    try:
+        for frame_idx, frame in enumerate(reader):
+            if frame_idx > last_needed:
+                break
+            for clip in frame_clips.get(frame_idx, []):
+                if clip not in writers:
+                    writers[clip] = StreamingVideoWriter(osp.join(clip_save_path, clip + '.mp4'), fps=fps)
+                    start_times[clip] = time.time()
+                writers[clip].append(frame)
+            for clip in set(frame_clips.get(frame_idx, [])):
+                if last_frame[clip] == frame_idx:
+                    num_frames = writers.pop(clip).close()
+                    written[clip] = (time.time() - start_times[clip], num_frames)
+                    if on_clip_done is not None:
+                        on_clip_done(clip)
+    finally:
+        reader.close()
+        for writer in writers.values():
+            writer.abort()
+    return written, list(writers.keys())
+
+
+def process_frame_clips(video_name, clip_list, args, manifest=None):
+    clip_save_path = osp.join(args.save_path, video_name)
+    for clip in tqdm(clip_list):
+        clip_save_name = clip + '.mp4'
+        if osp.exists(osp.join(clip_save_path, clip_save_name)):
+            finish_clip(manifest, clip, DONE, output_file=osp.join(clip_save_path, clip_save_name))
+            continue
+        frames_dir = osp.join(args.frame_root, clip)
+        if not osp.exists(frames_dir):
+            finish_clip(manifest, clip, SKIPPED, error='no frames')
+            continue
+        frame_files = sorted([osp.join(frames_dir, x) for x in os.listdir(frames_dir)
+                             if x.lower().endswith(('.jpg', '.png'))])
+        if len(frame_files) == 0:
+            finish_clip(manifest, clip, SKIPPED, error='no frames')
+            continue
+        timesteps = read_clip_timesteps(args.clip_txt_path, clip, manifest)
+        if timesteps is None:
+            continue
+        fps = 1e6 / (timesteps[1] - timesteps[0])
+        start_time = time.time()
+        try:
+            # the clips are verified afterwards by verify_realestate_clips.py, from the container metadata
+            num_frames = encode_frame_files(frame_files, osp.join(clip_save_path, clip_save_name), fps,
+                                            num_threads=args.decode_threads, read_ahead=args.read_ahead)
+        except Exception as e:
+            if manifest is None:
+                raise
+            finish_clip(manifest, clip, FAILED, duration=time.time() - start_time, error=repr(e))
+            continue
+        finish_clip(manifest, clip, DONE, duration=time.time() - start_time,
+                    output_file=osp.join(clip_save_path, clip_save_name), num_frames=num_frames)
+
+
+def process_raw_clips(video_name, clip_list, args, manifest=None):
+    clip_save_path = osp.join(args.save_path, video_name)
+    video_path = osp.join(args.video_root, video_name + '.mp4')
+    if not osp.exists(video_path):
+        for clip in clip_list:
+            finish_clip(manifest, clip, SKIPPED, error='no source video')
+        return
+    clip_timesteps = {}
+    for clip in clip_list:
+        if osp.exists(osp.join(clip_save_path, clip + '.mp4')):
+            finish_clip(manifest, clip, DONE, output_file=osp.join(clip_save_path, clip + '.mp4'))
+            continue
+        timesteps = read_clip_timesteps(args.clip_txt_path, clip, manifest)
+        if timesteps is None:
+            continue
+        clip_timesteps[clip] = timesteps
+    if len(clip_timesteps) == 0:
+        return
+    try:
+        # the clips are only recorded once the video is decoded, the lease of the video is renewed meanwhile
+        on_clip_done = (lambda clip: manifest.renew(video_name)) if manifest is not None else None
+        written, incomplete = extract_clips(video_path, clip_timesteps, clip_save_path, on_clip_done)
+    except Exception as e:
+        if manifest is None:
+            raise
+        for clip in clip_timesteps:
+            finish_clip(manifest, clip, FAILED, error=repr(e))
+        return
+    for clip, (duration, num_frames) in written.items():
+        error = None
+        if num_frames != len(clip_timesteps[clip]):
+            error = f'{num_frames} frames written for {len(clip_timesteps[clip])} timesteps'
+            tqdm.write(f'{video_name}/{clip}: {error}')
+        finish_clip(manifest, clip, DONE, duration=duration, output_file=osp.join(clip_save_path, clip + '.mp4'),
+                    error=error, num_frames=num_frames)
+    for clip in incomplete:
+        finish_clip(manifest, clip, SKIPPED, error='the source video ends before the clip')
+    if len(incomplete) > 0:
+        tqdm.write(f'{video_name}: the video ends before the last frame of the clips {incomplete}')
+
+
+def process_video(video_name, clip_list, args, manifest=None):
+    os.makedirs(osp.join(args.save_path, video_name), exist_ok=True)
+    if args.frame_root is not None:
+        process_frame_clips(video_name, clip_list, args, manifest)
+    else:
+        process_raw_clips(video_name, clip_list, args, manifest)
+
+
 if __name__ == '__main__':
     args = get_args()
     os.makedirs(args.save_path, exist_ok=True)
     video2clips = json.load(open(args.video2clip_json, 'r'))
-    video_names = list(video2clips.keys())[args.low_idx: args.high_idx] if args.high_idx != -1 else list(video2clips.keys())
-    video2clips = {k: v for k, v in video2clips.items() if k in video_names}
-
-    for video_name, clip_list in tqdm(video2clips.items()):
-        clip_save_path = osp.join(args.save_path, video_name)
-        os.makedirs(clip_save_path, exist_ok=True)
-
-        if args.frame_root is not None:
-            for clip in tqdm(clip_list):
-                clip_save_name = clip + '.mp4'
-                if osp.exists(osp.join(clip_save_path, clip_save_name)):
-                    continue
-                frames_dir = osp.join(args.frame_root, clip)
-                if not osp.exists(frames_dir):
-                    continue
-                frame_files = sorted([osp.join(frames_dir, x) for x in os.listdir(frames_dir)
-                                     if x.lower().endswith(('.jpg', '.png'))])
-                if len(frame_files) == 0:
-                    continue
-                with open(osp.join(args.clip_txt_path, clip + '.txt'), 'r') as f:
-                    lines = f.readlines()
-                timesteps = [int(x.split(' ')[0]) for x in lines[1:]]
-                if len(timesteps) < 2 or timesteps[-1] <= timesteps[0]:
-                    continue
-                fps = 1e6 / (timesteps[1] - timesteps[0])
-                frames = [imageio.imread(fp) for fp in frame_files]
-                imageio.mimsave(osp.join(clip_save_path, clip_save_name), frames, fps=fps)
-                video_reader = VideoReader(osp.join(clip_save_path, clip_save_name))
-                assert len(video_reader) == len(frame_files)
-        else:
-            video_path = osp.join(args.video_root, video_name + '.mp4')
-            if not osp.exists(video_path):
-                continue
-            video = VideoFileClip(video_path)
-            for clip in tqdm(clip_list):
-                clip_save_name = clip + '.mp4'
-                if osp.exists(osp.join(clip_save_path, clip_save_name)):
-                    continue
-                with open(osp.join(args.clip_txt_path, clip + '.txt'), 'r') as f:
-                    lines = f.readlines()
-                frames = [x for x in lines[1: ]]
-                timesteps = [int(x.split(' ')[0]) for x in frames]
-                if timesteps[-1] <= timesteps[0]:
-                    continue
-                timestamps_seconds = [x / 1000000.0 for x in timesteps]
-                frames = [video.get_frame(t) for t in timestamps_seconds]
-                imageio.mimsave(osp.join(clip_save_path, clip_save_name), frames, fps=video.fps)
-                video_reader = VideoReader(osp.join(clip_save_path, clip_save_name))
-                assert len(video_reader) == len(timesteps)
+
+    if args.manifest is not None:
+        manifest = ClipJobManifest(args.manifest)
+        manifest.add_videos(video2clips)
+        for video_name in tqdm(manifest.iter_claims()):
+            start_time = time.time()
+            process_video(video_name, manifest.get_pending_clips(video_name), args, manifest)
+            manifest.finish_video(video_name, duration=time.time() - start_time)
+        print(manifest.summary())
+    else:
+        video_names = list(video2clips.keys())[args.low_idx: args.high_idx] if args.high_idx != -1 else list(video2clips.keys())
+        video2clips = {k: v for k, v in video2clips.items() if k in video_names}
+        for video_name, clip_list in tqdm(video2clips.items()):
+            process_video(video_name, clip_list, args)
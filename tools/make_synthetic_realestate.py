@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import os.path as osp
+import string
+import imageio
+import numpy as np
+
+from multiprocessing import Pool
+from tqdm import tqdm
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_path', required=True, help='the synthetic dataset is written to this directory')
+    parser.add_argument('--num_videos', type=int, default=16, help='number of source videos')
+    parser.add_argument('--clips_per_video', type=int, default=4)
+    parser.add_argument('--min_frames', type=int, default=64)
+    parser.add_argument('--max_frames', type=int, default=160)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--video_folder', default='video_clips')
+    parser.add_argument('--pose_folder', default='pose_files')
+    parser.add_argument('--save_name', default='annotations/train.json',
+                        help='annotation json, relative to root_path')
+    parser.add_argument('--record_video_size', action='store_true',
+                        help='record the height and width of each clip, as tools/generate_realestate_json.py does')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--num_workers', type=int, default=8)
+    return parser.parse_args()
+
+
+def random_name(rng, length, alphabet):
+    return ''.join(rng.choice(list(alphabet), size=length))
+
+
+def make_trajectory(rng, num_frames):
+    # smooth forward motion with a slowly turning yaw, returns the w2c [N, 3, 4]
+    yaw = rng.uniform(-np.pi, np.pi) + np.cumsum(np.full(num_frames, rng.uniform(-0.01, 0.01)))
+    pitch = rng.uniform(-0.1, 0.1)
+    speed = rng.uniform(0.005, 0.03)
+    c2w = np.tile(np.eye(4), (num_frames, 1, 1))
+    position = rng.normal(size=3)
+    for i in range(num_frames):
+        cy, sy, cp, sp = np.cos(yaw[i]), np.sin(yaw[i]), np.cos(pitch), np.sin(pitch)
+        rot_yaw = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+        rot_pitch = np.array([[1, 0, 0], [0, cp, -sp], [0, sp, cp]])
+        c2w[i, :3, :3] = rot_yaw @ rot_pitch
+        c2w[i, :3, 3] = position
+        position = position + speed * c2w[i, :3, 2]     # move along the viewing direction (+z, OpenCV convention)
+    return np.linalg.inv(c2w)[:, :3, :]
+
+
+def make_frames(rng, num_frames, height, width):
+    # a smooth random texture panning across the frames, so that the clips compress like natural videos
+    texture = rng.integers(0, 256, size=(height // 16 + 2, width // 16 + 2 + num_frames // 4, 3), dtype=np.uint8)
+    texture = texture.repeat(16, axis=0).repeat(16, axis=1)
+    return [texture[:height, 4 * i: 4 * i + width] for i in range(num_frames)]
+
+
+def write_clip(clip_info):
+    rng = np.random.default_rng(clip_info['seed'])
+    num_frames, height, width, fps = clip_info['num_frames'], clip_info['height'], clip_info['width'], clip_info['fps']
+    video_path = osp.join(clip_info['root_path'], clip_info['clip_path'])
+    os.makedirs(osp.dirname(video_path), exist_ok=True)
+    imageio.mimsave(video_path, make_frames(rng, num_frames, height, width), fps=fps, macro_block_size=1)
+
+    fx = rng.uniform(0.45, 0.6)
+    intrinsics = [fx, fx * width / height, 0.5, 0.5]
+    w2c = make_trajectory(rng, num_frames)
+    start_timestamp = int(rng.integers(0, 10 ** 8))
+    with open(osp.join(clip_info['root_path'], clip_info['pose_file']), 'w') as f:
+        f.write(f'https://www.youtube.com/watch?v={clip_info["video_name"]}\n')
+        for i in range(num_frames):
+            entry = intrinsics + [0., 0.] + w2c[i].reshape(-1).tolist()
+            f.write(f'{start_timestamp + round(i * 1e6 / fps)} ' + ' '.join(f'{x:.9f}' for x in entry) + '\n')
+
+
+if __name__ == '__main__':
+    args = get_args()
+    assert args.height % 2 == 0 and args.width % 2 == 0, 'the encoder needs an even frame size'
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(osp.join(args.root_path, args.pose_folder), exist_ok=True)
+    os.makedirs(osp.dirname(osp.join(args.root_path, args.save_name)), exist_ok=True)
+
+    # same layout and names as the downloaded dataset: video_clips/<video_name>/<clip_name>.mp4 and
+    # pose_files/<clip_name>.txt, with the 11 char youtube ids and 16 hex char clip names
+    clip_infos = []
+    for _ in range(args.num_videos):
+        video_name = random_name(rng, 11, string.ascii_letters + string.digits + '-_')
+        for _ in range(args.clips_per_video):
+            clip_name = random_name(rng, 16, '0123456789abcdef')
+            clip_infos.append({
+                'root_path': args.root_path, 'video_name': video_name, 'clip_name': clip_name,
+                'clip_path': osp.join(args.video_folder, video_name, clip_name + '.mp4'),
+                'pose_file': osp.join(args.pose_folder, clip_name + '.txt'),
+                'num_frames': int(rng.integers(args.min_frames, args.max_frames + 1)),
+                'height': args.height, 'width': args.width, 'fps': args.fps, 'seed': int(rng.integers(2 ** 31))})
+    with Pool(args.num_workers) as pool:
+        list(tqdm(pool.imap_unordered(write_clip, clip_infos), total=len(clip_infos)))
+
+    annotations = []
+    for i, clip_info in enumerate(clip_infos):
+        video_dict = {'clip_name': clip_info['clip_name'], 'clip_path': clip_info['clip_path'],
+                      'pose_file': clip_info['pose_file'], 'caption': f'a synthetic scene number {i}'}
+        if args.record_video_size:
+            video_dict.update({'height': args.height, 'width': args.width})
+        annotations.append(video_dict)
+    with open(osp.join(args.root_path, args.save_name), 'w') as f:
+        json.dump(annotations, fp=f)
+    print(f'Saved {len(annotations)} synthetic clips to {args.root_path}, '
+          f'annotations saved to {osp.join(args.root_path, args.save_name)}')
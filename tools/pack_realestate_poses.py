@@ -0,0 +1,36 @@
+import argparse
+import json
+import os
+import os.path as osp
+import sys
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.data.pose_store import pack_pose_files
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_path', required=True, help='root path of the RealEstate10K dataset')
+    parser.add_argument('--pose_folder', default='pose_files')
+    parser.add_argument('--pose_suffix', default='.txt')
+    parser.add_argument('--annotation_json', nargs='*', default=None,
+                        help='only pack the pose files used by these json files, generated by generate_realestate_json.py')
+    parser.add_argument('--save_name', default='pose_store',
+                        help='the store is saved to root_path/save_name.bin and root_path/save_name.json')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.annotation_json is not None:
+        pose_files = set()
+        for annotation_json in args.annotation_json:
+            pose_files.update(x['pose_file'] for x in json.load(open(osp.join(args.root_path, annotation_json), 'r')))
+        pose_files = sorted(pose_files)
+    else:
+        pose_files = sorted(osp.join(args.pose_folder, x) for x in os.listdir(osp.join(args.root_path, args.pose_folder))
+                            if x.endswith(args.pose_suffix))
+    print(f'Packing {len(pose_files)} pose files')
+    store_path = osp.join(args.root_path, args.save_name)
+    num_rows = pack_pose_files(args.root_path, pose_files, store_path)
+    print(f'Saved {num_rows} poses to {store_path}.bin, index saved to {store_path}.json')
@@ -0,0 +1,75 @@
+import argparse
+import os.path as osp
+import random
+import sys
+import torch
+import numpy as np
+
+from decord import VideoReader
+from tqdm import tqdm
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.data.dataset import RealEstate10KPose
+from cameractrl.data.pose_store import read_pose_file
+from cameractrl.data.shards import ShardWriter
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_path', required=True, help='root path of the RealEstate10K dataset')
+    parser.add_argument('--annotation_json', required=True, help='json file generated by generate_realestate_json.py')
+    parser.add_argument('--pose_store', default=None, help='pose store written by pack_realestate_poses.py')
+    parser.add_argument('--save_name', default='shards/train',
+                        help='the shards are saved to root_path/save_name-xxxxx.bin/json, '
+                             'the shard index to root_path/save_name.json')
+    parser.add_argument('--sample_stride', type=int, default=8)
+    parser.add_argument('--minimum_sample_stride', type=int, default=1)
+    parser.add_argument('--sample_n_frames', type=int, default=16)
+    parser.add_argument('--sample_size', type=int, nargs=2, default=[256, 384])
+    parser.add_argument('--windows_per_clip', type=int, default=4, help='number of frame windows sampled per clip')
+    parser.add_argument('--records_per_shard', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    # only used for its annotations and frame sampling, the frames are resized after decoding at the native size
+    dataset = RealEstate10KPose(args.root_path, args.annotation_json, sample_stride=args.sample_stride,
+                                minimum_sample_stride=args.minimum_sample_stride,
+                                sample_n_frames=args.sample_n_frames, sample_size=args.sample_size,
+                                pose_store=args.pose_store)
+    writer = ShardWriter(args.root_path, args.save_name, args.sample_n_frames, dataset.sample_size,
+                         records_per_shard=args.records_per_shard)
+    # the clips are shuffled once here, RealEstate10KPoseShards only shuffles the shards and a small buffer
+    clip_order = list(range(len(dataset)))
+    random.shuffle(clip_order)
+    num_skipped = 0
+    for idx in tqdm(clip_order):
+        video_dict = dataset.dataset[idx]
+        try:
+            if dataset.pose_store is not None:
+                poses = dataset.pose_store.get(video_dict['pose_file'])
+            else:
+                poses = read_pose_file(osp.join(args.root_path, video_dict['pose_file']))
+            windows = [dataset.sample_frame_indices(len(poses)) for _ in range(args.windows_per_clip)]
+            # decode every sampled frame of the clip once
+            decode_indices = np.unique(np.concatenate(windows))
+            video_reader = VideoReader(osp.join(args.root_path, video_dict['clip_path']))
+            frames = torch.from_numpy(video_reader.get_batch(decode_indices).asnumpy()).permute(0, 3, 1, 2).contiguous()
+            ori_h, ori_w = frames.shape[-2:]
+            if tuple(frames.shape[-2:]) != dataset.sample_size:
+                frames = dataset.resize(frames)
+            frames = frames.permute(0, 2, 3, 1).numpy()
+        except Exception as e:
+            print(f'Skipping {video_dict["clip_name"]}: {e}')
+            num_skipped += 1
+            continue
+        for frame_indices in windows:
+            writer.write(frames[np.searchsorted(decode_indices, frame_indices)], poses[frame_indices],
+                         video_dict['clip_name'], video_dict['caption'], ori_h, ori_w)
+    num_records = writer.close()
+    print(f'Saved {num_records} records in {len(writer.shards)} shards, skipped {num_skipped} clips, '
+          f'shard index saved to {osp.join(args.root_path, args.save_name)}.json')
@@ -0,0 +1,55 @@
+import argparse
+import json
+import os.path as osp
+import sys
+import torch
+
+from transformers import CLIPTextModel, CLIPTokenizer
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.utils.text_embedding_cache import write_text_embedding_store
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained_model_path', required=True,
+                        help='the tokenizer and the text encoder are loaded from its subfolders')
+    parser.add_argument('--root_path', default='', help='root path of the annotation json files')
+    parser.add_argument('--annotation_json', nargs='*', default=[],
+                        help='json files generated by generate_realestate_json.py, their captions are encoded')
+    parser.add_argument('--prompt_file', nargs='*', default=[],
+                        help='prompt files of inference.py, json (captions / prompts / negative_prompts) or txt')
+    parser.add_argument('--save_path', required=True,
+                        help='the embeddings are saved to save_path.bin and save_path.json')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--dtype', default=None, choices=['float16', 'float32'],
+                        help='dtype of the stored embeddings, the dtype of the text encoder by default')
+    return parser.parse_args()
+
+
+def load_prompts(prompt_file):
+    if prompt_file.endswith('.json'):
+        json_file = json.load(open(prompt_file, 'r'))
+        prompts = json_file['captions'] if 'captions' in json_file else json_file['prompts']
+        prompts = [prompt['caption'] if isinstance(prompt, dict) else prompt for prompt in prompts]
+        return prompts + json_file.get('negative_prompts', [])
+    with open(prompt_file, 'r') as f:
+        return [prompt.strip() for prompt in f.readlines()]
+
+
+if __name__ == '__main__':
+    args = get_args()
+    # the empty prompt is used for the null-text dropout and the unconditional branch
+    prompts = ['']
+    for annotation_json in args.annotation_json:
+        prompts += [x['caption'] for x in json.load(open(osp.join(args.root_path, annotation_json), 'r'))]
+    for prompt_file in args.prompt_file:
+        prompts += load_prompts(prompt_file)
+
+    tokenizer = CLIPTokenizer.from_pretrained(args.pretrained_model_path, subfolder="tokenizer")
+    text_encoder = CLIPTextModel.from_pretrained(args.pretrained_model_path, subfolder="text_encoder")
+    text_encoder.requires_grad_(False)
+    text_encoder.to('cuda' if torch.cuda.is_available() else 'cpu').eval()
+    num_prompts = write_text_embedding_store(args.save_path, prompts, tokenizer, text_encoder,
+                                             batch_size=args.batch_size, dtype=args.dtype)
+    print(f'Saved the embeddings of {num_prompts} prompts to {args.save_path}.bin, index saved to {args.save_path}.json')
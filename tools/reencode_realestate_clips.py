@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import os.path as osp
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+
+def get_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('--root_path', required=True, help='root path of the RealEstate10K dataset')
+    p.add_argument('--annotation_json', required=True, help='json file generated by generate_realestate_json.py')
+    p.add_argument('--save_folder', default=None,
+                   help='folder of the re-encoded clips under root_path, defaults to video_clips_gop{gop}')
+    p.add_argument('--save_annotation_json', default=None,
+                   help='annotation json pointing to the re-encoded clips, defaults to the annotation json '
+                        'name with a _gop{gop} suffix')
+    p.add_argument('--gop', type=int, default=8, help='fixed number of frames between two keyframes')
+    p.add_argument('--crf', type=int, default=18)
+    p.add_argument('--preset', default='fast')
+    p.add_argument('--ffmpeg', default='ffmpeg', help='path to the ffmpeg binary')
+    p.add_argument('--workers', type=int, default=os.cpu_count(),
+                   help='Number of parallel worker processes')
+    return p.parse_args()
+
+
+def reencode_clip(ffmpeg, input_path, output_path, gop, crf, preset):
+    # fixed GOP without scene-cut keyframes nor B-frames, so that any frame is at most gop - 1 frames after its
+    # keyframe and the frames are decoded in presentation order
+    cmd = [
+        ffmpeg, '-y', '-loglevel', 'error',
+        '-i', input_path, '-an',
+        '-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p',
+        '-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0', '-bf', '0',
+        output_path,
+    ]
+    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    save_folder = args.save_folder if args.save_folder is not None else f'video_clips_gop{args.gop}'
+    save_annotation_json = args.save_annotation_json if args.save_annotation_json is not None else \
+        osp.splitext(args.annotation_json)[0] + f'_gop{args.gop}.json'
+    annotations = json.load(open(osp.join(args.root_path, args.annotation_json), 'r'))
+
+    jobs = {}
+    reencoded = []
+    with ProcessPoolExecutor(max_workers=args.workers) as exe:
+        for video_dict in annotations:
+            # keeps the video_clips/<video_id>/<clip_name>.mp4 layout under save_folder
+            clip_path = osp.join(save_folder, *video_dict['clip_path'].split('/')[1:])
+            output_path = osp.join(args.root_path, clip_path)
+            if osp.exists(output_path):
+                reencoded.append(dict(video_dict, clip_path=clip_path))
+                continue
+            os.makedirs(osp.dirname(output_path), exist_ok=True)
+            future = exe.submit(reencode_clip, args.ffmpeg, osp.join(args.root_path, video_dict['clip_path']),
+                                output_path, args.gop, args.crf, args.preset)
+            jobs[future] = (video_dict, clip_path)
+
+        for future in tqdm(as_completed(jobs), total=len(jobs)):
+            video_dict, clip_path = jobs[future]
+            try:
+                future.result()
+            except subprocess.CalledProcessError as e:
+                print(f'Failed to re-encode {video_dict["clip_name"]}: {e.stderr.strip()}')
+                continue
+            reencoded.append(dict(video_dict, clip_path=clip_path))
+
+    # the keyframes of the source clips do not apply to the re-encoded ones
+    for video_dict in reencoded:
+        video_dict.pop('key_indices', None)
+    reencoded.sort(key=lambda x: x['clip_name'])
+    with open(osp.join(args.root_path, save_annotation_json), 'w') as f:
+        json.dump(reencoded, f)
+    print(f'Re-encoded {len(reencoded)} / {len(annotations)} clips to {osp.join(args.root_path, save_folder)}, '
+          f'annotations saved to {osp.join(args.root_path, save_annotation_json)}')
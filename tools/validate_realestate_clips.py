@@ -0,0 +1,78 @@
+import argparse
+import os.path as osp
+import sys
+
+from collections import Counter
+from multiprocessing import Pool
+from decord import VideoReader
+from tqdm import tqdm
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.data.dataset import load_annotations
+from cameractrl.data.pose_store import read_pose_file
+from cameractrl.data.quarantine import QuarantineRegistry, MISSING_FILE, BAD_POSE, SHORT_CLIP, DECODE_ERROR, \
+    get_failure_reason
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_path', required=True, help='root path of the RealEstate10K dataset')
+    parser.add_argument('--annotation_json', default=None, help='json file generated by generate_realestate_json.py')
+    parser.add_argument('--annotation_index', default=None, help='index written by build_annotation_index.py')
+    parser.add_argument('--quarantine', default='quarantine.txt',
+                        help='registry file of the bad clips, relative to root_path, the failures are appended to it')
+    parser.add_argument('--sample_n_frames', type=int, default=16)
+    parser.add_argument('--no_decode', action='store_true',
+                        help='only open the videos, do not decode their first and last frames')
+    parser.add_argument('--num_workers', type=int, default=8)
+    return parser.parse_args()
+
+
+def validate_clip(root_path, video_dict, sample_n_frames, decode):
+    # returns the failure reason of the clip, None if it can be loaded
+    pose_file = osp.join(root_path, video_dict['pose_file'])
+    video_path = osp.join(root_path, video_dict['clip_path'])
+    if not osp.exists(pose_file) or not osp.exists(video_path):
+        return MISSING_FILE
+    try:
+        num_poses = len(read_pose_file(pose_file))
+    except Exception:
+        return BAD_POSE
+    if num_poses < sample_n_frames:
+        return SHORT_CLIP
+    try:
+        video_reader = VideoReader(video_path)
+    except Exception:
+        return DECODE_ERROR
+    # the pose indices are used as frame indices of the video
+    if len(video_reader) < num_poses:
+        return SHORT_CLIP
+    if decode:
+        try:
+            video_reader.get_batch([0, num_poses - 1])
+        except Exception as e:
+            return get_failure_reason(e)
+    return None
+
+
+def validate_clip_worker(job):
+    return job[1]['clip_name'], validate_clip(*job)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    annotations = load_annotations(args.root_path, args.annotation_json, args.annotation_index)
+    quarantine = QuarantineRegistry(osp.join(args.root_path, args.quarantine))
+    jobs = [(args.root_path, video_dict, args.sample_n_frames, not args.no_decode) for video_dict in annotations
+            if not quarantine.is_quarantined(video_dict['clip_name'])]
+    print(f'Validating {len(jobs)} clips, {len(quarantine)} clips already quarantined')
+
+    reasons = Counter()
+    with Pool(args.num_workers) as pool:
+        for clip_name, reason in tqdm(pool.imap_unordered(validate_clip_worker, jobs, chunksize=16), total=len(jobs)):
+            if reason is not None:
+                reasons[reason] += 1
+                # the checks of the tool are not transient, the clip is quarantined at once
+                quarantine.record_failure(clip_name, reason, permanent=True)
+    print(f'Found {sum(reasons.values())} bad clips: {dict(reasons)}')
+    print(f'{len(quarantine)} clips quarantined in {quarantine.path}')
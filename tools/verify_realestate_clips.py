@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import os.path as osp
+import sys
+
+from multiprocessing import Pool
+from imageio_ffmpeg import count_frames_and_secs
+from tqdm import tqdm
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+from cameractrl.utils.job_manifest import ClipJobManifest, SKIPPED
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save_path', required=True, help='save_path of get_realestate_clips.py, one folder per video')
+    parser.add_argument('--clip_txt_path', required=True, help='path to the downloaded realestate txt files')
+    parser.add_argument('--video2clip_json', default=None,
+                        help='generated by gather_realestate.py, the clips of the json missing from save_path '
+                             'are reported too')
+    parser.add_argument('--manifest', default=None,
+                        help='job manifest of the extraction tools, the clips they skipped on purpose are reported '
+                             'apart from the missing ones, and the clips are checked against the number of frames '
+                             'the encoder received')
+    parser.add_argument('--report', default='verify_report.json', help='report file, relative to save_path')
+    parser.add_argument('--num_workers', type=int, default=8)
+    return parser.parse_args()
+
+
+def list_clips(save_path):
+    # (video name, clip name) of the finished clips, and the temporary files left by interrupted encodings
+    clips, tmp_files = [], []
+    with os.scandir(save_path) as videos:
+        for video in videos:
+            if not video.is_dir():
+                continue
+            with os.scandir(video.path) as files:
+                for entry in files:
+                    if entry.name.endswith('.tmp.mp4'):
+                        tmp_files.append(osp.join(video.name, entry.name))
+                    elif entry.name.endswith('.mp4'):
+                        clips.append((video.name, entry.name[:-len('.mp4')]))
+    return sorted(clips), sorted(tmp_files)
+
+
+def count_poses(pose_file):
+    with open(pose_file, 'r') as f:
+        return sum(1 for line in f.readlines()[1:] if line.strip())
+
+
+def verify_clip(job):
+    # the frames are counted from the packets of the container, nothing is decoded
+    # expected_frames: frames the encoder received according to the manifest, None to count the poses
+    save_path, clip_txt_path, video_name, clip_name, expected_frames = job
+    result = {'video_name': video_name, 'clip_name': clip_name}
+    pose_file = osp.join(clip_txt_path, clip_name + '.txt')
+    if not osp.exists(pose_file):
+        return 'no_pose', result
+    if expected_frames is None:
+        result['expected_frames'], result['expected_from'] = count_poses(pose_file), 'poses'
+    else:
+        result['expected_frames'], result['expected_from'] = expected_frames, 'manifest'
+    try:
+        result['num_frames'] = count_frames_and_secs(osp.join(save_path, video_name, clip_name + '.mp4'))[0]
+    except Exception as e:
+        result['error'] = str(e).strip().splitlines()[-1]
+        return 'unreadable', result
+    if result['num_frames'] != result['expected_frames']:
+        return 'mismatch', result
+    return 'ok', result
+
+
+if __name__ == '__main__':
+    args = get_args()
+    clips, tmp_files = list_clips(args.save_path)
+    print(f'Verifying {len(clips)} clips in {args.save_path}')
+
+    manifest_clips = ClipJobManifest(args.manifest).get_clips() if args.manifest is not None else {}
+    report = {'ok': 0, 'mismatch': [], 'unreadable': [], 'no_pose': [], 'missing': [], 'skipped': [],
+              'tmp_files': tmp_files}
+    jobs = [(args.save_path, args.clip_txt_path, video_name, clip_name,
+             manifest_clips.get(clip_name, {}).get('num_frames')) for video_name, clip_name in clips]
+    with Pool(args.num_workers) as pool:
+        for status, result in tqdm(pool.imap_unordered(verify_clip, jobs, chunksize=16), total=len(jobs)):
+            if status == 'ok':
+                report['ok'] += 1
+            else:
+                report[status].append(result)
+    for status in ('mismatch', 'unreadable', 'no_pose'):
+        report[status].sort(key=lambda result: (result['video_name'], result['clip_name']))
+
+    # the expected clips are those of the json, else those of the manifest. The clips the tools skipped on
+    # purpose, e.g. running past the end of the video, or without a txt file when there is no manifest to tell,
+    # are reported as skipped, the others not written as missing
+    if args.video2clip_json is not None:
+        with open(args.video2clip_json, 'r') as f:
+            expected = [(video_name, clip_name) for video_name, clip_list in json.load(f).items()
+                        for clip_name in clip_list]
+    else:
+        expected = [(clip['video_name'], clip_name) for clip_name, clip in manifest_clips.items()]
+    written = set(clips)
+    for video_name, clip_name in sorted(expected):
+        if (video_name, clip_name) in written:
+            continue
+        result = {'video_name': video_name, 'clip_name': clip_name}
+        clip = manifest_clips.get(clip_name)
+        if clip is not None and clip['status'] == SKIPPED:
+            report['skipped'].append(dict(result, reason=clip['error']))
+        elif clip is None and not osp.exists(osp.join(args.clip_txt_path, clip_name + '.txt')):
+            report['skipped'].append(dict(result, reason='no txt file'))
+        else:
+            report['missing'].append(result)
+
+    report_file = osp.join(args.save_path, args.report)
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'{report["ok"]} clips ok, ' + ', '.join(f'{len(report[status])} {status}' for status in
+                                                    ('mismatch', 'unreadable', 'no_pose', 'missing', 'skipped', 'tmp_files')))
+    print(f'Report written to {report_file}')
@@ -1,11 +1,16 @@
 import random
 import argparse
+import os.path as osp
+import sys
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib.patches import Patch
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+from cameractrl.data.dataset import CameraTrajectory
+
 
 class CameraPoseVisualizer:
     def __init__(self, xlim, ylim, zlim):
@@ -76,42 +81,29 @@ def get_args():
     return parser.parse_args()
 
 
-def get_c2w(w2cs, transform_matrix, relative_c2w):
+def get_c2w(cam_params, transform_matrix, relative_c2w):
     if relative_c2w:
-        target_cam_c2w = np.array([
-            [1, 0, 0, 0],
-            [0, 1, 0, 0],
-            [0, 0, 1, 0],
-            [0, 0, 0, 1]
-        ])
-        abs2rel = target_cam_c2w @ w2cs[0]
-        ret_poses = [target_cam_c2w, ] + [abs2rel @ np.linalg.inv(w2c) for w2c in w2cs[1:]]
+        ret_poses = cam_params.get_relative_c2w(zero_t_first_frame=True)
     else:
-        ret_poses = [np.linalg.inv(w2c) for w2c in w2cs]
-    ret_poses = [transform_matrix @ x for x in ret_poses]
-    return np.array(ret_poses, dtype=np.float32)
+        ret_poses = cam_params.c2w
+    return (transform_matrix @ ret_poses).astype(np.float32)
 
 
 if __name__ == '__main__':
     args = get_args()
-    with open(args.pose_file_path, 'r') as f:
-        poses = f.readlines()
-    w2cs = [np.asarray([float(p) for p in pose.strip().split(' ')[7:]]).reshape(3, 4) for pose in poses[1:]]
-    fxs = [float(pose.strip().split(' ')[1]) for pose in poses[1:]]
+    cam_params = CameraTrajectory.from_pose_file(args.pose_file_path)
     if args.all_frames:
-        args.num_frames = len(fxs)
+        args.num_frames = len(cam_params)
         args.sample_stride = 1
     cropped_length = args.num_frames * args.sample_stride
-    total_frames = len(w2cs)
+    total_frames = len(cam_params)
     start_frame_ind = random.randint(0, max(0, total_frames - cropped_length - 1))
     end_frame_ind = min(start_frame_ind + cropped_length, total_frames)
     frame_ind = np.linspace(start_frame_ind, end_frame_ind - 1, args.num_frames, dtype=int)
-    w2cs = [w2cs[x] for x in frame_ind]
+    cam_params = cam_params[frame_ind]
+    fxs = cam_params.intrinsics[:, 0]
     transform_matrix = np.asarray([[1, 0, 0, 0], [0, 0, 1, 0], [0, -1, 0, 0], [0, 0, 0, 1]]).reshape(4, 4)
-    last_row = np.zeros((1, 4))
-    last_row[0, -1] = 1.0
-    w2cs = [np.concatenate((w2c, last_row), axis=0) for w2c in w2cs]
-    c2ws = get_c2w(w2cs, transform_matrix, args.relative_c2w)
+    c2ws = get_c2w(cam_params, transform_matrix, args.relative_c2w)
 
     visualizer = CameraPoseVisualizer([args.x_min, args.x_max], [args.y_min, args.y_max], [args.z_min, args.z_max])
     for frame_idx, c2w in enumerate(c2ws):
@@ -120,4 +112,4 @@ if __name__ == '__main__':
 
     visualizer.colorbar(args.num_frames)
     pose_file_name = args.pose_file_path.split('/')[-1].split('.')[0]
-    visualizer.show()
\ No newline at end of file
+    visualizer.show()
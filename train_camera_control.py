@@ -10,7 +10,7 @@ import subprocess
 
 from pathlib import Path
 from omegaconf import OmegaConf
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -26,8 +26,13 @@ from diffusers.models.attention_processor import AttnProcessor
 from transformers import CLIPTextModel, CLIPTokenizer
 from einops import rearrange
 
-from cameractrl.data.dataset import RealEstate10KPose
+from cameractrl.data.dataset import RealEstate10KPose, ray_condition, batch_pixel_transforms
+from cameractrl.data.shards import RealEstate10KPoseShards
+from cameractrl.data.streaming import RealEstate10KPoseStream
+from cameractrl.data.samplers import LocalityAwareSampler, BucketBatchSampler
+from cameractrl.data.prefetcher import BatchPrefetcher
 from cameractrl.utils.util import setup_logger, format_time, save_videos_grid
+from cameractrl.utils.text_embedding_cache import TextEmbeddingCache, tokenize_prompts
 from cameractrl.pipelines.pipeline_animation import CameraCtrlPipeline
 from cameractrl.models.unet import UNet3DConditionModelPoseCond
 from cameractrl.models.pose_adaptor import CameraPoseEncoder, PoseAdaptor
@@ -65,6 +70,20 @@ def init_dist(launcher="slurm", backend='nccl', port=29500, **kwargs):
     return local_rank
 
 
+def get_plucker_embedding(batch, height, width, device):
+    """Returns the plucker embedding [b, 6, f, h, w] of a batch, built on `device` if the dataset returns poses.
+
+    height, width: size of the frames, the batches of a latent cache have no pixel_values to take it from.
+    """
+    if 'plucker_embedding' in batch:
+        plucker_embedding = batch['plucker_embedding'].to(device=device)  # [b, f, 6, h, w]
+    else:
+        plucker_embedding = ray_condition(batch['intrinsics'].to(device=device), batch['c2w'].to(device=device),
+                                          height, width, device=device, flip_flag=batch['flip_flag'].to(device=device))
+        plucker_embedding = plucker_embedding.permute(0, 1, 4, 2, 3).contiguous()  # [b, f, 6, h, w]
+    return rearrange(plucker_embedding, "b f c h w -> b c f h w")
+
+
 def main(name: str,
          launcher: str,
          port: int,
@@ -118,6 +137,14 @@ def main(name: str,
          global_seed: int = 42,
          logger_interval: int = 10,
          resume_from: str = None,
+
+         text_embedding_store: str = None,
+         text_embedding_cache_size: int = 256,
+
+         locality_sampler_window: int = 0,
+         prefetch_batches: int = 2,
+         stream_shard_size: int = 0,
+         buckets: List = None,
          ):
     check_min_version("0.10.0.dev0")
 
@@ -150,6 +177,7 @@ def main(name: str,
     noise_scheduler = DDIMScheduler(**OmegaConf.to_container(noise_scheduler_kwargs))
 
     vae = AutoencoderKL.from_pretrained(pretrained_model_path, subfolder="vae")
+    vae_scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
     tokenizer = CLIPTokenizer.from_pretrained(pretrained_model_path, subfolder="tokenizer")
     text_encoder = CLIPTextModel.from_pretrained(pretrained_model_path, subfolder="text_encoder")
     unet = UNet3DConditionModelPoseCond.from_pretrained_2d(pretrained_model_path, subfolder=unet_subfolder,
@@ -236,25 +264,69 @@ def main(name: str,
 
     # Get the training dataset
     logger.info(f'Building training datasets')
-    train_dataset = RealEstate10KPose(**train_data)
-    distributed_sampler = DistributedSampler(
-        train_dataset,
-        num_replicas=num_processes,
-        rank=global_rank,
-        shuffle=True,
-        seed=global_seed,
-    )
+    if buckets is not None and ('shard_index' in train_data or stream_shard_size > 0 or locality_sampler_window > 0):
+        raise ValueError('buckets cannot be combined with shard_index, stream_shard_size or locality_sampler_window')
+    if 'shard_index' in train_data:
+        # streams the shards written by tools/pack_realestate_shards.py, split between the ranks by the dataset
+        train_dataset = RealEstate10KPoseShards(**train_data, rank=global_rank, world_size=num_processes,
+                                                seed=global_seed)
+        distributed_sampler = None
+    elif stream_shard_size > 0:
+        # streams contiguous shards of the annotations per (rank, worker), see cameractrl/data/streaming.py
+        train_dataset = RealEstate10KPoseStream(**train_data, shard_size=stream_shard_size, rank=global_rank,
+                                                world_size=num_processes, seed=global_seed)
+        distributed_sampler = None
+    elif buckets is not None:
+        # shape-homogeneous batches of several (height, width, frames) buckets, see cameractrl/data/samplers.py
+        train_dataset = RealEstate10KPose(**train_data)
+        distributed_sampler = BucketBatchSampler(
+            train_dataset,
+            buckets=buckets,
+            batch_size=train_batch_size,
+            num_replicas=num_processes,
+            rank=global_rank,
+            shuffle=True,
+            seed=global_seed,
+        )
+    elif locality_sampler_window > 0:
+        # draws the clips of the same source video consecutively, see cameractrl/data/samplers.py
+        train_dataset = RealEstate10KPose(**train_data)
+        distributed_sampler = LocalityAwareSampler(
+            train_dataset,
+            window_size=locality_sampler_window,
+            num_replicas=num_processes,
+            rank=global_rank,
+            shuffle=True,
+            seed=global_seed,
+        )
+    else:
+        train_dataset = RealEstate10KPose(**train_data)
+        distributed_sampler = DistributedSampler(
+            train_dataset,
+            num_replicas=num_processes,
+            rank=global_rank,
+            shuffle=True,
+            seed=global_seed,
+        )
 
     # DataLoaders creation:
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        batch_size=train_batch_size,
-        shuffle=False,
-        sampler=distributed_sampler,
-        num_workers=num_workers,
-        pin_memory=True,
-        drop_last=True,
-    )
+    if isinstance(distributed_sampler, BucketBatchSampler):
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_sampler=distributed_sampler,
+            num_workers=num_workers,
+            pin_memory=True,
+        )
+    else:
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=train_batch_size,
+            shuffle=False,
+            sampler=distributed_sampler,
+            num_workers=num_workers,
+            pin_memory=True,
+            drop_last=True,
+        )
 
     # Get the validation dataset
     logger.info(f'Building validation datasets')
@@ -294,6 +366,11 @@ def main(name: str,
         scheduler=noise_scheduler,
         pose_encoder=pose_encoder)
     validation_pipeline.enable_vae_slicing()
+    # the text encoder is frozen, the embeddings of the captions are cached,
+    # optionally backed by the store written by tools/precompute_text_embeddings.py
+    text_embedding_cache = TextEmbeddingCache(tokenizer, text_encoder, store_path=text_embedding_store,
+                                              max_items=text_embedding_cache_size)
+    validation_pipeline.text_embedding_cache = text_embedding_cache
 
     # DDP wrapper
     pose_adaptor.to(local_rank)
@@ -336,30 +413,61 @@ def main(name: str,
         logger.info(f"Loading the pose encoder and attention processor weights done.")
         logger.info(f"Loading done, resuming training from the {global_step + 1}th iteration")
         lr_scheduler.last_epoch = first_epoch
+        if stream_shard_size > 0 and 'stream_cursors' in ckpt:
+            train_dataset.set_cursors(**ckpt['stream_cursors'])
     else:
         trained_iterations = 0
 
+    # failures of the clips recorded by the dataset workers of all ranks, reported with the training log
+    quarantine = getattr(train_dataset, 'quarantine', None)
+    if quarantine is not None:
+        quarantine_start_step = global_step
+        quarantine_failures_offset = quarantine.summary()['num_failures']
+
+    # last cursor of every (rank, worker) pair of the stream, saved with the checkpoints to resume mid-epoch
+    stream_cursors = {} if stream_shard_size > 0 else None
+    num_stream_slots = num_processes * max(num_workers, 1)
+
+    def process_batch(batch):
+        # run in the prefetch thread, ahead of the training step
+        if cfg_random_null_text:
+            batch['text'] = [name if random.random() > cfg_random_null_text_ratio else "" for name in batch['text']]
+        batch['text_inputs'] = tokenize_prompts(tokenizer, batch['text'])
+        return batch
+
     # Support mixed-precision training
     scaler = torch.cuda.amp.GradScaler() if mixed_precision_training else None
 
     for epoch in range(first_epoch, num_train_epochs):
-        train_dataloader.sampler.set_epoch(epoch)
+        if distributed_sampler is not None:
+            distributed_sampler.set_epoch(epoch)
+        else:
+            train_dataset.set_epoch(epoch)
         pose_adaptor.train()
 
-        data_iter = iter(train_dataloader)
+        # the batches come on the device, with the null-text dropout applied and the captions tokenized
+        data_iter = BatchPrefetcher(train_dataloader, local_rank, num_batches=prefetch_batches,
+                                    process_fn=process_batch)
         for step in range(trained_iterations, len(train_dataloader)):
 
             iter_start_time = time.time()
             batch = next(data_iter)
             data_end_time = time.time()
-            if cfg_random_null_text:
-                batch['text'] = [name if random.random() > cfg_random_null_text_ratio else "" for name in batch['text']]
+            if stream_cursors is not None:
+                # the samples of a batch come from the same worker, the last one holds its latest cursor
+                cursor = batch['stream_cursor'][-1].tolist()
+                stream_cursors[cursor[0]] = cursor[1:]
+            # the dataset returns the cached latent distribution of the frames if it uses a latent cache
+            use_latent_cache = 'latent_mean' in batch
+            if not use_latent_cache:
+                # normalize and flip the frames on the device if the dataset returns uint8 frames
+                pixel_values = batch_pixel_transforms(batch["pixel_values"], batch.get('flip_flag'))  # [b, f, c, h, w]
 
             # Data batch sanity check
-            if epoch == first_epoch and step == 0 and do_sanity_check:
-                pixel_values, texts = batch['pixel_values'].cpu(), batch['text']
-                pixel_values = rearrange(pixel_values, "b f c h w -> b c f h w")
-                for idx, (pixel_value, text) in enumerate(zip(pixel_values, texts)):
+            if epoch == first_epoch and step == 0 and do_sanity_check and not use_latent_cache:
+                sanity_pixel_values, texts = pixel_values.cpu(), batch['text']
+                sanity_pixel_values = rearrange(sanity_pixel_values, "b f c h w -> b c f h w")
+                for idx, (pixel_value, text) in enumerate(zip(sanity_pixel_values, texts)):
                     pixel_value = pixel_value[None, ...]
                     save_videos_grid(pixel_value,
                                      f"{output_dir}/sanity_check/{'-'.join(text.replace('/', '').split()[:10]) if not text == '' else f'{global_rank}-{idx}'}.gif",
@@ -368,13 +476,19 @@ def main(name: str,
             ### >>>> Training >>>> ###
 
             # Convert videos to latent space
-            pixel_values = batch["pixel_values"].to(local_rank)
-            video_length = pixel_values.shape[1]
-            with torch.no_grad():
-                pixel_values = rearrange(pixel_values, "b f c h w -> (b f) c h w")
-                latents = vae.encode(pixel_values).latent_dist.sample()
-                latents = rearrange(latents, "(b f) c h w -> b c f h w", f=video_length)
+            if use_latent_cache:
+                latent_mean = batch['latent_mean'].float()
+                video_length = latent_mean.shape[1]
+                latents = latent_mean + batch['latent_std'].float() * torch.randn_like(latent_mean)
+                latents = rearrange(latents, "b f c h w -> b c f h w")
                 latents = latents * 0.18215
+            else:
+                video_length = pixel_values.shape[1]
+                with torch.no_grad():
+                    pixel_values = rearrange(pixel_values, "b f c h w -> (b f) c h w")
+                    latents = vae.encode(pixel_values).latent_dist.sample()
+                    latents = rearrange(latents, "(b f) c h w -> b c f h w", f=video_length)
+                    latents = latents * 0.18215
 
             # Sample noise that we'll add to the latents
             noise = torch.randn_like(latents)  # [b, c, f, h, w]
@@ -389,17 +503,14 @@ def main(name: str,
             noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)  # [b, c, f h, w]
 
             # Get the text embedding for conditioning
-            with torch.no_grad():
-                prompt_ids = tokenizer(
-                    batch['text'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True,
-                    return_tensors="pt"
-                ).input_ids.to(latents.device)
-                encoder_hidden_states = text_encoder(prompt_ids)[0]  # b l c
+            encoder_hidden_states = text_embedding_cache.encode(batch['text'], latents.device, batch['text_inputs'])  # b l c
 
             # Predict the noise residual and compute loss
             # Mixed-precision training
-            plucker_embedding = batch["plucker_embedding"].to(device=local_rank)  # [b, f, 6, h, w]
-            plucker_embedding = rearrange(plucker_embedding, "b f c h w -> b c f h w")  # [b, 6, f h, w]
+            # the frame size of the batch, which may come from a bucket or a latent cache
+            plucker_embedding = get_plucker_embedding(batch, latents.shape[-2] * vae_scale_factor,
+                                                      latents.shape[-1] * vae_scale_factor,
+                                                      device=local_rank)  # [b, 6, f h, w]
             with torch.cuda.amp.autocast(enabled=mixed_precision_training):
                 model_pred = pose_adaptor(noisy_latents,
                                           timesteps,
@@ -440,6 +551,9 @@ def main(name: str,
             iter_end_time = time.time()
 
             # Save checkpoint
+            if stream_cursors is not None and (global_step % checkpointing_steps == 0):
+                all_stream_cursors = [None] * num_processes
+                dist.all_gather_object(all_stream_cursors, stream_cursors)
             if is_main_process and (global_step % checkpointing_steps == 0):
                 save_path = os.path.join(output_dir, f"checkpoints")
                 state_dict = {
@@ -450,6 +564,10 @@ def main(name: str,
                                                        if k in attention_trainable_param_names},
                     "optimizer_state_dict": optimizer.state_dict()
                 }
+                if stream_cursors is not None:
+                    state_dict["stream_cursors"] = {
+                        "cursors": {k: v for cursors in all_stream_cursors for k, v in cursors.items()},
+                        "epoch": epoch, "num_slots": num_stream_slots}
                 torch.save(state_dict, os.path.join(save_path, f"checkpoint-step-{global_step}.ckpt"))
                 logger.info(f"Saved state to {save_path} (global_step: {global_step})")
 
@@ -474,8 +592,7 @@ def main(name: str,
                 validation_data_iter = iter(validation_dataloader)
 
                 for idx, validation_batch in enumerate(validation_data_iter):
-                    plucker_embedding = validation_batch['plucker_embedding'].to(device=unet.device)
-                    plucker_embedding = rearrange(plucker_embedding, "b f c h w -> b c f h w")
+                    plucker_embedding = get_plucker_embedding(validation_batch, height, width, device=unet.device)
                     sample = validation_pipeline(
                         prompt=validation_batch['text'],
                         pose_embedding=plucker_embedding,
@@ -486,7 +603,9 @@ def main(name: str,
                         guidance_scale=8.,
                         generator=generator,
                     ).videos[0]  # [3 f h w]
-                    sample_gt = torch.cat([sample, (validation_batch['pixel_values'][0].permute(1, 0, 2, 3) + 1.0) / 2.0], dim=2)  # [3, f, 2h, w]
+                    validation_pixel_values = batch_pixel_transforms(validation_batch['pixel_values'],
+                                                                     validation_batch.get('flip_flag'))
+                    sample_gt = torch.cat([sample, (validation_pixel_values[0].permute(1, 0, 2, 3) + 1.0) / 2.0], dim=2)  # [3, f, 2h, w]
                     if 'clip_name' in validation_batch:
                         save_path = f"{output_dir}/samples/sample-{global_step}/{validation_batch['clip_name'][0]}.gif"
                     else:
@@ -500,10 +619,15 @@ def main(name: str,
                       f"Iter time: {format_time(iter_end_time - data_end_time)}, " \
                       f"ETA: {format_time((iter_end_time - iter_start_time) * (max_train_steps - global_step))}, " \
                       f"GPU memory: {gpu_memory: .2f} G"
+                msg += ", " + data_iter.get_log_message()
+                if quarantine is not None:
+                    num_samples = (global_step - quarantine_start_step) * train_batch_size * num_processes
+                    msg += ", " + quarantine.get_log_message(num_samples, quarantine_failures_offset)
                 logger.info(msg)
 
             if global_step >= max_train_steps:
                 break
+        data_iter.close()
 
     dist.destroy_process_group()
 
@@ -30,8 +30,11 @@ from diffusers.utils.import_utils import is_xformers_available
 
 from transformers import CLIPTextModel, CLIPTokenizer
 
-from cameractrl.data.dataset import RealEstate10K
+from cameractrl.data.dataset import RealEstate10K, batch_pixel_transforms
+from cameractrl.data.samplers import LocalityAwareSampler
+from cameractrl.data.prefetcher import BatchPrefetcher
 from cameractrl.utils.util import setup_logger, format_time
+from cameractrl.utils.text_embedding_cache import TextEmbeddingCache, tokenize_prompts
 
 
 def init_dist(launcher="slurm", backend='nccl', port=29500, **kwargs):
@@ -110,7 +113,13 @@ def main(name: str,
          global_seed: int = 42,
          logger_interval: int = 10,
 
-         resume_from: str = None
+         resume_from: str = None,
+
+         text_embedding_store: str = None,
+         text_embedding_cache_size: int = 256,
+
+         locality_sampler_window: int = 0,
+         prefetch_batches: int = 2,
 ):
     check_min_version("0.10.0.dev0")
 
@@ -206,13 +215,24 @@ def main(name: str,
 
     # Get the training dataset
     train_dataset = RealEstate10K(**train_data)
-    distributed_sampler = DistributedSampler(
-        train_dataset,
-        num_replicas=num_processes,
-        rank=global_rank,
-        shuffle=True,
-        seed=global_seed,
-    )
+    if locality_sampler_window > 0:
+        # draws the clips of the same source video consecutively, see cameractrl/data/samplers.py
+        distributed_sampler = LocalityAwareSampler(
+            train_dataset,
+            window_size=locality_sampler_window,
+            num_replicas=num_processes,
+            rank=global_rank,
+            shuffle=True,
+            seed=global_seed,
+        )
+    else:
+        distributed_sampler = DistributedSampler(
+            train_dataset,
+            num_replicas=num_processes,
+            rank=global_rank,
+            shuffle=True,
+            seed=global_seed,
+        )
 
     # DataLoaders creation:
     train_dataloader = torch.utils.data.DataLoader(
@@ -247,6 +267,10 @@ def main(name: str,
                                                                   tokenizer=tokenizer, text_encoder=text_encoder,
                                                                   scheduler=noise_scheduler, safety_checker=None,)
     validation_pipeline.enable_vae_slicing()
+    # the text encoder is frozen, the embeddings of the captions are cached,
+    # optionally backed by the store written by tools/precompute_text_embeddings.py
+    text_embedding_cache = TextEmbeddingCache(tokenizer, text_encoder, store_path=text_embedding_store,
+                                              max_items=text_embedding_cache_size)
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / gradient_accumulation_steps)
@@ -286,6 +310,19 @@ def main(name: str,
     else:
         trained_iterations = 0
 
+    # failures of the clips recorded by the dataset workers of all ranks, reported with the training log
+    quarantine = getattr(train_dataset, 'quarantine', None)
+    if quarantine is not None:
+        quarantine_start_step = global_step
+        quarantine_failures_offset = quarantine.summary()['num_failures']
+
+    def process_batch(batch):
+        # run in the prefetch thread, ahead of the training step
+        if cfg_random_null_text:
+            batch['caption'] = [name if random.random() > cfg_random_null_text_ratio else "" for name in batch['caption']]
+        batch['text_inputs'] = tokenize_prompts(tokenizer, batch['caption'])
+        return batch
+
     # Support mixed-precision training
     scaler = torch.cuda.amp.GradScaler() if mixed_precision_training else None
 
@@ -293,25 +330,26 @@ def main(name: str,
         train_dataloader.sampler.set_epoch(epoch)
         unet.train()
 
-        data_iter = iter(train_dataloader)
+        # the batches come on the device, with the null-text dropout applied and the captions tokenized
+        data_iter = BatchPrefetcher(train_dataloader, local_rank, num_batches=prefetch_batches,
+                                    process_fn=process_batch)
         for step in range(trained_iterations, len(train_dataloader)):
             iter_start_time = time.time()
             batch = next(data_iter)
             data_end_time = time.time()
-            if cfg_random_null_text:
-                batch['caption'] = [name if random.random() > cfg_random_null_text_ratio else "" for name in batch['caption']]
+            # normalize and flip the images on the device if the dataset returns uint8 images
+            pixel_values = batch_pixel_transforms(batch["pixel_values"], batch.get('flip_flag'))
 
             # Data batch sanity check
             if epoch == first_epoch and step == 0 and do_sanity_check:
-                pixel_values, texts = batch['pixel_values'].cpu(), batch['caption']
-                for idx, (pixel_value, text) in enumerate(zip(pixel_values, texts)):
+                sanity_pixel_values, texts = pixel_values.cpu(), batch['caption']
+                for idx, (pixel_value, text) in enumerate(zip(sanity_pixel_values, texts)):
                     pixel_value = pixel_value / 2. + 0.5
                     torchvision.utils.save_image(pixel_value, f"{output_dir}/sanity_check/{'-'.join(text.replace('/', '').split()[:10]) if not text == '' else f'{global_rank}-{idx}'}.png")
 
             ### >>>> Training >>>> ###
 
             # Convert videos to latent space            
-            pixel_values = batch["pixel_values"].to(local_rank)
             with torch.no_grad():
                 latents = vae.encode(pixel_values).latent_dist
                 latents = latents.sample()
@@ -331,11 +369,7 @@ def main(name: str,
             noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
 
             # Get the text embedding for conditioning
-            with torch.no_grad():
-                prompt_ids = tokenizer(
-                    batch['caption'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
-                ).input_ids.to(latents.device)
-                encoder_hidden_states = text_encoder(prompt_ids)[0]
+            encoder_hidden_states = text_embedding_cache.encode(batch['caption'], latents.device, batch['text_inputs'])
 
             # Get the target for loss depending on the prediction type
             if noise_scheduler.config.prediction_type == "epsilon":
@@ -426,10 +460,15 @@ def main(name: str,
                       f"Iter time: {format_time(iter_end_time - data_end_time)}, " \
                       f"ETA: {format_time((iter_end_time - iter_start_time) * (max_train_steps - global_step))}, " \
                       f"GPU memory: {gpu_memory: .2f} G"
+                msg += ", " + data_iter.get_log_message()
+                if quarantine is not None:
+                    num_samples = (global_step - quarantine_start_step) * train_batch_size * num_processes
+                    msg += ", " + quarantine.get_log_message(num_samples, quarantine_failures_offset)
                 logger.info(msg)
 
             if global_step >= max_train_steps:
                 break
+        data_iter.close()
 
     dist.destroy_process_group()
 